@@ -0,0 +1,127 @@
+"""
+Benchmark of the chunk representation of the scraping hot path: the memory of 100k chunks stored as dicts, as
+ChunkRecord tuples and as a pandas DataFrame (the previous representation), the time of the dedup and diff against the
+stored hash_ids with sets and with pandas, and the import time of each representation.
+
+Usage: python -m benchmarks.bench_chunk_records [--chunks 100000]
+"""
+import argparse
+import gc
+import importlib.util
+import random
+import subprocess
+import sys
+import time
+import tracemalloc
+
+from src.utils.chunk_record import ChunkRecord
+from src.utils.general_functions import calculate_hash
+
+SOURCES = ('Airzone Support', 'Airzone FAQs', 'Airzone Downloads')
+
+
+def create_fields(n_chunks: int) -> list:
+    """
+    Create the fields of the chunks before building any container, so only the container overhead is measured.
+    :param n_chunks: number of chunks
+    :return: list of tuples with the fields of each chunk (about 1% of them duplicated)
+    """
+    rng = random.Random(0)
+    upload_date = time.strftime('%Y-%m-%d %H:%M:%S')
+    fields = []
+    for i in range(n_chunks):
+        # A few chunks are repeated, as happens with documents shared by several sections
+        j = rng.randrange(i) if i and rng.random() < 0.01 else i
+        text = f"Chunk {j}: instrucciones de instalación del termostato Airzone Blueface Zero " * 6
+        fields.append((calculate_hash(f"Documento {j // 10}{text}"), upload_date, SOURCES[j % len(SOURCES)],
+                       f"Documento {j // 10}", text))
+    return fields
+
+
+def measure_memory(build) -> tuple:
+    gc.collect()
+    tracemalloc.start()
+    container = build()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return size, container
+
+
+def set_dedup_and_diff(records, stored_hash_ids: set) -> tuple:
+    seen = set()
+    unique = []
+    for record in records:
+        key = (record.source, record.hash_id)
+        if key not in seen:
+            seen.add(key)
+            unique.append(record)
+    new = [record for record in unique if record.hash_id not in stored_hash_ids]
+    seen_hash_ids = {hash_id for _, hash_id in seen}
+    stale = [hash_id for hash_id in stored_hash_ids if hash_id not in seen_hash_ids]
+    return len(new), len(stale)
+
+
+def pandas_dedup_and_diff(df, stored_hash_ids: set) -> tuple:
+    import pandas as pd
+    unique = df.drop_duplicates(subset=['source', 'hash_id'])
+    stored = pd.Series(list(stored_hash_ids))
+    new = unique[~unique['hash_id'].isin(stored)]
+    stale = stored[~stored.isin(unique['hash_id'])]
+    return len(new), len(stale)
+
+
+def import_seconds(module: str) -> float:
+    """
+    Measure the import time of a module in a fresh interpreter.
+    :param module: module name
+    :return: import time in seconds
+    """
+    code = f"import time; start = time.perf_counter(); import {module}; print(time.perf_counter() - start)"
+    return float(subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True).stdout)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--chunks', type=int, default=100000, help='number of chunks')
+    args = parser.parse_args()
+
+    pandas_available = importlib.util.find_spec('pandas') is not None
+    fields = create_fields(args.chunks)
+    keys = ('hash_id', 'upload_date', 'source', 'title', 'description')
+    per_100k = 100000 / args.chunks
+
+    dict_bytes, dicts = measure_memory(lambda: [dict(zip(keys, row)) for row in fields])
+    record_bytes, records = measure_memory(lambda: [ChunkRecord(*row) for row in fields])
+    print("Memory of the chunks (container overhead, the strings are shared), per 100k chunks:")
+    print(f"  dicts:              {dict_bytes * per_100k / 2 ** 20:7.1f} MiB")
+    print(f"  ChunkRecord:        {record_bytes * per_100k / 2 ** 20:7.1f} MiB "
+          f"({dict_bytes / record_bytes:.1f}x less than dicts)")
+    if pandas_available:
+        import pandas as pd
+        # The previous path built the dicts and then a DataFrame from them, so both were alive at the same time
+        df_bytes, df = measure_memory(lambda: pd.DataFrame(dicts))
+        print(f"  dicts + DataFrame:  {(dict_bytes + df_bytes) * per_100k / 2 ** 20:7.1f} MiB "
+              f"({(dict_bytes + df_bytes) / record_bytes:.1f}x more than ChunkRecord)")
+
+    # Half of the chunks are already stored, and the stored collection has some stale chunks
+    stored_hash_ids = {record.hash_id for record in records[::2]} | {calculate_hash(str(i)) for i in range(1000)}
+    start = time.perf_counter()
+    set_result = set_dedup_and_diff(records, stored_hash_ids)
+    set_seconds = time.perf_counter() - start
+    print(f"Dedup and diff against {len(stored_hash_ids)} stored hash_ids:")
+    print(f"  sets:   {set_seconds:.3f} s ({set_result[0]} new, {set_result[1]} stale)")
+    if pandas_available:
+        start = time.perf_counter()
+        pandas_result = pandas_dedup_and_diff(df, stored_hash_ids)
+        pandas_seconds = time.perf_counter() - start
+        assert pandas_result == set_result, "The set-based diff differs from the pandas diff"
+        print(f"  pandas: {pandas_seconds:.3f} s ({pandas_seconds / set_seconds:.2f}x the time of the sets)")
+
+    print("Import time (fresh interpreter):")
+    print(f"  src.utils.chunk_record: {import_seconds('src.utils.chunk_record') * 1000:7.1f} ms")
+    if pandas_available:
+        print(f"  pandas:                 {import_seconds('pandas') * 1000:7.1f} ms")
+
+
+if __name__ == '__main__':
+    main()
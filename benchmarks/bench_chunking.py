@@ -0,0 +1,79 @@
+"""
+Micro-benchmark of the chunking engine: the previous split_text_into_chunks (new splitter and HTML parsing for every
+call) against the cached splitters, the markup check and the batch API. Both paths use the same chunk parameters and
+must produce identical chunks.
+
+Usage: python -m benchmarks.bench_chunking [--documents 2000] [--repeat 3]
+"""
+import argparse
+import random
+import time
+
+from bs4 import BeautifulSoup
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+from src.utils.general_functions import split_text_into_chunks, split_texts_into_chunks
+
+WORDS = ('termostato', 'zona', 'Airzone', 'instalación', 'configuración', 'sistema', 'compuerta', 'rejilla',
+         'Blueface', 'Think', 'temperatura', 'modo', 'calor', 'frío', 'ventilación', 'consigna', 'pasarela')
+
+
+def create_documents(n_documents: int) -> list:
+    """
+    Create already cleaned texts (as produced by the scrapers) and a share of raw HTML descriptions.
+    :param n_documents: number of documents
+    :return: list of texts
+    """
+    rng = random.Random(0)
+    documents = []
+    for i in range(n_documents):
+        text = '. '.join(' '.join(rng.choice(WORDS) for _ in range(rng.randint(6, 18)))
+                         for _ in range(rng.randint(2, 40))) + '.'
+        documents.append(f"<p>{text}</p><ul><li>{text[:80]}</li></ul>" if i % 10 == 0 else text)
+    return documents
+
+
+def legacy_split_text_into_chunks(text: str, chunk_size: int, chunk_overlap: int) -> list:
+    clean_text = BeautifulSoup(text, "html.parser").get_text()
+    text_splitter = RecursiveCharacterTextSplitter(
+        chunk_size=chunk_size,
+        chunk_overlap=chunk_overlap,
+        length_function=len,
+    )
+    return text_splitter.split_text(clean_text)
+
+
+def measure(function, repeat: int) -> tuple:
+    best, result = float('inf'), None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--documents', type=int, default=2000, help='number of documents')
+    parser.add_argument('--repeat', type=int, default=3, help='repetitions (the best one is reported)')
+    args = parser.parse_args()
+
+    documents = create_documents(args.documents)
+    for chunk_size, chunk_overlap in ((1000, 200), (500, 100)):
+        legacy_seconds, legacy_chunks = measure(
+            lambda: [legacy_split_text_into_chunks(text, chunk_size, chunk_overlap) for text in documents], args.repeat)
+        single_seconds, single_chunks = measure(
+            lambda: [split_text_into_chunks(text, chunk_size, chunk_overlap) for text in documents], args.repeat)
+        batch_seconds, batch_chunks = measure(
+            lambda: split_texts_into_chunks(documents, chunk_size, chunk_overlap), args.repeat)
+
+        assert legacy_chunks == single_chunks == batch_chunks, "The chunking engine output differs"
+        print(f"chunk_size={chunk_size}, chunk_overlap={chunk_overlap}, {args.documents} documents, "
+              f"{sum(map(len, batch_chunks))} chunks")
+        print(f"  Previous split_text_into_chunks: {legacy_seconds:.3f} s")
+        print(f"  split_text_into_chunks:          {single_seconds:.3f} s ({legacy_seconds / single_seconds:.2f}x)")
+        print(f"  split_texts_into_chunks (batch): {batch_seconds:.3f} s ({legacy_seconds / batch_seconds:.2f}x)")
+
+
+if __name__ == '__main__':
+    main()
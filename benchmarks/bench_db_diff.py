@@ -0,0 +1,117 @@
+"""
+Benchmark of the database diff step against a local MongoDB with a large synthetic collection. The next run is
+simulated as the stored chunks minus 1% (stale) plus 1% of new chunks, and synchronised with:
+  - the previous insert_df_into_db ('distinct' of every hash_id, insert_many and a '$nin' sweep per source)
+  - DocumentSync in 'diff' mode, without and with the indexes provisioned by ensure_indexes
+  - DocumentSync in 'upsert' mode, with the indexes
+The collection is rebuilt before each strategy, and all of them must leave the same documents.
+
+Usage: python -m benchmarks.bench_db_diff [--uri mongodb://localhost:27017] [--documents 200000]
+"""
+import argparse
+import sys
+import time
+
+from pymongo import MongoClient, errors as pymongo_errors
+
+from src.utils import db_sync
+from src.utils.chunk_record import ChunkRecord
+from src.utils.db_sync import DocumentSync, ensure_indexes
+from src.utils.general_functions import calculate_hash
+
+SOURCES = ('Airzone Support', 'Airzone FAQs', 'Airzone Downloads')
+
+
+def create_chunks(start: int, stop: int) -> list:
+    return [ChunkRecord.create(calculate_hash(f"chunk {i}"), SOURCES[i % len(SOURCES)], f"Documento {i // 10}",
+                               f"Chunk {i}: instrucciones de instalación del termostato Airzone Blueface Zero " * 4)
+            for i in range(start, stop)]
+
+
+def legacy_sync(collection, chunks: list) -> dict:
+    """
+    Previous diff step, run once per source (it only swept the source of its first row).
+    """
+    stats = {'inserted': 0, 'deleted': 0, 'unchanged': 0}
+    for source in SOURCES:
+        documents = list({chunk.hash_id: chunk.to_document() for chunk in chunks if chunk.source == source}.values())
+        db_hash_ids = set(collection.distinct('hash_id'))
+        documents_to_insert = [document for document in documents if document['hash_id'] not in db_hash_ids]
+        if documents_to_insert:
+            collection.insert_many(documents_to_insert)
+        rows_to_remove = collection.find(
+            {'source': source, 'hash_id': {'$nin': [document['hash_id'] for document in documents]}})
+        for row in rows_to_remove:
+            collection.delete_one({'_id': row['_id']})
+            stats['deleted'] += 1
+        stats['inserted'] += len(documents_to_insert)
+        stats['unchanged'] += len(documents) - len(documents_to_insert)
+    return stats
+
+
+def document_sync(write_mode: str):
+    def sync(collection, chunks: list) -> dict:
+        synchronisation = DocumentSync(collection, write_mode=write_mode)
+        synchronisation.add_many(chunks)
+        return synchronisation.finish()
+    return sync
+
+
+def rebuild_collection(db, stored_chunks: list, indexed: bool):
+    db.drop_collection('support')
+    # Each strategy provisions its indexes on a fresh collection
+    db_sync._indexed_collections.clear()
+    collection = db['support']
+    if indexed:
+        ensure_indexes(db, ['support'])
+    for i in range(0, len(stored_chunks), 10000):
+        collection.insert_many([chunk.to_document() for chunk in stored_chunks[i:i + 10000]])
+    return collection
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--uri', default='mongodb://localhost:27017', help='URI of the MongoDB server')
+    parser.add_argument('--database', default='airzone_benchmark', help='database used (it is dropped at the end)')
+    parser.add_argument('--documents', type=int, default=200000, help='documents of the synthetic collection')
+    parser.add_argument('--skip-legacy', action='store_true', help='do not run the previous diff step (slow)')
+    args = parser.parse_args()
+
+    client = MongoClient(args.uri, serverSelectionTimeoutMS=2000)
+    try:
+        client.admin.command('ping')
+    except pymongo_errors.PyMongoError as e:
+        print(f"A MongoDB server is needed at {args.uri}: {e}")
+        sys.exit(1)
+    db = client[args.database]
+
+    changed = args.documents // 100
+    stored_chunks = create_chunks(0, args.documents)
+    next_chunks = stored_chunks[changed:] + create_chunks(args.documents, args.documents + changed)
+
+    strategies = [('diff, no indexes', document_sync('diff'), False),
+                  ('diff, indexes', document_sync('diff'), True),
+                  ('upsert, indexes', document_sync('upsert'), True)]
+    if not args.skip_legacy:
+        strategies.insert(0, ('previous insert_df_into_db', legacy_sync, False))
+
+    print(f"{args.documents} stored documents, {changed} stale and {changed} new in the next run")
+    expected = None
+    try:
+        for name, sync, indexed in strategies:
+            collection = rebuild_collection(db, stored_chunks, indexed)
+            start = time.perf_counter()
+            stats = sync(collection, next_chunks)
+            seconds = time.perf_counter() - start
+
+            result = {(row['source'], row['hash_id']) for row in collection.find({}, {'_id': 0, 'source': 1,
+                                                                                     'hash_id': 1})}
+            expected = expected or result
+            status = 'OK' if result == expected else 'MISMATCH'
+            print(f"{status:8} {name:28} {seconds:8.2f} s  {stats}")
+    finally:
+        client.drop_database(args.database)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+"""
+Import-time (cold start) benchmark: imports each module of the scraper in a fresh interpreter with '-X importtime' and
+reports the median cumulative import time of the module and which heavy dependencies it loaded. The heavy dependencies
+are also measured on their own, as a reference.
+
+Usage: python -m benchmarks.bench_imports [--repeat 5] [module ...]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+MODULES = ('lambda_function', 'main_scraper', 'src.utils.scraper_orchestrator', 'src.utils.general_functions',
+           'src.utils.db_sync', 'src.websites.airzonecontrol.airzonecontrol_functions',
+           'src.websites.airzonecontrol.general_information_scraper', 'src.websites.support.support_functions',
+           'src.websites.myzone.myzone_products_scraper')
+HEAVY_DEPENDENCIES = ('pandas', 'fitz', 'langchain', 'bs4', 'aiohttp', 'pymongo', 'requests', 'yaml')
+
+
+def import_module(module: str) -> tuple:
+    """
+    Import a module in a fresh interpreter.
+    :param module: module name
+    :return: tuple with the cumulative import time of the module in seconds and the heavy dependencies it loaded
+    """
+    code = (f"import json, sys; import {module}; "
+            f"print(json.dumps([name for name in {HEAVY_DEPENDENCIES!r} if name in sys.modules]))")
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], cwd=ROOT_DIR, capture_output=True,
+                            text=True, check=True)
+    # Each line of the report is 'import time: self [us] | cumulative | imported package', indented by depth
+    cumulative = next(int(line.split('|')[1]) for line in result.stderr.splitlines()
+                      if line.startswith('import time:') and line.split('|')[2].strip() == module)
+    return cumulative / 1e6, json.loads(result.stdout)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=5, help='imports of each module (the median is reported)')
+    parser.add_argument('modules', nargs='*', help='modules to measure (the scraper modules by default)')
+    args = parser.parse_args()
+
+    for module in args.modules or MODULES + HEAVY_DEPENDENCIES:
+        runs = [import_module(module) for _ in range(args.repeat)]
+        seconds = statistics.median(run[0] for run in runs)
+        dependencies = [name for name in runs[0][1] if name != module]
+        print(f"{module:58} {seconds * 1000:8.1f} ms  {', '.join(dependencies) or '-'}")
+
+
+if __name__ == '__main__':
+    main()
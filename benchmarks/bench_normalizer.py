@@ -0,0 +1,270 @@
+"""
+Benchmark of the HTML-to-text normalizer against the code it replaced: the tag walks of the Support sections, the
+Support FAQs, the Myzone product pages and the Myzone footer sections, which built their texts with '+=' and cleaned
+them with chained str.replace calls (or a regular expression). The fragments are taken from the recorded responses in
+benchmarks/fixtures, plus a few edge cases (links, empty and comment nodes, nested whitespace), and the text of each
+fragment must be identical with both implementations. Only the walk and the cleanup are timed: every run gets freshly
+parsed fragments, since the previous Support walk removed nodes from them.
+
+It also compares the whitespace cleanups: the legacy chain of str.replace calls with a single regular expression pass
+that gives the same result, and re.sub(r'\\s+', ' ') with str.split and str.join.
+
+Usage: python -m benchmarks.bench_normalizer [--repeat 20]
+"""
+import argparse
+import glob
+import json
+import os
+import re
+import sys
+import time
+
+from bs4 import BeautifulSoup, NavigableString
+
+from src.utils.html_parsing import parse_product_page_html
+from src.utils.text_normalizer import clean_text
+from src.websites.airzonecontrol.general_information_scraper import FOOTER_NORMALIZER
+from src.websites.myzone.myzone_products_scraper import PRODUCT_NORMALIZER
+from src.websites.support.support_functions import FAQ_NORMALIZER, SECTION_NORMALIZER
+
+FIXTURES_DIR = os.path.join(os.path.dirname(__file__), 'fixtures')
+
+EDGE_CASES = [
+    '<p>Texto   con  espacios .</p>\n<a href="#">Enlace</a><p>Tras el enlace</p><p></p><p>Tras el vacío</p>',
+    'Texto suelto <a href="#">enlace</a><p><a href="#">Primero</a> el enlace</p><h3>Título<br/>Subtítulo</h3>'
+    '<ul><li>Uno</li>\n<li>Dos ( con paréntesis )</li></ul><!-- comentario --><p>Fin</p>.',
+    '<h1>Título</h1><p>Ver <em>manual</em> y <a href="#">web</a> .</p>\n\n<ol>\n<li> A </li><li>B\n\nC</li></ol>'
+    '<p>\n   Línea\n   partida   .  </p>',
+]
+
+
+# Previous implementations, kept verbatim as the reference of the output and the time
+def legacy_support_section(soup) -> str:
+    clean_description = ""
+    excluded_tags = ['a']
+    for tag in soup.contents:
+        if tag.name in excluded_tags:
+            tag.decompose()
+        elif tag.next.name in excluded_tags:
+            tag.next.decompose()
+        elif tag.text == '':
+            tag.decompose()
+        elif isinstance(tag, NavigableString):
+            clean_description += tag.strip()
+        else:
+            list_number = 1
+            for content in tag.contents:
+                if tag.name in ('h2', 'h3', 'h4'):
+                    clean_description += content.text.strip() + ": "
+                elif content.name == 'li':
+                    clean_description += str(list_number) + ") " + content.text.strip() + " "
+                    list_number += 1
+                elif content.name in ('a', 'em'):
+                    clean_description += "\"" + content.text.strip() + "\"" + " "
+                else:
+                    clean_description += content.text.strip() + " "
+    return clean_description.replace(" .", ".").replace("   ", " ").replace("  ", " ").replace("\n", " ").strip()
+
+
+def legacy_support_faq(soup) -> str:
+    final_answer = ""
+    for tag in soup.contents:
+        if tag.name == 'a':
+            final_answer += tag.text.strip()
+        elif tag.name == 'h1' or tag.text == '':
+            continue
+        elif isinstance(tag, NavigableString):
+            final_answer += tag.strip() + " "
+        else:
+            list_number = 1
+            for content in tag.contents:
+                if tag.name in ('h2', 'h3', 'h4'):
+                    final_answer += content.text.strip() + ": "
+                elif content.name == 'li':
+                    final_answer += str(list_number) + ") " + content.text.strip() + " "
+                    list_number += 1
+                elif content.name in ('a', 'em'):
+                    final_answer += "\"" + content.text.strip() + "\"" + " "
+                else:
+                    final_answer += content.text.strip() + " "
+    return final_answer.replace(" .", ".").replace("   ", " ").replace("  ", " ").replace("\n", " ").replace(
+        "( ", "(").strip()
+
+
+def legacy_product(fragment) -> str:
+    final_description = ''
+    for tag in fragment.contents:
+        if tag.name == 'p' or (isinstance(tag, NavigableString) and tag.strip() != ''):
+            final_description += tag.text.strip() + " "
+        elif tag.name == 'ul' or tag.name == 'ol':
+            list_number = 1
+            for li in tag.contents:
+                if li.name == 'li':
+                    final_description += str(list_number) + ") " + li.text.strip() + " "
+                    list_number += 1
+    return final_description.replace(" .", ".").replace("   ", " ").replace("  ", " ").replace("\n", " ").strip()
+
+
+def legacy_footer(section) -> tuple:
+    description = ''
+    section_name = None
+    for tag in section.contents:
+        if tag.name == 'h5':
+            section_name = tag.text.strip().capitalize()
+        elif tag.name == 'p':
+            description += tag.text.strip() + " "
+        elif tag.name == 'ul' or tag.name == 'ol':
+            list_number = 1
+            for li in tag.contents:
+                if li.name == 'li':
+                    description += str(list_number) + ") " + li.text.strip() + " "
+                    list_number += 1
+    return section_name, re.sub(r'\s+', ' ', description).strip()
+
+
+# Single regular expression pass with the same result as the legacy chain of str.replace calls: each run of spaces and
+# line breaks (with the opening parenthesis before it and the dot after it) is rewritten at once
+LEGACY_CLEANUP_PATTERN = re.compile(r'\(?(?:[ \n]{2,}|\n)\.?| \.|\( \.?')
+
+
+def rewrite_run(match) -> str:
+    run = match.group()
+    prefix = '(' if run[0] == '(' else ''
+    suffix = '.' if run[-1] == '.' else ''
+    segments = run[len(prefix):len(run) - len(suffix)].split('\n')
+    if suffix and segments[-1]:
+        segments[-1] = segments[-1][:-1]
+    # Replacing the triple and then the double spaces turns n spaces into m = n // 3 + n % 3, and then m // 2 + m % 2
+    lengths = [len(segment) // 3 + len(segment) % 3 for segment in segments]
+    text = ' '.join(' ' * (length // 2 + length % 2) for length in lengths)
+    if prefix and text.startswith(' '):
+        text = text[1:]
+    return prefix + text + suffix
+
+
+def regex_cleanup(text: str) -> str:
+    return LEGACY_CLEANUP_PATTERN.sub(rewrite_run, text).strip()
+
+
+def load_fragments() -> dict:
+    """
+    Get the HTML fragments of each source from the fixtures.
+    :return: dictionary with the list of HTML fragments of each source
+    """
+    fragments = {'support_section': [], 'support_faq': [], 'product': [], 'footer': []}
+    for path in sorted(glob.glob(os.path.join(FIXTURES_DIR, 'airzone_api', 'section_*.json'))):
+        with open(path, 'r', encoding='utf-8') as fixture_file:
+            section = json.load(fixture_file)['body']['digital_section']
+        fragments['support_section'] += [content['description'] for unit in section['digital_subsections']
+                                         for content in unit['digital_contents']]
+    for path in sorted(glob.glob(os.path.join(FIXTURES_DIR, 'airzone_api', 'faqs_*.json'))):
+        with open(path, 'r', encoding='utf-8') as fixture_file:
+            fragments['support_faq'] += [faq['answer'] for faq in json.load(fixture_file)['body']['faqs']['data']]
+    for path in sorted(glob.glob(os.path.join(FIXTURES_DIR, 'myzone', 'product_*.html'))):
+        with open(path, 'r', encoding='utf-8') as fixture_file:
+            soup = parse_product_page_html(fixture_file.read().replace('\n', ''), partial=False)
+        fragments['product'].append(str(soup.find('div', itemprop='description')))
+        fragments['product'] += [str(answer) for answer in soup.select('div[class="m-b-lg"]')]
+    for path in sorted(glob.glob(os.path.join(FIXTURES_DIR, 'myzone', 'footer_*.html'))):
+        with open(path, 'r', encoding='utf-8') as fixture_file:
+            soup = BeautifulSoup(fixture_file.read(), 'html.parser')
+        fragments['footer'] += [str(section) for section in soup.select('div.col-md-10 > div.row')]
+
+    for name in ('support_section', 'support_faq'):
+        fragments[name] += EDGE_CASES
+    # The product answers and the footer sections are walked from their root tag
+    fragments['product'] += [f'<div class="m-b-lg">{html}</div>' for html in EDGE_CASES]
+    fragments['footer'] += [f'<div class="row"><h5>sección</h5>{html}</div>' for html in EDGE_CASES]
+    return fragments
+
+
+def parse_fragment(name: str, html: str):
+    soup = BeautifulSoup(html, 'html.parser')
+    return soup if name.startswith('support') else soup.contents[0]
+
+
+def run_legacy(function, root):
+    try:
+        return function(root)
+    except AttributeError:
+        # The previous Support walk failed on a string at the end of a fragment
+        return None
+
+
+IMPLEMENTATIONS = {
+    'support_section': (legacy_support_section, SECTION_NORMALIZER.normalize),
+    'support_faq': (legacy_support_faq, FAQ_NORMALIZER.normalize),
+    'product': (legacy_product, PRODUCT_NORMALIZER.normalize),
+    'footer': (legacy_footer, FOOTER_NORMALIZER.normalize_section),
+}
+
+
+def measure(function, name: str, fragments: list, repeat: int) -> tuple:
+    """
+    Measure the walk and cleanup time of a list of fragments, parsing them again before each run.
+    :param function: walk and cleanup function
+    :param name: source of the fragments
+    :param fragments: HTML fragments
+    :param repeat: number of runs
+    :return: tuple with the seconds per run and the texts of the last run
+    """
+    seconds = 0
+    texts = None
+    for _ in range(repeat):
+        roots = [parse_fragment(name, html) for html in fragments]
+        start = time.perf_counter()
+        texts = [run_legacy(function, root) for root in roots]
+        seconds += time.perf_counter() - start
+    return seconds / repeat, texts
+
+
+def measure_cleanup(function, texts: list, repeat: int) -> float:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for text in texts:
+            function(text)
+    return (time.perf_counter() - start) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=20, help='runs of each implementation')
+    args = parser.parse_args()
+
+    fragments = load_fragments()
+    mismatches = 0
+    print(f"{'source':16} {'fragments':>9} {'previous ms':>12} {'normalizer ms':>14} {'speed-up':>9}  output")
+    for name, (legacy_function, function) in IMPLEMENTATIONS.items():
+        legacy_seconds, expected = measure(legacy_function, name, fragments[name], args.repeat)
+        seconds, texts = measure(function, name, fragments[name], args.repeat)
+        # The fragments the previous walk could not convert are left out of the comparison
+        differences = sum(1 for text, expected_text in zip(texts, expected)
+                          if expected_text is not None and text != expected_text)
+        mismatches += differences
+        print(f"{name:16} {len(fragments[name]):9} {legacy_seconds * 1000:12.3f} {seconds * 1000:14.3f} "
+              f"{legacy_seconds / seconds:8.2f}x  {'OK' if not differences else f'{differences} MISMATCHES'}")
+
+    # The cleanups are compared on the raw texts of the Support sections and FAQs, before any cleaning
+    raw_texts = [BeautifulSoup(html, 'html.parser').get_text(' ') + ' .  (  x \n .'
+                 for name in ('support_section', 'support_faq') for html in fragments[name]]
+    raw_texts *= 10
+    cleanups = {
+        'legacy chain of str.replace': lambda text: clean_text(text, fix_parentheses=True),
+        'single regular expression pass': regex_cleanup,
+        "re.sub(r'\\s+', ' ')": lambda text: re.sub(r'\s+', ' ', text).strip(),
+        'str.split and str.join': lambda text: clean_text(text, 'collapse'),
+    }
+    if any(clean_text(text, fix_parentheses=True) != regex_cleanup(text) for text in raw_texts) or \
+            any(re.sub(r'\s+', ' ', text).strip() != clean_text(text, 'collapse') for text in raw_texts):
+        print("The cleanups give different texts")
+        mismatches += 1
+    print(f"\n{'cleanup of ' + str(len(raw_texts)) + ' texts':32} {'ms':>9}")
+    for name, function in cleanups.items():
+        print(f"{name:32} {measure_cleanup(function, raw_texts, args.repeat) * 1000:9.3f}")
+
+    if mismatches:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
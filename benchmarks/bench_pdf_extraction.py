@@ -0,0 +1,81 @@
+"""
+Benchmark of the PDF text extraction stage: the previous path (thread pool writing each PDF to a temporary file) against
+the in-memory extraction in a process pool sized to the available cores.
+
+Usage: python -m benchmarks.bench_pdf_extraction [--pdfs 40] [--pages 30]
+"""
+import argparse
+import concurrent.futures
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import fitz
+
+from src.utils.general_functions import PDF_EXTRACTION_WORKERS, create_pdf_extraction_executor, \
+    extract_text_from_pdf_bytes
+
+
+def create_synthetic_pdf(n_pages: int) -> bytes:
+    """
+    Create a PDF with a few paragraphs of text in each page.
+    :param n_pages: number of pages
+    :return: content of the PDF
+    """
+    document = fitz.open()
+    for page_number in range(n_pages):
+        page = document.new_page()
+        text = '\n'.join(f"Página {page_number}, línea {line}: instrucciones de instalación del termostato Airzone "
+                         f"Blueface Zero y configuración del sistema de zonificación." for line in range(45))
+        page.insert_textbox(fitz.Rect(36, 36, 576, 806), text, fontsize=8)
+    content = document.tobytes()
+    document.close()
+    return content
+
+
+def legacy_extract_text(content: bytes) -> str:
+    """
+    Previous extraction path: write the PDF to a temporary file and open it from disk.
+    :param content: content of the PDF
+    :return: extracted text
+    """
+    with tempfile.NamedTemporaryFile(delete=False) as temp_file:
+        temp_file.write(content)
+        temp_file_path = temp_file.name
+    try:
+        with fitz.open(temp_file_path) as pdf_document:
+            text = ""
+            for page_number in range(len(pdf_document)):
+                page = pdf_document.load_page(page_number)
+                text += page.get_text()
+        return text
+    finally:
+        os.remove(temp_file_path)
+
+
+def run(executor, function, contents) -> tuple:
+    start = time.perf_counter()
+    with executor:
+        texts = [future.result() for future in [executor.submit(function, content) for content in contents]]
+    return time.perf_counter() - start, texts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--pdfs', type=int, default=40, help='number of synthetic PDFs')
+    parser.add_argument('--pages', type=int, default=30, help='pages per PDF')
+    args = parser.parse_args()
+
+    contents = [create_synthetic_pdf(args.pages)] * args.pdfs
+    legacy_seconds, legacy_texts = run(ThreadPoolExecutor(), legacy_extract_text, contents)
+    engine_seconds, engine_texts = run(create_pdf_extraction_executor(), extract_text_from_pdf_bytes, contents)
+
+    assert legacy_texts == engine_texts, "The extraction engine output differs from the previous path"
+    print(f"{args.pdfs} PDFs x {args.pages} pages, {PDF_EXTRACTION_WORKERS} extraction workers")
+    print(f"Thread pool + temporary files: {legacy_seconds:.2f} s")
+    print(f"In-memory extraction engine:   {engine_seconds:.2f} s ({legacy_seconds / engine_seconds:.2f}x)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,229 @@
+"""
+Offline benchmark suite of the scraper entry points (support_scraper, academia_scraper, partner_scraper,
+general_information_scraper and airzone_products_scraper). Each scraper runs against the recorded API, HTML and PDF
+fixtures in benchmarks/fixtures and an in-memory MongoDB stand-in, with no network access, and the suite reports:
+  - the throughput (chunks written per second) and the median wall-clock time of the scraper
+  - the latency of the fetch stage (each replayed request) and of the database stage (each database operation)
+  - the peak memory allocated while the scraper runs (a separate run, traced with tracemalloc)
+The results are compared to a stored baseline: a scraper whose time or peak memory exceeds the baseline by more than
+the tolerance, whose output (number and hash_ids of the chunks) differs, or that logs an error fails the run.
+
+The caches and the source manifest are disabled, so every run does all the work, and the CPU-bound stages run in thread
+pools, as in AWS Lambda, so their memory is traced too. The baseline is machine-specific: record it again with
+--update-baseline on the machine that runs the suite after a deliberate change.
+
+Usage: python -m benchmarks.bench_scrapers [--repeat 5] [--latency-ms 0] [--update-baseline] [scraper ...]
+"""
+import os
+
+# The settings are read when the modules are imported, so they are set first
+os.environ.update({'HTTP_CACHE_ENABLED': 'false', 'PDF_CACHE_ENABLED': 'false', 'SOURCE_MANIFEST_ENABLED': 'false'})
+os.environ.setdefault('DEPLOYMENT_OPTION', 'LAMBDA')
+
+import argparse
+import hashlib
+import json
+import logging
+import statistics
+import sys
+import time
+import tracemalloc
+
+from benchmarks.mongo_stand_in import InMemoryDatabase
+from benchmarks.replay import FixtureRoutes, replay_network
+from src.utils.scraper_orchestrator import SCRAPER_TASKS
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), 'baselines', 'bench_scrapers.json')
+# Absolute slack added to the tolerances, so the noise of the fastest scrapers is not reported as a regression
+TIME_SLACK_SECONDS = 0.01
+MEMORY_SLACK_MIB = 1
+
+
+class ErrorCounter(logging.Handler):
+    """
+    Logging handler that counts the errors logged by the scrapers, which catch and log their exceptions.
+    """
+
+    def __init__(self):
+        super().__init__(level=logging.ERROR)
+        self.errors = []
+
+    def emit(self, record):
+        self.errors.append(record.getMessage())
+
+
+def percentile(values: list, fraction: float) -> float:
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(int(fraction * len(values)), len(values) - 1)]
+
+
+def summarise_latencies(durations: list) -> dict:
+    return {'count': len(durations), 'total_ms': round(sum(durations) * 1000, 2),
+            'p50_ms': round(percentile(durations, 0.5) * 1000, 3), 'p95_ms': round(percentile(durations, 0.95) * 1000, 3)}
+
+
+def get_output(db: InMemoryDatabase, collections) -> tuple:
+    """
+    Get the number of chunks written by a scraper and the digest of their source and hash_id.
+    :param db: in-memory database
+    :param collections: collections written by the scraper
+    :return: tuple with the number of chunks and their digest
+    """
+    keys = sorted((name, *key) for name in collections for key in db[name].documents)
+    return len(keys), hashlib.sha256(json.dumps(keys).encode('utf-8')).hexdigest()
+
+
+def run_once(task, session, routes: FixtureRoutes, trace_memory: bool = False) -> dict:
+    """
+    Run a scraper against a new in-memory database.
+    :param task: scraper task
+    :param session: requests session served from the fixtures
+    :param routes: recorded responses
+    :param trace_memory: measure the peak memory of the run with tracemalloc (which slows it down)
+    :return: dictionary with the results of the run
+    """
+    db = InMemoryDatabase()
+    routes.reset()
+    error_counter = ErrorCounter()
+    logging.getLogger().addHandler(error_counter)
+    if trace_memory:
+        tracemalloc.start()
+    try:
+        start = time.perf_counter()
+        task.function(session, db)
+        seconds = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1] if trace_memory else None
+    finally:
+        if trace_memory:
+            tracemalloc.stop()
+        logging.getLogger().removeHandler(error_counter)
+
+    chunks, digest = get_output(db, task.collections)
+    return {'seconds': seconds, 'chunks': chunks, 'digest': digest, 'peak_bytes': peak,
+            'fetch': routes.reset(), 'db': db.reset(), 'errors': error_counter.errors}
+
+
+def benchmark_scraper(task, session, routes: FixtureRoutes, repeat: int) -> dict:
+    """
+    Benchmark a scraper: a warm-up run (which imports its modules), the timed runs and a run traced with tracemalloc.
+    :param task: scraper task
+    :param session: requests session served from the fixtures
+    :param routes: recorded responses
+    :param repeat: number of timed runs
+    :return: dictionary with the metrics of the scraper
+    """
+    warm_up = run_once(task, session, routes)
+    runs = [run_once(task, session, routes) for _ in range(repeat)]
+    memory_run = run_once(task, session, routes, trace_memory=True)
+
+    # The run with the median time is reported, so its stage latencies are consistent with its time
+    median_run = sorted(runs, key=lambda run: run['seconds'])[len(runs) // 2]
+    errors = [error for run in [warm_up, *runs, memory_run] for error in run['errors']]
+    outputs = {(run['chunks'], run['digest']) for run in [warm_up, *runs, memory_run]}
+    return {'seconds': round(statistics.median(run['seconds'] for run in runs), 4),
+            'chunks': median_run['chunks'], 'digest': median_run['digest'],
+            'chunks_per_second': round(median_run['chunks'] / statistics.median(run['seconds'] for run in runs), 1),
+            'peak_mib': round(memory_run['peak_bytes'] / 2 ** 20, 2),
+            'fetch': summarise_latencies(median_run['fetch']), 'db': summarise_latencies(median_run['db']),
+            'deterministic': len(outputs) == 1, 'errors': errors}
+
+
+def compare_to_baseline(name: str, result: dict, baseline: dict, time_tolerance: float,
+                        memory_tolerance: float) -> list:
+    """
+    Compare the metrics of a scraper to its baseline.
+    :param name: scraper name
+    :param result: metrics of the scraper
+    :param baseline: metrics of the scraper in the baseline (None if it has no baseline)
+    :param time_tolerance: fraction of the baseline time a scraper can exceed it by
+    :param memory_tolerance: fraction of the baseline peak memory a scraper can exceed it by
+    :return: list of failures
+    """
+    failures = [f"{name}: {error}" for error in result['errors']]
+    if not result['deterministic']:
+        failures.append(f"{name}: the output differs between runs")
+    if baseline is None:
+        return failures
+
+    if (result['chunks'], result['digest']) != (baseline['chunks'], baseline['digest']):
+        failures.append(f"{name}: the output changed ({result['chunks']} chunks, {baseline['chunks']} in the baseline)")
+    if result['seconds'] > baseline['seconds'] * (1 + time_tolerance) + TIME_SLACK_SECONDS:
+        failures.append(f"{name}: {result['seconds']:.3f} s, {result['seconds'] / baseline['seconds']:.2f}x the "
+                        f"baseline ({baseline['seconds']:.3f} s)")
+    if result['peak_mib'] > baseline['peak_mib'] * (1 + memory_tolerance) + MEMORY_SLACK_MIB:
+        failures.append(f"{name}: {result['peak_mib']:.1f} MiB of peak memory, {result['peak_mib'] / baseline['peak_mib']:.2f}x "
+                        f"the baseline ({baseline['peak_mib']:.1f} MiB)")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('scrapers', nargs='*', help='scrapers to run (all of them by default)')
+    parser.add_argument('--repeat', type=int, default=5, help='timed runs of each scraper')
+    parser.add_argument('--latency-ms', type=float, default=0, help='latency added to each replayed request')
+    parser.add_argument('--baseline', default=BASELINE_PATH, help='baseline JSON file')
+    parser.add_argument('--update-baseline', action='store_true', help='store the results as the new baseline')
+    parser.add_argument('--time-tolerance', type=float, default=0.3, help='allowed slowdown over the baseline')
+    parser.add_argument('--memory-tolerance', type=float, default=0.2, help='allowed peak memory over the baseline')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--verbose', action='store_true', help='show the logs of the scrapers')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.CRITICAL)
+    tasks = [task for task in SCRAPER_TASKS if not args.scrapers or task.name in args.scrapers]
+    if not tasks:
+        parser.error(f"Unknown scrapers, choose from {[task.name for task in SCRAPER_TASKS]}")
+
+    routes = FixtureRoutes(latency=args.latency_ms / 1000)
+    results = {}
+    with replay_network(routes) as session:
+        for task in tasks:
+            results[task.name] = benchmark_scraper(task, session, routes, args.repeat)
+
+    print(f"{'scraper':20} {'seconds':>8} {'chunks':>7} {'chunks/s':>9} {'peak MiB':>9}   {'fetch (n, p50, p95 ms)':24}"
+          f" {'db (n, p50, p95 ms)':24}")
+    for name, result in results.items():
+        fetch, db = result['fetch'], result['db']
+        print(f"{name:20} {result['seconds']:8.3f} {result['chunks']:7} {result['chunks_per_second']:9.1f} "
+              f"{result['peak_mib']:9.2f}   {fetch['count']:5} {fetch['p50_ms']:8.3f} {fetch['p95_ms']:8.3f}  "
+              f"{db['count']:5} {db['p50_ms']:8.3f} {db['p95_ms']:8.3f}")
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent=2)
+
+    if args.update_baseline:
+        baseline = {'python': sys.version.split()[0], 'repeat': args.repeat, 'latency_ms': args.latency_ms,
+                    'scrapers': {name: {key: result[key] for key in ('seconds', 'chunks', 'digest', 'peak_mib')}
+                                 for name, result in results.items()}}
+        os.makedirs(os.path.dirname(args.baseline), exist_ok=True)
+        with open(args.baseline, 'w') as baseline_file:
+            json.dump(baseline, baseline_file, indent=2)
+            baseline_file.write('\n')
+        print(f"Baseline written to {args.baseline}")
+        return
+
+    try:
+        with open(args.baseline, 'r') as baseline_file:
+            baseline = json.load(baseline_file)
+    except FileNotFoundError:
+        print(f"There is no baseline at {args.baseline}, record one with --update-baseline")
+        baseline = {'scrapers': {}}
+    if baseline.get('latency_ms', args.latency_ms) != args.latency_ms:
+        print(f"Warning: the baseline was recorded with --latency-ms {baseline['latency_ms']}")
+
+    failures = [failure for name, result in results.items()
+                for failure in compare_to_baseline(name, result, baseline['scrapers'].get(name),
+                                                   args.time_tolerance, args.memory_tolerance)]
+    if failures:
+        print("FAILED:")
+        for failure in failures:
+            print(f"  {failure}")
+        sys.exit(1)
+    print("OK: no regressions against the baseline")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,193 @@
+"""
+Benchmark of the vector index on synthetic embedded chunks (clustered unit vectors of the dimensions of the embedding
+model, stored in the in-memory database stand-in). It measures:
+  - the full build of the index from the database and its incremental update after a run that removes and adds 1% of
+    the chunks, whose search results must be identical to those of an index built from scratch
+  - the time to load the persisted index (memory-mapped) against reading every vector from the database
+  - the latency of single queries (p50 and p95) and the throughput of batched queries, in 'exact' mode and in 'ivfpq'
+    mode with several numbers of probed lists, and the recall@k of 'ivfpq' against the exact results
+
+The queries are perturbed copies of stored vectors, like questions close to a chunk.
+
+Usage: python -m benchmarks.bench_vector_index [--vectors 100000] [--queries 200] [--k 10]
+"""
+import argparse
+import hashlib
+import statistics
+import sys
+import tempfile
+import time
+
+import numpy as np
+from pymongo import InsertOne
+
+from benchmarks.mongo_stand_in import InMemoryDatabase
+from src.utils.embeddings import EMBEDDING_BACKEND, load_embedding_backend
+from src.utils.vector_index import VectorIndex, update_vector_index
+
+COLLECTIONS = ('support', 'product', 'academia', 'general_information')
+SOURCES = ('Airzone Support', 'Airzone FAQs', 'Airzone Downloads')
+PROBES = (1, 4, 8, 16, 32)
+
+
+def create_documents(start: int, stop: int, centers: np.ndarray, model_id: str, seed: int) -> list:
+    """
+    Create synthetic embedded chunks: each vector is a topic center plus noise, normalised to unit length.
+    :param start: number of the first chunk
+    :param stop: number after the last chunk
+    :param centers: 2D array with the center of each topic
+    :param model_id: embedding model of the vectors
+    :param seed: seed of the noise
+    :return: list of document dicts
+    """
+    rng = np.random.default_rng(seed)
+    topics = rng.integers(0, len(centers), stop - start)
+    # The noise has about the norm of the centers, so the chunks of a topic are similar but not identical
+    vectors = centers[topics] + rng.standard_normal((stop - start, centers.shape[1])) / np.sqrt(centers.shape[1])
+    vectors = (vectors / np.linalg.norm(vectors, axis=1, keepdims=True)).astype(np.float32)
+    return [{'hash_id': hashlib.sha256(f"chunk {number}".encode('utf-8')).hexdigest(),
+             'source': SOURCES[number % len(SOURCES)], 'title': f"Documento {number // 10}",
+             'description': f"Chunk {number}", 'embedding': vector.tobytes(), 'embedding_model': model_id,
+             'collection': COLLECTIONS[number % len(COLLECTIONS)]}
+            for number, vector in zip(range(start, stop), vectors)]
+
+
+def store_documents(db, documents: list) -> None:
+    for collection_name in COLLECTIONS:
+        operations = [InsertOne({key: value for key, value in document.items() if key != 'collection'})
+                      for document in documents if document['collection'] == collection_name]
+        if operations:
+            db[collection_name].bulk_write(operations, ordered=False)
+
+
+def remove_documents(db, documents: list) -> None:
+    for collection_name in COLLECTIONS:
+        db[collection_name].delete_many({'hash_id': {'$in': [document['hash_id'] for document in documents
+                                                             if document['collection'] == collection_name]}})
+
+
+def run_changes(added: list, removed: list) -> dict:
+    # The keys recorded by the DocumentSyncs of a run (see record_vector_changes)
+    changes = {}
+    for name, documents in (('added', added), ('removed', removed)):
+        for document in documents:
+            changes.setdefault(document['collection'], {'added': set(), 'removed': set()})[name].add(
+                (document['source'], document['hash_id']))
+    return changes
+
+
+def timed(function, *args) -> tuple:
+    start = time.perf_counter()
+    result = function(*args)
+    return time.perf_counter() - start, result
+
+
+def read_all_vectors(db) -> np.ndarray:
+    # What a process without the persisted index would do: read every vector from the database
+    vectors = [row['embedding'] for collection_name in COLLECTIONS
+               for row in db[collection_name].find({}, {'_id': 0, 'source': 1, 'hash_id': 1, 'embedding': 1})]
+    return np.frombuffer(b''.join(vectors), dtype=np.float32)
+
+
+def load_and_query(directory: str, query: np.ndarray, k: int) -> VectorIndex:
+    # Time until a new process answers its first query
+    index = VectorIndex.load(directory)
+    index.search(query, k)
+    return index
+
+
+def result_keys(results: list) -> list:
+    return [[(result.collection, result.hash_id) for result in query_results] for query_results in results]
+
+
+def measure_queries(index: VectorIndex, queries: np.ndarray, k: int, **kwargs) -> tuple:
+    """
+    Measure the latency of single queries and the time per query of a batch of queries.
+    :param index: VectorIndex object
+    :param queries: 2D array of queries
+    :param k: number of results of each query
+    :return: tuple with the p50 and p95 latencies and the batched time per query, in milliseconds, and the results
+    """
+    latencies = []
+    results = []
+    for query in queries:
+        seconds, query_results = timed(lambda: index.search(query, k, **kwargs))
+        latencies.append(seconds * 1000)
+        results += query_results
+    batch_seconds, _ = timed(lambda: index.search(queries, k, **kwargs))
+    p95 = statistics.quantiles(latencies, n=20)[-1] if len(latencies) > 1 else latencies[0]
+    return statistics.median(latencies), p95, batch_seconds * 1000 / len(queries), results
+
+
+def recall(results: list, expected: list) -> float:
+    return statistics.mean(len(set(keys) & set(expected_keys)) / max(len(expected_keys), 1)
+                           for keys, expected_keys in zip(result_keys(results), result_keys(expected)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--vectors', type=int, default=100000, help='embedded chunks of the synthetic corpus')
+    parser.add_argument('--queries', type=int, default=200, help='queries of the latency and recall measures')
+    parser.add_argument('--k', type=int, default=10, help='results of each query')
+    parser.add_argument('--topics', type=int, default=500, help='topic centers of the synthetic vectors')
+    args = parser.parse_args()
+
+    backend = load_embedding_backend(EMBEDDING_BACKEND)
+    dimensions = len(backend.embed(['dimensions'])[0])
+    rng = np.random.default_rng(0)
+    centers = rng.standard_normal((args.topics, dimensions)) / np.sqrt(dimensions)
+    documents = create_documents(0, args.vectors, centers, backend.model_id, seed=1)
+    changed = max(1, args.vectors // 100)
+    print(f"{args.vectors} chunks of {dimensions} dimensions ({backend.model_id}), {changed} removed and {changed} "
+          f"added in the next run, {args.queries} queries, k={args.k}")
+
+    failures = []
+    stored_vectors = np.stack([np.frombuffer(document['embedding'], dtype=np.float32)
+                               for document in documents[changed:]])
+    queries = stored_vectors[rng.choice(len(stored_vectors), args.queries, replace=False)]
+    queries = queries + 0.3 * rng.standard_normal(queries.shape).astype(np.float32) / np.sqrt(dimensions)
+
+    print(f"\n{'mode':8} {'build s':>8} {'update s':>9} {'rebuild s':>10} {'load ms':>8} {'read db ms':>11}")
+    indexes = {}
+    for mode in ('exact', 'ivfpq'):
+        db = InMemoryDatabase()
+        store_documents(db, documents)
+        directory = tempfile.mkdtemp(prefix=f"vector_index_{mode}_")
+        build_seconds, _ = timed(update_vector_index, db, directory, COLLECTIONS, mode)
+
+        # Next run: 1% of the chunks are removed and 1% are added, and the index is updated with the changes of the run
+        new_documents = create_documents(args.vectors, args.vectors + changed, centers, backend.model_id, seed=2)
+        remove_documents(db, documents[:changed])
+        store_documents(db, new_documents)
+        update_seconds, stats = timed(lambda: update_vector_index(
+            db, directory, COLLECTIONS, mode, changes=run_changes(new_documents, documents[:changed])))
+        if stats != {'added': changed, 'removed': changed, 'indexed': args.vectors}:
+            failures.append(f"{mode}: the incremental update gave {stats}")
+
+        rebuild_directory = tempfile.mkdtemp(prefix=f"vector_index_{mode}_rebuild_")
+        rebuild_seconds, _ = timed(update_vector_index, db, rebuild_directory, COLLECTIONS, mode)
+        load_seconds, index = timed(load_and_query, directory, queries[0], args.k)
+        read_seconds, _ = timed(read_all_vectors, db)
+        if mode == 'exact' and result_keys(index.search(queries, args.k)) != \
+                result_keys(VectorIndex.load(rebuild_directory).search(queries, args.k)):
+            failures.append("exact: the updated index and the rebuilt index give different results")
+        indexes[mode] = index
+        print(f"{mode:8} {build_seconds:8.2f} {update_seconds:9.2f} {rebuild_seconds:10.2f} "
+              f"{load_seconds * 1000:8.1f} {read_seconds * 1000:11.1f}")
+
+    print(f"\n{'search':16} {'p50 ms':>8} {'p95 ms':>8} {'batched ms/query':>17} {'recall@' + str(args.k):>10}")
+    p50, p95, batched, expected = measure_queries(indexes['exact'], queries, args.k)
+    print(f"{'exact':16} {p50:8.3f} {p95:8.3f} {batched:17.3f} {1:10.3f}")
+    for probes in PROBES:
+        p50, p95, batched, results = measure_queries(indexes['ivfpq'], queries, args.k, probes=probes)
+        print(f"{'ivfpq, ' + str(probes) + ' probes':16} {p50:8.3f} {p95:8.3f} {batched:17.3f} "
+              f"{recall(results, expected):10.3f}")
+
+    if failures:
+        print("FAILED:\n  " + "\n  ".join(failures))
+        sys.exit(1)
+    print("OK: the incremental updates match the rebuilt index")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,141 @@
+"""
+Regression check of the removal of the near-duplicate documents at the end of a run, against the in-memory MongoDB
+stand-in: the copy of a near-duplicate stored by a previous run (or written before it was demoted) is only removed if
+the document of its canonical chunk is confirmed in the database, and the chunks stored by a source skipped by the
+source manifest take part in the choice of the canonical chunks without being removed.
+
+Usage: python -m benchmarks.check_near_duplicates
+"""
+import os
+
+# The settings are read when the modules are imported, so they are set first
+os.environ.update({'EMBEDDINGS_ENABLED': 'false', 'SOURCE_MANIFEST_ENABLED': 'true'})
+
+import sys
+
+from pymongo import InsertOne, errors as pymongo_errors
+
+from benchmarks.mongo_stand_in import InMemoryDatabase
+from src.utils.chunk_record import ChunkRecord
+from src.utils.db_sync import DocumentSync, insert_records_into_db
+from src.utils.near_duplicates import finish_near_duplicates_run, start_near_duplicates_run
+from src.utils.source_manifest import is_source_unchanged, record_source_digest, start_manifest_run
+
+TEXT = ("The thermostat shows the temperature of the zone and lets the user change the setpoint, the operating mode and "
+        "the fan speed of the installation from the main screen")
+# Near-duplicate of TEXT: one word of thirty changes
+NEAR_DUPLICATE_TEXT = TEXT.replace('main screen', 'home screen')
+
+# The canonical chunk of a group is the one with the smallest collection, source and hash_id
+CANONICAL = ChunkRecord('a' * 64, '2024-01-01 00:00:00', 'Academia', 'Thermostat', TEXT)
+DUPLICATE = ChunkRecord('b' * 64, '2024-01-01 00:00:00', 'Airzone Support', 'Thermostat', NEAR_DUPLICATE_TEXT)
+
+
+def store(db, collection_name: str, record: ChunkRecord) -> None:
+    # Document stored by a previous run
+    db[collection_name].bulk_write([InsertOne(record.to_document())], ordered=False)
+
+
+def find(db, collection_name: str, record: ChunkRecord) -> dict:
+    return db[collection_name].find_one({'source': record.source, 'hash_id': record.hash_id})
+
+
+def is_stored(db, collection_name: str, record: ChunkRecord) -> bool:
+    return find(db, collection_name, record) is not None
+
+
+def fail_writes(collection) -> None:
+    def bulk_write(operations, ordered=True):
+        raise pymongo_errors.AutoReconnect('connection lost')
+    collection.bulk_write = bulk_write
+
+
+def sync(db, collection_name: str, record: ChunkRecord, discarded: bool = False) -> None:
+    document_sync = DocumentSync(db[collection_name])
+    document_sync.add(record)
+    if discarded:
+        document_sync.discard_source(record.source)
+    document_sync.finish()
+
+
+def check_confirmed_canonical(db) -> bool:
+    # The canonical chunk is written, so the copy of its near-duplicate stored by the previous run is removed
+    store(db, 'support', DUPLICATE)
+    sync(db, 'academia', CANONICAL)
+    sync(db, 'support', DUPLICATE)
+    finish_near_duplicates_run(db)
+    return is_stored(db, 'academia', CANONICAL) and not is_stored(db, 'support', DUPLICATE)
+
+
+def check_discarded_canonical(db) -> bool:
+    # The source of the canonical chunk is discarded (e.g. its scraper failed), so the near-duplicate is kept
+    store(db, 'support', DUPLICATE)
+    sync(db, 'academia', CANONICAL, discarded=True)
+    sync(db, 'support', DUPLICATE)
+    finish_near_duplicates_run(db)
+    return is_stored(db, 'support', DUPLICATE)
+
+
+def check_failed_canonical_write(db) -> bool:
+    # The write of the canonical chunk fails, so the near-duplicate is kept
+    store(db, 'support', DUPLICATE)
+    fail_writes(db['academia'])
+    insert_records_into_db(db['academia'], [CANONICAL])
+    sync(db, 'support', DUPLICATE)
+    finish_near_duplicates_run(db)
+    return not is_stored(db, 'academia', CANONICAL) and is_stored(db, 'support', DUPLICATE)
+
+
+def check_demoted_before_failed_write(db) -> bool:
+    # The near-duplicate is written as canonical and then demoted by a chunk whose write fails, so it is kept
+    sync(db, 'support', DUPLICATE)
+    fail_writes(db['academia'])
+    insert_records_into_db(db['academia'], [CANONICAL])
+    finish_near_duplicates_run(db)
+    return is_stored(db, 'support', DUPLICATE)
+
+
+def check_skipped_canonical(db) -> bool:
+    # The canonical chunk belongs to a source skipped by the manifest: its stored chunk is still the canonical one, so
+    # the near-duplicate is not written and its copy stored by the previous run is removed
+    store(db, 'academia', CANONICAL)
+    store(db, 'support', DUPLICATE)
+    record_source_digest(db['academia'], 'digest')
+    skipped = is_source_unchanged(db['academia'], 'digest')
+    sync(db, 'support', DUPLICATE)
+    finish_near_duplicates_run(db)
+    canonical = find(db, 'academia', CANONICAL)
+    return skipped and canonical is not None and not is_stored(db, 'support', DUPLICATE) and \
+        [duplicate['hash_id'] for duplicate in canonical.get('duplicates', [])] == [DUPLICATE.hash_id]
+
+
+def check_skipped_near_duplicate(db) -> bool:
+    # The near-duplicate belongs to a source skipped by the manifest: it cannot be written again in the run, so its
+    # stored chunk is kept even if a processed chunk precedes it
+    store(db, 'support', DUPLICATE)
+    record_source_digest(db['support'], 'digest')
+    skipped = is_source_unchanged(db['support'], 'digest')
+    sync(db, 'academia', CANONICAL)
+    finish_near_duplicates_run(db)
+    return skipped and is_stored(db, 'academia', CANONICAL) and is_stored(db, 'support', DUPLICATE)
+
+
+CHECKS = [check_confirmed_canonical, check_discarded_canonical, check_failed_canonical_write,
+          check_demoted_before_failed_write, check_skipped_canonical, check_skipped_near_duplicate]
+
+
+def main():
+    failures = 0
+    for check in CHECKS:
+        db = InMemoryDatabase()
+        start_manifest_run()
+        start_near_duplicates_run(enabled=True)
+        passed = check(db)
+        failures += not passed
+        print(f"{'OK' if passed else 'FAILED':8} {check.__name__}")
+
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
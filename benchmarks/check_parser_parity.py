@@ -0,0 +1,69 @@
+"""
+Regression check of the HTML parsing layer against the recorded Myzone pages in benchmarks/fixtures/myzone: the text
+extracted with the selected backend (and partial parsing for the product pages) must be identical to the text extracted
+with a full 'html.parser' parse. It also reports the parsing time of each configuration.
+
+Usage: python -m benchmarks.check_parser_parity [--repeat 50]
+"""
+import argparse
+import glob
+import os
+import sys
+import time
+
+from src.utils.html_parsing import get_parser_backend
+from src.websites.myzone.myzone_products_scraper import parse_product_page, parse_products_index, parse_subunit_page
+
+FIXTURES_DIR = os.path.join(os.path.dirname(__file__), 'fixtures', 'myzone')
+
+
+def read_fixtures(pattern: str) -> dict:
+    fixtures = {}
+    for path in sorted(glob.glob(os.path.join(FIXTURES_DIR, pattern))):
+        with open(path, 'r', encoding='utf-8') as fixture_file:
+            fixtures[os.path.basename(path)] = fixture_file.read()
+    return fixtures
+
+
+def product_texts(product_dict: dict) -> list:
+    # The upload date depends on the time of the parsing, so it is left out of the comparison
+    return [(chunk.source, chunk.title, chunk.description, chunk.hash_id)
+            for chunk in product_dict['products'] + product_dict['faqs']]
+
+
+def measure(function, repeat: int) -> tuple:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = function()
+    return (time.perf_counter() - start) / repeat, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=50, help='parses of each page to measure the time')
+    args = parser.parse_args()
+
+    backend = get_parser_backend()
+    failures = 0
+    checks = [(name, lambda html: parse_products_index(html, backend='html.parser'),
+               lambda html: parse_products_index(html), html) for name, html in read_fixtures('productos*.html').items()]
+    checks += [(name, lambda html: parse_subunit_page(html, backend='html.parser'),
+                lambda html: parse_subunit_page(html), html) for name, html in read_fixtures('subunit_*.html').items()]
+    checks += [(name, lambda html: product_texts(parse_product_page(html, '', '', '', 'Producto', partial=False,
+                                                                    backend='html.parser')),
+                lambda html: product_texts(parse_product_page(html, '', '', '', 'Producto')), html)
+               for name, html in read_fixtures('product_*.html').items()]
+
+    for name, reference_function, function, html in checks:
+        reference_seconds, expected = measure(lambda: reference_function(html), args.repeat)
+        seconds, result = measure(lambda: function(html), args.repeat)
+        status = 'OK' if result == expected else 'MISMATCH'
+        failures += result != expected
+        print(f"{status:8} {name:32} html.parser: {reference_seconds * 1000:.2f} ms, {backend}: "
+              f"{seconds * 1000:.2f} ms ({reference_seconds / seconds:.2f}x)")
+
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
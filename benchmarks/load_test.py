@@ -0,0 +1,67 @@
+"""
+Load test of the scrapers against the local stand-in server of the Airzone API and the Myzone website: the server is
+started in a background thread, the scrapers are pointed to it with AIRZONE_API_URL and MYZONE_URL, and each scraper
+runs against an in-memory MongoDB stand-in for every catalog scale, to measure how the crawlers scale with the size of
+the catalog. The caches and the source manifest are disabled, so every run does all the work.
+
+Usage: python -m benchmarks.load_test [--scale 1 10 100] [--latency-ms 20] [--error-rate 0] [--throttle-rate 0]
+       [scraper ...]
+"""
+import argparse
+import logging
+import os
+import time
+
+from benchmarks.stand_in_server import StandInServer, add_config_arguments, config_from_arguments
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('scrapers', nargs='*', help='scrapers to run (all of them by default)')
+    parser.add_argument('--scale', type=float, nargs='+', default=[1, 10], help="catalog sizes, as multiples of "
+                                                                                "today's catalog")
+    parser.add_argument('--verbose', action='store_true', help='show the logs of the scrapers')
+    add_config_arguments(parser)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.CRITICAL)
+
+    server = StandInServer(config_from_arguments(args, args.scale[0])).start()
+    try:
+        # The settings are read when the scraper modules are imported, so they are set once the server port is known
+        os.environ.update({'AIRZONE_API_URL': server.url, 'MYZONE_URL': server.url, 'HTTP_CACHE_ENABLED': 'false',
+                           'PDF_CACHE_ENABLED': 'false', 'SOURCE_MANIFEST_ENABLED': 'false'})
+        import requests
+
+        from benchmarks.bench_scrapers import ErrorCounter
+        from benchmarks.mongo_stand_in import InMemoryDatabase
+        from src.utils.scraper_orchestrator import SCRAPER_TASKS
+
+        tasks = [task for task in SCRAPER_TASKS if not args.scrapers or task.name in args.scrapers]
+        session = requests.Session()
+
+        print(f"Stand-in server at {server.url}")
+        print(f"{'scale':>6} {'scraper':20} {'seconds':>8} {'chunks':>7} {'chunks/s':>9} {'requests':>9} {'errors':>7}")
+        for scale in args.scale:
+            server.config.scale = scale
+            for task in tasks:
+                db = InMemoryDatabase()
+                requests_before = server.app['stats']['requests']
+                error_counter = ErrorCounter()
+                logging.getLogger().addHandler(error_counter)
+                start = time.perf_counter()
+                try:
+                    task.function(session, db)
+                finally:
+                    seconds = time.perf_counter() - start
+                    logging.getLogger().removeHandler(error_counter)
+
+                chunks = sum(len(db[name].documents) for name in task.collections)
+                print(f"{scale:6g} {task.name:20} {seconds:8.2f} {chunks:7} {chunks / seconds:9.1f} "
+                      f"{server.app['stats']['requests'] - requests_before:9} {len(error_counter.errors):7}")
+        print(f"Server: {server.app['stats']}")
+    finally:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,215 @@
+"""
+In-memory stand-in of the MongoDB database for the offline benchmarks and checks. It implements the subset of the
+pymongo API used by DocumentSync, the near-duplicate index, the source manifest and the vector index (find with
+equality, '$in', '$nin', '$ne' and '$exists' filters, unordered bulk writes, delete_many, update_many with '$unset', and
+find_one_and_update and update_one of a document keyed by its '_id') with the semantics of the indexes provisioned by
+ensure_indexes (a unique 'source' and 'hash_id'), and records the duration of each operation.
+"""
+import threading
+import time
+from types import SimpleNamespace
+
+from pymongo import InsertOne, UpdateOne, errors as pymongo_errors
+
+from src.utils.db_sync import DUPLICATE_KEY_ERROR
+
+
+def compile_query(query: dict) -> dict:
+    """
+    Compile a query with equality, '$in', '$nin', '$ne' and '$exists' conditions into the operator and the operand of
+    each field, where the equalities and '$in' conditions become the set of accepted values.
+    :param query: MongoDB query
+    :return: dictionary with the operator and the operand of each field
+    """
+    conditions = {}
+    for field, condition in (query or {}).items():
+        if not isinstance(condition, dict):
+            condition = {'$in': [condition]}
+        (operator, operand), = condition.items()
+        if operator not in ('$in', '$nin', '$ne', '$exists'):
+            raise NotImplementedError(f"Unsupported operator: {operator}")
+        conditions[field] = (operator, set(operand) if operator in ('$in', '$nin') else operand)
+    return conditions
+
+
+def matches(document: dict, conditions: dict) -> bool:
+    for field, (operator, operand) in conditions.items():
+        if operator == '$in':
+            matched = document.get(field) in operand
+        elif operator == '$nin':
+            matched = document.get(field) not in operand
+        elif operator == '$ne':
+            matched = document.get(field) != operand
+        else:
+            matched = (field in document) == operand
+        if not matched:
+            return False
+    return True
+
+
+def project(document: dict, projection: dict = None) -> dict:
+    if not projection:
+        return dict(document)
+    return {field: document[field] for field, included in projection.items() if included and field in document}
+
+
+class InMemoryCollection:
+    """
+    Collection of the in-memory database, with its documents keyed by their source and hash_id.
+    """
+
+    def __init__(self, database, name: str):
+        self.database = database
+        self.name = name
+        self.documents = {}
+        # Keys of the documents of each 'hash_id' (the unique index on 'source' and 'hash_id')
+        self._keys = {}
+        self._lock = threading.Lock()
+
+    def _timed(self, function):
+        start = time.perf_counter()
+        try:
+            with self._lock:
+                return function()
+        finally:
+            self.database.record(time.perf_counter() - start)
+
+    def create_index(self, keys, **kwargs) -> str:
+        return kwargs.get('name', '_'.join(field for field, _ in keys))
+
+    def _select(self, conditions: dict) -> list:
+        # A 'hash_id' condition is served like the unique index, without scanning the collection
+        if conditions.get('hash_id', ('',))[0] == '$in':
+            candidates = [self.documents[key] for hash_id in conditions['hash_id'][1]
+                          for key in self._keys.get(hash_id, ())]
+        else:
+            candidates = self.documents.values()
+        return [document for document in candidates if matches(document, conditions)]
+
+    def find(self, query: dict = None, projection: dict = None) -> list:
+        conditions = compile_query(query)
+        return self._timed(lambda: [project(document, projection) for document in self._select(conditions)])
+
+    def find_one(self, query: dict = None, projection: dict = None):
+        documents = self.find(query, projection)
+        return documents[0] if documents else None
+
+    def count_documents(self, query: dict) -> int:
+        return len(self.find(query))
+
+    def bulk_write(self, operations: list, ordered: bool = True):
+        def bulk_write():
+            result = {'nInserted': 0, 'nUpserted': 0, 'nModified': 0, 'writeErrors': [], 'upserted': []}
+            for index, operation in enumerate(operations):
+                if isinstance(operation, InsertOne):
+                    document = dict(operation._doc)
+                elif isinstance(operation, UpdateOne) and not operation._upsert:
+                    # E.g. the vectors written by the embedding stage
+                    key = (operation._filter['source'], operation._filter['hash_id'])
+                    if key in self.documents:
+                        self.documents[key].update(operation._doc['$set'])
+                        result['nModified'] += 1
+                    continue
+                elif isinstance(operation, UpdateOne):
+                    key = (operation._filter['source'], operation._filter['hash_id'])
+                    if key in self.documents:
+                        continue
+                    document = {**operation._filter, **operation._doc.get('$setOnInsert', {})}
+                    result['upserted'].append({'index': index, '_id': index})
+                else:
+                    raise NotImplementedError(f"Unsupported operation: {operation}")
+
+                # The unique index rejects the document if it exists in its source (e.g. inserted by a concurrent run)
+                key = (document['source'], document['hash_id'])
+                if key in self.documents:
+                    result['writeErrors'].append({'index': index, 'code': DUPLICATE_KEY_ERROR})
+                    if ordered:
+                        break
+                    continue
+                self.documents[key] = document
+                self._keys.setdefault(document['hash_id'], set()).add(key)
+                result['nInserted' if isinstance(operation, InsertOne) else 'nUpserted'] += 1
+
+            if result['writeErrors']:
+                raise pymongo_errors.BulkWriteError(result)
+            return SimpleNamespace(bulk_api_result=result)
+        return self._timed(bulk_write)
+
+    def find_one_and_update(self, query: dict, update: dict, upsert: bool = False, return_document: bool = False):
+        # Only the '$inc' of a document keyed by its '_id' (e.g. the update counter of the vector index)
+        def find_one_and_update():
+            key = ('_id', query['_id'])
+            if key not in self.documents and not upsert:
+                return None
+            previous = self.documents.setdefault(key, {'_id': query['_id']})
+            document = dict(previous)
+            for field, value in update['$inc'].items():
+                document[field] = document.get(field, 0) + value
+            self.documents[key] = document
+            return dict(document if return_document else previous)
+        return self._timed(find_one_and_update)
+
+    def update_one(self, query: dict, update: dict, upsert: bool = False):
+        # Only the '$set' of a document keyed by its '_id' (e.g. the digests of the source manifest)
+        def update_one():
+            key = ('_id', query['_id'])
+            if key not in self.documents and not upsert:
+                return SimpleNamespace(matched_count=0)
+            self.documents.setdefault(key, {'_id': query['_id']}).update(update['$set'])
+            return SimpleNamespace(matched_count=1)
+        return self._timed(update_one)
+
+    def update_many(self, query: dict, update: dict):
+        # Only '$unset' (e.g. the near-duplicate references left by previous runs)
+        conditions = compile_query(query)
+
+        def update_many():
+            documents = self._select(conditions)
+            for document in documents:
+                for field in update['$unset']:
+                    document.pop(field, None)
+            return SimpleNamespace(modified_count=len(documents))
+        return self._timed(update_many)
+
+    def delete_many(self, query: dict):
+        conditions = compile_query(query)
+
+        def delete_many():
+            documents = self._select(conditions)
+            for document in documents:
+                key = (document['source'], document['hash_id'])
+                del self.documents[key]
+                self._keys[document['hash_id']].discard(key)
+                if not self._keys[document['hash_id']]:
+                    del self._keys[document['hash_id']]
+            return SimpleNamespace(deleted_count=len(documents))
+        return self._timed(delete_many)
+
+
+class InMemoryDatabase:
+    """
+    In-memory database, whose collections are created on first access like in MongoDB.
+    """
+
+    def __init__(self, name: str = 'airzone_benchmark'):
+        self.name = name
+        self.durations = []
+        self._collections = {}
+        self._lock = threading.Lock()
+
+    def __getitem__(self, name: str) -> InMemoryCollection:
+        with self._lock:
+            return self._collections.setdefault(name, InMemoryCollection(self, name))
+
+    def record(self, seconds: float) -> None:
+        with self._lock:
+            self.durations.append(seconds)
+
+    def reset(self) -> list:
+        """
+        Reset the statistics of the database operations.
+        :return: duration of each operation since the last reset, in seconds
+        """
+        with self._lock:
+            durations, self.durations = self.durations, []
+        return durations
@@ -0,0 +1,236 @@
+"""
+Offline replay of the upstream services for the benchmarks: the requests and aiohttp clients of the scrapers are served
+from the recorded fixtures in benchmarks/fixtures (indexed by URL in routes.json), so no request leaves the process.
+"""
+import asyncio
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from unittest import mock
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+import requests
+from requests.adapters import BaseAdapter
+
+from src.utils.connections import get_http_session
+
+FIXTURES_DIR = os.path.join(os.path.dirname(__file__), 'fixtures')
+
+# Modules whose aiohttp sessions are replaced by the replay sessions
+AIOHTTP_CLIENT_MODULES = ('src.websites.support.support_functions', 'src.websites.myzone.myzone_products_scraper')
+
+
+def normalise_url(url: str, params: dict = None) -> str:
+    """
+    Normalise a URL and its query string parameters, so the same request matches its route whatever the order of the
+    parameters.
+    :param url: URL of the request
+    :param params: query string parameters of the request
+    :return: normalised URL
+    """
+    parts = urlsplit(str(url))
+    query = parse_qsl(parts.query) + [(key, str(value)) for key, value in (params or {}).items()]
+    return urlunsplit((parts.scheme, parts.netloc, parts.path, urlencode(sorted(query)), ''))
+
+
+class FixtureRoutes:
+    """
+    Recorded responses indexed by URL, and the statistics of the requests replayed from them. Each replayed request can
+    be delayed to emulate the network latency.
+    """
+
+    def __init__(self, fixtures_dir: str = FIXTURES_DIR, latency: float = 0):
+        """
+        :param fixtures_dir: directory of the fixtures, with the routes.json index
+        :param latency: seconds each request is delayed
+        """
+        with open(os.path.join(fixtures_dir, 'routes.json'), 'r', encoding='utf-8') as routes_file:
+            routes = json.load(routes_file)
+        self.routes = {normalise_url(url): route for url, route in routes.items()}
+        self.fixtures_dir = fixtures_dir
+        self.latency = latency
+        self.durations = []
+        self._bodies = {}
+        self._lock = threading.Lock()
+
+    def get(self, url: str, params: dict = None) -> tuple:
+        """
+        Get the recorded response of a URL.
+        :param url: URL of the request
+        :param params: query string parameters of the request
+        :return: tuple with the status code, the content type and the body of the response
+        """
+        route = self.routes.get(normalise_url(url, params))
+        if route is None:
+            return 404, 'text/plain', b'Not recorded'
+        with self._lock:
+            body = self._bodies.get(route['path'])
+            if body is None:
+                with open(os.path.join(self.fixtures_dir, route['path']), 'rb') as fixture_file:
+                    body = self._bodies[route['path']] = fixture_file.read()
+        return 200, route['content_type'], body
+
+    def record(self, seconds: float) -> None:
+        with self._lock:
+            self.durations.append(seconds)
+
+    def reset(self) -> list:
+        """
+        Reset the statistics of the replayed requests.
+        :return: duration of each request replayed since the last reset, in seconds
+        """
+        with self._lock:
+            durations, self.durations = self.durations, []
+        return durations
+
+
+class FixtureAdapter(BaseAdapter):
+    """
+    requests transport adapter that answers every request from the recorded fixtures.
+    """
+
+    def __init__(self, routes: FixtureRoutes):
+        super().__init__()
+        self.routes = routes
+
+    def send(self, request, **kwargs):
+        start = time.perf_counter()
+        if self.routes.latency:
+            time.sleep(self.routes.latency)
+        status, content_type, body = self.routes.get(request.url)
+
+        response = requests.Response()
+        response.status_code = status
+        response.headers['Content-Type'] = content_type
+        response.headers['Content-Length'] = str(len(body))
+        response._content = body if request.method != 'HEAD' else b''
+        response.encoding = 'utf-8'
+        response.url = request.url
+        response.request = request
+        self.routes.record(time.perf_counter() - start)
+        return response
+
+    def close(self):
+        pass
+
+
+class FixtureClientResponse:
+    """
+    Subset of aiohttp.ClientResponse used by the scrapers.
+    """
+
+    def __init__(self, url: str, status: int, content_type: str, body: bytes):
+        from multidict import CIMultiDict
+
+        self.url = url
+        self.status = status
+        self.headers = CIMultiDict({'Content-Type': content_type, 'Content-Length': str(len(body))})
+        self._body = body
+
+    def raise_for_status(self) -> None:
+        import aiohttp
+        from multidict import CIMultiDict, CIMultiDictProxy
+        from yarl import URL
+
+        if self.status >= 400:
+            request_info = aiohttp.RequestInfo(URL(self.url), 'GET', CIMultiDictProxy(CIMultiDict()), URL(self.url))
+            raise aiohttp.ClientResponseError(request_info, (), status=self.status, message='Not recorded')
+
+    def get_encoding(self) -> str:
+        return 'utf-8'
+
+    async def read(self) -> bytes:
+        return self._body
+
+    async def text(self) -> str:
+        return self._body.decode('utf-8')
+
+    async def json(self):
+        return json.loads(self._body)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        pass
+
+
+class FixtureClientSession:
+    """
+    Subset of aiohttp.ClientSession used by the scrapers, answering every request from the recorded fixtures.
+    """
+
+    def __init__(self, routes: FixtureRoutes, raise_for_status: bool = False, **kwargs):
+        """
+        :param routes: recorded responses
+        :param raise_for_status: raise an aiohttp.ClientResponseError for the error responses
+        :param kwargs: other arguments of the aiohttp session (ignored)
+        """
+        self.routes = routes
+        self.raise_for_status = raise_for_status
+
+    def get(self, url, params=None, headers=None):
+        return _FixtureRequest(self, url, params)
+
+    async def close(self) -> None:
+        pass
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        pass
+
+
+class _FixtureRequest:
+
+    def __init__(self, session: FixtureClientSession, url, params):
+        self.session = session
+        self.url = url
+        self.params = params
+
+    async def __aenter__(self) -> FixtureClientResponse:
+        routes = self.session.routes
+        start = time.perf_counter()
+        if routes.latency:
+            await asyncio.sleep(routes.latency)
+        response = FixtureClientResponse(normalise_url(self.url, self.params), *routes.get(self.url, self.params))
+        routes.record(time.perf_counter() - start)
+        if self.session.raise_for_status:
+            response.raise_for_status()
+        return response
+
+    async def __aexit__(self, *exc_info):
+        pass
+
+
+@contextmanager
+def replay_network(routes: FixtureRoutes):
+    """
+    Serve the requests of the scrapers from the recorded fixtures: the shared PDF download session and the returned
+    requests session are mounted with a FixtureAdapter, and the aiohttp sessions of the scrapers are replaced by
+    FixtureClientSession objects.
+    :param routes: recorded responses
+    :return: requests session for the scrapers
+    """
+    session = requests.Session()
+    downloads_session = get_http_session('downloads', cached=False)
+    previous_adapters = dict(downloads_session.adapters)
+    for client in (session, downloads_session):
+        client.mount('https://', FixtureAdapter(routes))
+        client.mount('http://', FixtureAdapter(routes))
+
+    patches = [mock.patch(f'{module}.create_client_session', lambda **kwargs: FixtureClientSession(routes, **kwargs))
+               for module in AIOHTTP_CLIENT_MODULES]
+    try:
+        for patch in patches:
+            patch.start()
+        yield session
+    finally:
+        for patch in patches:
+            patch.stop()
+        downloads_session.adapters.clear()
+        downloads_session.adapters.update(previous_adapters)
+        session.close()
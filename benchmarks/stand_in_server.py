@@ -0,0 +1,427 @@
+"""
+Local stand-in server of api.airzonecloud.com and myzone.airzone.es for load tests. It serves synthetic responses with
+the structure of the real ones for every endpoint the scrapers use: the msmultimedia books, sections, FAQ groups, FAQs,
+media groups and PDFs, the msacademy courses, the crm-associates partners, the msairpress translations, and the Myzone
+products tree, product pages and footer pages.
+
+The catalog is a multiple (--scale) of the size of today's catalog, and each response is generated from its path, so
+the memory of the server does not grow with the scale. The latency, the error rate (500) and the rate of "429 Too Many
+Requests" responses are configurable, and the responses have an ETag, so conditional requests are answered with 304.
+
+Point the scrapers to the server with the AIRZONE_API_URL and MYZONE_URL environment variables, e.g.:
+    python -m benchmarks.stand_in_server --port 8080 --scale 10
+    AIRZONE_API_URL=http://127.0.0.1:8080 MYZONE_URL=http://127.0.0.1:8080 python main_scraper.py
+
+Usage: python -m benchmarks.stand_in_server [--port 8080] [--scale 1] [--latency-ms 0] [--error-rate 0]
+       [--throttle-rate 0]
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import random
+import threading
+from dataclasses import dataclass
+from typing import Optional
+
+from aiohttp import web
+
+WORDS = ('termostato sistema zona compuerta rejilla plenum central instalación configuración temperatura consigna '
+         'modo calor frío ventilación deshumidificación pasarela unidad conductos control bus cableado radio batería '
+         'pantalla aplicación usuario instalador parámetro caudal velocidad sonda humedad calidad aire programación '
+         'horario eficiencia consumo protección alarma error comunicación firmware actualización Airzone Flexa '
+         'Easyzone Blueface Think Lite Aidoo Cloud webserver módulo relé salida entrada').split()
+
+# Size of today's catalog, multiplied by the scale
+CATALOG_SIZE = {'support_sections': 20, 'support_contents': 12, 'faq_groups': 8, 'faq_pages': 3, 'media_groups': 20,
+                'media_pdfs': 5, 'courses': 40, 'partner_categories': 5, 'partners': 40, 'translations': 60,
+                'product_categories': 4, 'product_units': 4, 'product_subunits': 3, 'products': 6}
+# Dimensions that grow with the scale (the rest of them are the fan-out of a page, e.g. the FAQs of a page)
+SCALED_DIMENSIONS = ('support_sections', 'faq_groups', 'media_groups', 'courses', 'partners', 'translations',
+                     'product_units')
+FAQS_PER_PAGE = 10
+PDF_PAGES = 4
+# Distinct PDF documents generated (each PDF of the catalog is one of them with a different title)
+PDF_VARIANTS = 8
+FOOTER_PAGES = ('politica-privacidad', 'condiciones-uso', 'aviso-legal', 'politica-cookies')
+
+
+@dataclass
+class StandInConfig:
+    """
+    Configuration of the stand-in server.
+    """
+    scale: float = 1
+    latency_ms: float = 0
+    latency_jitter_ms: float = 0
+    error_rate: float = 0
+    throttle_rate: float = 0
+    retry_after: int = 1
+    seed: int = 0
+
+    def size(self, dimension: str) -> int:
+        size = CATALOG_SIZE[dimension]
+        return max(1, round(size * self.scale)) if dimension in SCALED_DIMENSIONS else size
+
+
+class TextGenerator:
+    """
+    Deterministic generator of Spanish-like text, seeded by the path of each response.
+    """
+
+    def __init__(self, seed: int, key: str):
+        self.rng = random.Random(f"{seed}:{key}")
+
+    def sentence(self, n_words: Optional[int] = None) -> str:
+        words = ' '.join(self.rng.choice(WORDS) for _ in range(n_words or self.rng.randint(8, 20)))
+        return words[0].upper() + words[1:] + '.'
+
+    def title(self, n_words: int = 4) -> str:
+        return self.sentence(n_words)[:-1]
+
+    def paragraph(self, n_sentences: Optional[int] = None) -> str:
+        return ' '.join(self.sentence() for _ in range(n_sentences or self.rng.randint(2, 5)))
+
+    def html(self, n_blocks: int) -> str:
+        blocks = []
+        for _ in range(n_blocks):
+            kind = self.rng.random()
+            if kind < 0.15:
+                blocks.append(f"<h3>{self.title()}</h3>")
+            elif kind < 0.35:
+                blocks.append('<ul>' + ''.join(f"<li>{self.sentence()}</li>" for _ in range(self.rng.randint(2, 5)))
+                              + '</ul>')
+            elif kind < 0.45:
+                blocks.append(f"<p>{self.paragraph(2)} <em>{self.sentence(3)}</em> "
+                              f"<a href=\"https://www.airzonecontrol.com\">más información</a>.</p>")
+            else:
+                blocks.append(f"<p>{self.paragraph()}</p>")
+        return '\n'.join(blocks)
+
+
+class StandInCatalog:
+    """
+    Synthetic catalog of the Airzone API and the Myzone website. The responses are generated on request from their
+    path, except the PDF documents, which are generated once.
+    """
+
+    def __init__(self, config: StandInConfig):
+        self.config = config
+        self._pdfs = {}
+        self._pdfs_lock = threading.Lock()
+
+    def text(self, key: str) -> TextGenerator:
+        return TextGenerator(self.config.seed, key)
+
+    # Airzone API
+    def books(self) -> dict:
+        sections = [{'name': f"Sección {i}", 'az_iso': f"MU_AZCLOUD_{i:04d}"}
+                    for i in range(self.config.size('support_sections'))]
+        return {'body': {'digital_books': {'data': [
+            {'name': 'Airzone Aidoo', 'az_iso': 'MU_AIDOO', 'digital_sections': []},
+            {'name': 'Airzone Cloud', 'az_iso': 'MU_AZCLOUD', 'digital_sections': sections}]}}}
+
+    def section(self, az_iso: str) -> dict:
+        text = self.text(f"section:{az_iso}")
+        contents = [{'name': f"{az_iso} {i}: {text.title()}", 'description': text.html(text.rng.randint(3, 9))}
+                    for i in range(self.config.size('support_contents'))]
+        return {'body': {'digital_section': {'digital_subsections': [
+            {'name': az_iso, 'digital_contents': contents[i::3]} for i in range(3)]}}}
+
+    def faq_groups(self) -> dict:
+        return {'body': {'groups': [{'name': f"Grupo {i}", 'reference': f"group-{i}"}
+                                    for i in range(self.config.size('faq_groups'))]}}
+
+    def faqs(self, group: str, page: int) -> dict:
+        text = self.text(f"faqs:{group}:{page}")
+        faqs = [{'question': f"¿{group} {page}.{i}: {text.title(6)}?",
+                 'answer': f"<h1>{group}</h1>{text.html(text.rng.randint(1, 4))}"} for i in range(FAQS_PER_PAGE)]
+        return {'body': {'faqs': {'data': faqs, 'last_page': self.config.size('faq_pages')}}}
+
+    def media_groups(self) -> dict:
+        return {'body': {'media_groups': [{'id': i, 'name': f"Grupo multimedia {i}"}
+                                          for i in range(self.config.size('media_groups'))]}}
+
+    def media_group(self, group_id: int, base_url: str) -> dict:
+        n_pdfs = self.config.size('media_pdfs')
+        resources = [{'name': f"Documento {group_id}.{i}", 'url': f"{base_url}/pdf/{group_id * n_pdfs + i}.pdf"}
+                     for i in range(n_pdfs)]
+        # Groups share some PDFs, and not every resource is a PDF, as in the real groups
+        resources.append({'name': 'Imagen', 'url': f"{base_url}/img/{group_id}.png"})
+        if group_id:
+            resources.append({'name': f"Documento {group_id - 1}.0",
+                              'url': f"{base_url}/pdf/{(group_id - 1) * n_pdfs}.pdf"})
+        return {'body': {'media_group': {'classes': [{'media_resources': resources[:2]},
+                                                     {'media_resources': resources[2:]}]}}}
+
+    def pdf(self, pdf_id: int) -> bytes:
+        variant = pdf_id % PDF_VARIANTS
+        with self._pdfs_lock:
+            if variant not in self._pdfs:
+                import fitz
+
+                text = self.text(f"pdf:{variant}")
+                document = fitz.open()
+                for _ in range(PDF_PAGES):
+                    page = document.new_page()
+                    page.insert_textbox(fitz.Rect(36, 36, 576, 806),
+                                        '\n'.join(text.sentence(text.rng.randint(8, 14)) for _ in range(40)),
+                                        fontsize=8)
+                self._pdfs[variant] = document.tobytes(garbage=3, deflate=True)
+                document.close()
+            return self._pdfs[variant]
+
+    def courses(self) -> dict:
+        courses = []
+        for i in range(self.config.size('courses')):
+            text = self.text(f"course:{i}")
+            courses.append({'title': f"Curso {i}: {text.title()}",
+                            'description': f"<p><strong>Webinar</strong></p>{text.html(text.rng.randint(2, 6))}"})
+        return {'body': {'courses': courses}}
+
+    def partner_categories(self) -> dict:
+        text = self.text('partners')
+        categories = []
+        for i in range(self.config.size('partner_categories')):
+            partners = [{'name': f"Instalaciones {text.title(2)} {i}.{j}", 'alias': f"IN{i}.{j}",
+                         'address': f"Calle {text.title(2)} {text.rng.randint(1, 99)}",
+                         'city': text.rng.choice(('Málaga', 'Madrid', 'Sevilla', 'Valencia', 'Barcelona')),
+                         'postal_code': f"{text.rng.randint(1000, 52999):05d}",
+                         'phone': f"9{text.rng.randint(10000000, 99999999)}", 'email': f"contacto{i}.{j}@example.com"}
+                        for j in range(self.config.size('partners'))]
+            categories.append({'name': f"Categoría {i}", 'associates': partners})
+        return {'body': {'categories': {'data': categories}}}
+
+    def translations(self) -> dict:
+        def translation(text: TextGenerator, depth: int) -> dict:
+            node = {'title': text.title(3)}
+            for k in range(text.rng.randint(2, 5)):
+                node[f"text_{k}"] = text.paragraph(text.rng.randint(1, 3))
+            if depth:
+                node['section'] = translation(text, depth - 1)
+                node['items'] = [translation(text, 0) for _ in range(2)]
+            return node
+
+        body = {}
+        for i in range(self.config.size('translations')):
+            text = self.text(f"translation:{i}")
+            body[f"page_{i}"] = translation(text, text.rng.randint(0, 2))
+        return {'body': body}
+
+    # Myzone website
+    def products_index(self) -> str:
+        categories = []
+        for c in range(self.config.size('product_categories')):
+            units = []
+            for u in range(self.config.size('product_units')):
+                subunits = ''.join(f'<li><a href="/productos/c{c}u{u}/s{s}">Subunidad {c}.{u}.{s} '
+                                   f'({self.config.size("products")})</a></li>'
+                                   for s in range(self.config.size('product_subunits')))
+                units.append(f'<li class="categoria"><a href="#"><span class="sidebar-nav-item">Unidad {c}.{u}</span>'
+                             f'</a><ul>{subunits}<li><a href="/productos/c{c}u{u}/">Ver todos</a></li></ul></li>')
+            categories.append(f'<h3 class="sidelines text-center">Categoría {c}</h3>\n'
+                              f'<ul class="sidebar-nav">{"".join(units)}</ul>')
+        return self.page('Productos', '<div class="col-md-3 sidebar">' + '\n'.join(categories) + '</div>')
+
+    def subunit(self, unit: str, subunit: str) -> str:
+        grid = ''.join(f'<div class="col-xs-4 col-sm-3 col-lg-4 inner-bottom-xs text-center li-img-holder">'
+                       f'<a href="/productos/{unit}/{subunit}/p{p}"><img src="/img/p.png" alt=""></a></div>'
+                       f'<div class="col-xs-8 col-sm-9 col-lg-8"><h2>Producto {unit}.{subunit}.{p}</h2></div>\n'
+                       for p in range(self.config.size('products')))
+        return self.page(f"Subunidad {unit}.{subunit}", f'<div class="row products-grid">\n{grid}</div>')
+
+    def product(self, unit: str, subunit: str, product: str) -> str:
+        text = self.text(f"product:{unit}:{subunit}:{product}")
+        description = ''.join(f"<p>{text.paragraph()}</p>" if text.rng.random() < 0.6 else
+                              '<ul>' + ''.join(f"<li>{text.sentence()}</li>" for _ in range(4)) + '</ul>'
+                              for _ in range(text.rng.randint(3, 7)))
+        faqs = ''.join(f'<div class="col-sm-12 inner-top-xs"><a class="make-menos" href="#faq{k}"><h3 class="faq">'
+                       f'{k}. ¿{text.title(6)}?</h3></a></div>\n<div class="m-b-lg"><p>{text.paragraph()}</p></div>\n'
+                       for k in range(1, text.rng.randint(2, 6)))
+        return self.page(f"Producto {unit}.{subunit}.{product}",
+                         f'<div class="row"><div class="col-md-7"><h1 itemprop="name">Producto</h1>\n'
+                         f'<div itemprop="description">\n{description}\n</div></div></div>\n<div class="row">\n{faqs}'
+                         f'</div>')
+
+    def footer(self, slug: str) -> str:
+        text = self.text(f"footer:{slug}")
+        sections = []
+        for s in range(text.rng.randint(4, 7)):
+            blocks = ''.join(f"<p>{text.paragraph()}</p>" if text.rng.random() < 0.7 else
+                             '<ol>' + ''.join(f"<li>{text.sentence()}</li>" for _ in range(3)) + '</ol>'
+                             for _ in range(text.rng.randint(2, 4)))
+            sections.append(f'<div class="row"><h5>{s + 1}. {text.title(3).upper()}</h5>{blocks}</div>')
+        return self.page(slug, '<div class="row"><div class="col-md-10">\n' + '\n'.join(sections) + '\n</div></div>')
+
+    @staticmethod
+    def page(title: str, content: str) -> str:
+        return (f'<!DOCTYPE html>\n<html lang="es">\n<head><meta charset="utf-8">'
+                f'<title>{title} | Myzone Airzone</title></head>\n<body>\n<section class="container">\n{content}\n</section>\n</body>\n</html>\n')
+
+
+def create_app(config: StandInConfig) -> web.Application:
+    """
+    Create the application of the stand-in server.
+    :param config: configuration of the server
+    :return: aiohttp application
+    """
+    catalog = StandInCatalog(config)
+    rng = random.Random(config.seed)
+    stats = {'requests': 0, 'not_modified': 0, 'errors': 0, 'throttled': 0}
+
+    @web.middleware
+    async def emulate_network(request, handler):
+        stats['requests'] += 1
+        if config.latency_ms or config.latency_jitter_ms:
+            await asyncio.sleep(max(0, rng.gauss(config.latency_ms, config.latency_jitter_ms)) / 1000)
+        if rng.random() < config.throttle_rate:
+            stats['throttled'] += 1
+            return web.Response(status=429, headers={'Retry-After': str(config.retry_after)})
+        if rng.random() < config.error_rate:
+            stats['errors'] += 1
+            return web.Response(status=500, text='Internal Server Error')
+
+        response = await handler(request)
+        # The ETag is the digest of the body, so an unchanged response is answered with 304 to a conditional request
+        etag = f'"{hashlib.sha256(response.body).hexdigest()[:32]}"'
+        if request.headers.get('If-None-Match') == etag:
+            stats['not_modified'] += 1
+            return web.Response(status=304, headers={'ETag': etag})
+        response.headers['ETag'] = etag
+        return response
+
+    def json_response(body: dict) -> web.Response:
+        return web.Response(body=json.dumps(body, ensure_ascii=False).encode('utf-8'),
+                            content_type='application/json', charset='utf-8')
+
+    def html_response(body: str) -> web.Response:
+        return web.Response(body=body.encode('utf-8'), content_type='text/html', charset='utf-8')
+
+    def base_url(request) -> str:
+        return f"{request.scheme}://{request.host}"
+
+    async def pdf(request):
+        # The PDF documents are generated in a thread, so the first request of each one does not block the server
+        content = await asyncio.to_thread(catalog.pdf, int(request.match_info['pdf_id']))
+        return web.Response(body=content, content_type='application/pdf')
+
+    async def get_stats(request):
+        return json_response(stats)
+
+    api = '/msmultimedia.pv1'
+    routes = [
+        (f'{api}/digital-doc/books', lambda request: json_response(catalog.books())),
+        (f'{api}/digital-doc/sections/{{az_iso}}',
+         lambda request: json_response(catalog.section(request.match_info['az_iso']))),
+        (f'{api}/faq-groups', lambda request: json_response(catalog.faq_groups())),
+        (f'{api}/faqs', lambda request: json_response(catalog.faqs(request.query.get('group', ''),
+                                                                   int(request.query.get('page', 1))))),
+        (f'{api}/groups', lambda request: json_response(catalog.media_groups())),
+        (f'{api}/groups/{{group_id}}',
+         lambda request: json_response(catalog.media_group(int(request.match_info['group_id']), base_url(request)))),
+        ('/msacademy.pv1/courses/', lambda request: json_response(catalog.courses())),
+        ('/mscrm.pv1/crm-associates/categories', lambda request: json_response(catalog.partner_categories())),
+        ('/msairpress.pv1/translations/es-ES', lambda request: json_response(catalog.translations())),
+        ('/productos/', lambda request: html_response(catalog.products_index())),
+        ('/productos/{unit}/{subunit}', lambda request: html_response(catalog.subunit(**request.match_info))),
+        ('/productos/{unit}/{subunit}/{product}',
+         lambda request: html_response(catalog.product(**request.match_info))),
+        *[(f'/{slug}', lambda request, slug=slug: html_response(catalog.footer(slug))) for slug in FOOTER_PAGES],
+    ]
+
+    app = web.Application(middlewares=[emulate_network])
+    for path, handler in routes:
+        async def handle(request, handler=handler):
+            return handler(request)
+        app.router.add_get(path, handle)
+    app.router.add_get('/pdf/{pdf_id}.pdf', pdf)
+    app.router.add_get('/_stats', get_stats)
+    app['config'] = config
+    app['stats'] = stats
+    return app
+
+
+class StandInServer:
+    """
+    Stand-in server running in a background thread, e.g. to load test the scrapers from the same process.
+    """
+
+    def __init__(self, config: StandInConfig, host: str = '127.0.0.1', port: int = 0):
+        """
+        :param config: configuration of the server (it can be changed while the server runs)
+        :param host: host to listen on
+        :param port: port to listen on (a free port if 0)
+        """
+        self.config = config
+        self.host = host
+        self.port = port
+        self.app = None
+        self._loop = None
+        self._runner = None
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    def start(self) -> 'StandInServer':
+        started = threading.Event()
+
+        async def serve():
+            self.app = create_app(self.config)
+            self._runner = web.AppRunner(self.app, access_log=None)
+            await self._runner.setup()
+            site = web.TCPSite(self._runner, self.host, self.port)
+            await site.start()
+            self.port = site._server.sockets[0].getsockname()[1]
+            started.set()
+
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+        self._thread.start()
+        asyncio.run_coroutine_threadsafe(serve(), self._loop).result()
+        started.wait()
+        return self
+
+    def stop(self) -> None:
+        asyncio.run_coroutine_threadsafe(self._runner.cleanup(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+    def __enter__(self) -> 'StandInServer':
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+def add_config_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument('--latency-ms', type=float, default=0, help='mean latency of each response')
+    parser.add_argument('--latency-jitter-ms', type=float, default=0, help='standard deviation of the latency')
+    parser.add_argument('--error-rate', type=float, default=0, help='fraction of the requests answered with 500')
+    parser.add_argument('--throttle-rate', type=float, default=0, help='fraction of the requests answered with 429')
+    parser.add_argument('--retry-after', type=int, default=1, help='Retry-After seconds of the 429 responses')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the generated catalog')
+
+
+def config_from_arguments(args, scale: float) -> StandInConfig:
+    return StandInConfig(scale=scale, latency_ms=args.latency_ms, latency_jitter_ms=args.latency_jitter_ms,
+                         error_rate=args.error_rate, throttle_rate=args.throttle_rate, retry_after=args.retry_after,
+                         seed=args.seed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1', help='host to listen on')
+    parser.add_argument('--port', type=int, default=8080, help='port to listen on')
+    parser.add_argument('--scale', type=float, default=1, help="size of the catalog, as a multiple of today's catalog")
+    add_config_arguments(parser)
+    args = parser.parse_args()
+
+    print(f"Point the scrapers to the server with AIRZONE_API_URL=http://{args.host}:{args.port} "
+          f"MYZONE_URL=http://{args.host}:{args.port}")
+    web.run_app(create_app(config_from_arguments(args, args.scale)), host=args.host, port=args.port)
+
+
+if __name__ == '__main__':
+    main()
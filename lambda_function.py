@@ -6,8 +6,9 @@ from main_scraper import airzone_main_scraper
 
 def lambda_handler(event, context):
     try:
-        # Run the main scraper
-        airzone_main_scraper()
+        # Run the main scraper (the event can force the processing of the unchanged sources)
+        force_refresh = isinstance(event, dict) and bool(event.get('force_refresh', False))
+        airzone_main_scraper(force_refresh=force_refresh)
         return {
             'statusCode': 200,
             'body': json.dumps('Airzone scraper finished successfully')
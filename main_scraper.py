@@ -1,25 +1,31 @@
-import asyncio
 import os
+import sys
 
-import requests
 import logging
 import logging.config
-from pymongo import MongoClient, errors as pymongo_errors
+from pymongo import errors as pymongo_errors
+from src.utils.connections import close_connections, get_http_session, get_mongo_client
+from src.utils.db_sync import ensure_indexes
+from src.utils.embeddings import flush_embedding_cache
 from src.utils.general_functions import setup_logging
-from src.websites.airzonecontrol.airzonecontrol_functions import academia_scraper, partner_scraper
-from src.websites.airzonecontrol.general_information_scraper import general_information_scraper
-from src.websites.myzone.myzone_products_scraper import airzone_products_scraper
-from src.websites.support.support_functions import support_scraper
+from src.utils.http_cache import flush_http_cache
+from src.utils.metrics import emit_metrics, start_metrics_run, write_run_summary
+from src.utils.near_duplicates import finish_near_duplicates_run, start_near_duplicates_run
+from src.utils.profiling import finish_profiling_run, start_profiling_run
+from src.utils.scraper_orchestrator import SCRAPER_TASKS, get_collections, run_scrapers
+from src.utils.source_manifest import log_skipped_sources, start_manifest_run
+from src.utils.vector_index import finish_vector_index_run, start_vector_index_run
 
 
-def airzone_main_scraper():
-    global db_connection, client
+def airzone_main_scraper(force_refresh=False, profile=None, profile_stages=None):
+    """
+    Run all the scrapers and synchronise their data with the database.
+    :param force_refresh: process every source even if its upstream payloads have not changed since the last run
+    :param profile: profile each scraper with cProfile and tracemalloc (PROFILING_ENABLED if None)
+    :param profile_stages: also profile each stage of the scrapers (PROFILING_STAGES if None)
+    """
     api_key = os.environ.get('AIRZONE_API_KEY')
-    db_host = os.environ.get('DB_HOST')
-    db_port = os.environ.get('DB_PORT')
     db_name = os.environ.get('DB_NAME')
-    db_user = os.environ.get('DB_USER')
-    db_password = os.environ.get('DB_PASSWORD')
     deployment_option = os.environ.get('DEPLOYMENT_OPTION')
 
     headers = {
@@ -37,27 +43,28 @@ def airzone_main_scraper():
     try:
         # Set up the logging configuration based on the deployment option (On-premise or Cloud)
         setup_logging()
-        logging.info("Setting up the connection to the database...")
-
-        # Create a MongoDB client
-        if deployment_option == 'ON_PREMISE':
-            client = MongoClient(host=db_host, port=int(db_port), username=db_user, password=db_password)
-        else:
-            client = MongoClient(f'mongodb://{db_user}:{db_password}@{db_name}.cluster-ca1pg02lwckr.eu-west-3.docdb'
-                             f'.amazonaws.com:{db_port}/?tls=true&tlsCAFile=src/global-bundle.pem&replicaSet=rs0'
-                             f'&readPreference=secondaryPreferred&retryWrites=false')
 
+        # The MongoDB client and the HTTP session are reused by the warm invocations of the same Lambda environment
+        client = get_mongo_client()
         db = client[db_name]
-        session = requests.Session()
-        session.headers.update(headers)
+        ensure_indexes(db, get_collections(SCRAPER_TASKS))
+        session = get_http_session(headers=headers)
 
         logging.info("Starting the Airzone scraper...")
-        # Run all the scrapers
-        support_scraper(session, db)
-        academia_scraper(session, db)
-        general_information_scraper(session, db)
-        partner_scraper(session, db)
-        asyncio.run(airzone_products_scraper(db))
+        start_manifest_run(force_refresh)
+        start_metrics_run()
+        start_profiling_run(profile, profile_stages)
+        start_near_duplicates_run()
+        start_vector_index_run()
+        # Run all the scrapers concurrently
+        breakdown = run_scrapers(session, db)
+        finish_near_duplicates_run(db)
+        # Only the vectors of the chunks embedded by this run are read from the database (unless the index is built
+        # again or missed an update)
+        finish_vector_index_run(db)
+        log_skipped_sources()
+        emit_metrics()
+        write_run_summary(breakdown)
         logging.info("Airzone scraper finished successfully")
 
     except pymongo_errors.PyMongoError as e:
@@ -65,8 +72,15 @@ def airzone_main_scraper():
     except Exception as e:
         logging.error(f"An error occurred: {e}")
     finally:
-        client.close()
+        finish_profiling_run()
+        flush_http_cache()
+        flush_embedding_cache()
+        # Lambda keeps the connections for the next invocation; the other deployments run once, so they close them
+        if deployment_option != 'LAMBDA':
+            close_connections()
 
 
 if __name__ == "__main__":
-    airzone_main_scraper()
+    airzone_main_scraper(force_refresh='--force-refresh' in sys.argv[1:],
+                         profile=True if '--profile' in sys.argv[1:] else None,
+                         profile_stages=True if '--profile-stages' in sys.argv[1:] else None)
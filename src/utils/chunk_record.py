@@ -0,0 +1,67 @@
+import time
+from typing import NamedTuple, Optional
+
+
+class ChunkRecord(NamedTuple):
+    """
+    Chunk of a scraped document. A tuple takes a fraction of the memory of the equivalent dict, since the field names
+    are stored once in the class instead of in every chunk.
+    """
+    hash_id: str
+    upload_date: str
+    source: str
+    title: str
+    description: str
+    url: Optional[str] = None
+
+    @classmethod
+    def create(cls, hash_id: str, source: str, title: str, description: str, url: Optional[str] = None):
+        """
+        Create a chunk uploaded at the current time.
+        :param hash_id: hash of the chunk content
+        :param source: source name
+        :param title: title of the document
+        :param description: text of the chunk
+        :param url: URL of the document (None if the source has no URL per document)
+        :return: ChunkRecord object
+        """
+        return cls(hash_id, time.strftime('%Y-%m-%d %H:%M:%S'), source, title, description, url)
+
+    @classmethod
+    def from_json(cls, value):
+        """
+        Rebuild a chunk from its JSON representation (the list of its fields).
+        :param value: JSON decoded chunk
+        :return: ChunkRecord object
+        """
+        return cls(*value)
+
+    def to_document(self) -> dict:
+        """
+        Get the MongoDB document of the chunk. The 'url' field is only included if the chunk has a URL.
+        :return: document dict
+        """
+        document = self._asdict()
+        if self.url is None:
+            del document['url']
+        return document
+
+
+def get_record_key(record) -> tuple:
+    """
+    Get the source and the hash_id of a record, either a ChunkRecord or a document dict (e.g. a partner).
+    :param record: ChunkRecord object or dict
+    :return: tuple with the source and the hash_id
+    """
+    if isinstance(record, ChunkRecord):
+        return record.source, record.hash_id
+    return record['source'], record['hash_id']
+
+
+def to_document(record) -> dict:
+    """
+    Get the MongoDB document of a record.
+    :param record: ChunkRecord object or dict
+    :return: document dict
+    """
+    return record.to_document() if isinstance(record, ChunkRecord) else record
@@ -0,0 +1,134 @@
+import logging
+import os
+import threading
+from typing import Optional
+
+import requests
+from pymongo import MongoClient, errors as pymongo_errors
+from requests.adapters import HTTPAdapter
+
+from src.utils.http_cache import get_http_cache, mount_http_cache
+from src.utils.metrics import increment, record_time
+
+# Size of the MongoDB connection pool: maximum and minimum connections, and milliseconds an idle connection is kept
+DB_MAX_POOL_SIZE = int(os.environ.get('DB_MAX_POOL_SIZE', 20))
+DB_MIN_POOL_SIZE = int(os.environ.get('DB_MIN_POOL_SIZE', 0))
+DB_MAX_IDLE_TIME_MS = int(os.environ.get('DB_MAX_IDLE_TIME_MS', 60000))
+# Milliseconds to wait for a MongoDB server, both to connect and in the health check of a reused client
+DB_SERVER_SELECTION_TIMEOUT_MS = int(os.environ.get('DB_SERVER_SELECTION_TIMEOUT_MS', 5000))
+# Size of the connection pools of the requests sessions: pools (one per host) and connections per pool
+HTTP_POOL_CONNECTIONS = int(os.environ.get('HTTP_POOL_CONNECTIONS', 10))
+HTTP_POOL_MAXSIZE = int(os.environ.get('HTTP_POOL_MAXSIZE', 10))
+
+# The clients are module-level, so they are reused by the warm invocations of the same Lambda execution environment
+_mongo_client = None
+_http_sessions = {}
+_connections_lock = threading.Lock()
+
+
+def create_mongo_client() -> MongoClient:
+    """
+    Create a MongoDB client with the connection settings of the environment variables (a local server on premise, an
+    Amazon DocumentDB cluster otherwise).
+    :return: MongoClient object
+    """
+    db_host = os.environ.get('DB_HOST')
+    db_port = os.environ.get('DB_PORT')
+    db_name = os.environ.get('DB_NAME')
+    db_user = os.environ.get('DB_USER')
+    db_password = os.environ.get('DB_PASSWORD')
+    pool_options = {'maxPoolSize': DB_MAX_POOL_SIZE, 'minPoolSize': DB_MIN_POOL_SIZE,
+                    'maxIdleTimeMS': DB_MAX_IDLE_TIME_MS, 'serverSelectionTimeoutMS': DB_SERVER_SELECTION_TIMEOUT_MS}
+
+    if os.environ.get('DEPLOYMENT_OPTION') == 'ON_PREMISE':
+        return MongoClient(host=db_host, port=int(db_port), username=db_user, password=db_password, **pool_options)
+    return MongoClient(f'mongodb://{db_user}:{db_password}@{db_name}.cluster-ca1pg02lwckr.eu-west-3.docdb'
+                       f'.amazonaws.com:{db_port}/?tls=true&tlsCAFile=src/global-bundle.pem&replicaSet=rs0'
+                       f'&readPreference=secondaryPreferred&retryWrites=false', **pool_options)
+
+
+def is_mongo_client_healthy(client: MongoClient) -> bool:
+    """
+    Check that a reused MongoDB client can still reach the server.
+    :param client: MongoClient object
+    :return: True if the server answers a ping
+    """
+    try:
+        client.admin.command('ping')
+        return True
+    except pymongo_errors.PyMongoError as e:
+        logging.warning(f"The MongoDB client is not healthy, a new one will be created: {e}")
+        return False
+
+
+def get_mongo_client() -> MongoClient:
+    """
+    Get the MongoDB client shared by the invocations of the process, creating it on first use or when the previous one
+    does not pass the health check.
+    :return: MongoClient object
+    """
+    global _mongo_client
+    with _connections_lock:
+        if _mongo_client is not None and not is_mongo_client_healthy(_mongo_client):
+            _mongo_client.close()
+            _mongo_client = None
+        if _mongo_client is None:
+            logging.info("Setting up the connection to the database...")
+            _mongo_client = create_mongo_client()
+        else:
+            logging.info("Reusing the connection to the database")
+        return _mongo_client
+
+
+def record_response_metrics(response, *args, **kwargs) -> None:
+    """
+    Response hook of the requests sessions that records the fetch metrics of each response.
+    :param response: requests response
+    """
+    increment('requests')
+    if getattr(response, 'not_modified', False):
+        increment('cache_hits')
+    else:
+        increment('bytes', len(response.content))
+    record_time('fetch', response.elapsed.total_seconds())
+
+
+def get_http_session(name: str = 'api', headers: Optional[dict] = None, cached: bool = True) -> requests.Session:
+    """
+    Get a requests session shared by the invocations of the process, so its keep-alive connections are reused. The
+    sessions are kept by name, since each one has its own headers (e.g. the API key is only sent to the Airzone API).
+    :param name: session name
+    :param headers: headers of the session, updated on every call
+    :param cached: send conditional requests through the shared HTTP cache
+    :return: requests session
+    """
+    with _connections_lock:
+        session = _http_sessions.get(name)
+        if session is None:
+            session = requests.Session()
+            adapter_kwargs = {'pool_connections': HTTP_POOL_CONNECTIONS, 'pool_maxsize': HTTP_POOL_MAXSIZE}
+            if cached and get_http_cache() is not None:
+                mount_http_cache(session, **adapter_kwargs)
+            else:
+                session.mount('https://', HTTPAdapter(**adapter_kwargs))
+                session.mount('http://', HTTPAdapter(**adapter_kwargs))
+            session.hooks['response'].append(record_response_metrics)
+            _http_sessions[name] = session
+        if headers:
+            session.headers.update(headers)
+        return session
+
+
+def close_connections() -> None:
+    """
+    Close the shared MongoDB client and HTTP sessions. Long-running processes (EC2 or on premise) call it when they
+    finish, while in Lambda the connections are kept for the next warm invocation.
+    """
+    global _mongo_client
+    with _connections_lock:
+        if _mongo_client is not None:
+            _mongo_client.close()
+            _mongo_client = None
+        for session in _http_sessions.values():
+            session.close()
+        _http_sessions.clear()
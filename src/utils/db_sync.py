@@ -0,0 +1,333 @@
+import logging
+import os
+import threading
+from contextlib import contextmanager
+from typing import Iterable, Optional
+
+from pymongo import ASCENDING, InsertOne, UpdateOne, errors as pymongo_errors
+
+from src.utils.chunk_record import ChunkRecord, get_record_key, to_document
+from src.utils.embeddings import EMBEDDINGS_ENABLED, EMBEDDING_MODEL_FIELD, create_chunk_embedder
+from src.utils.metrics import increment, timer
+from src.utils.near_duplicates import get_near_duplicate_index
+from src.utils.profiling import profiled_stage
+from src.utils.vector_index import record_vector_changes
+
+# Maximum number of documents sent to the database in each write operation
+DB_BATCH_SIZE = int(os.environ.get('DB_BATCH_SIZE', 1000))
+# Write mode of the synchronisation: 'diff' (look up the documents of each batch and insert the new ones) or 'upsert'
+# (unordered bulk upserts keyed on the source and the hash_id, which are idempotent for concurrent or repeated runs)
+DB_WRITE_MODE = os.environ.get('DB_WRITE_MODE', 'diff')
+# Error code of a write rejected by a unique index
+DUPLICATE_KEY_ERROR = 11000
+
+# Locks used to serialise the writes of different scrapers into the same collection
+_collection_locks = {}
+_collection_locks_lock = threading.Lock()
+# Collections whose indexes have already been provisioned by this process
+_indexed_collections = set()
+
+
+def get_collection_lock(collection_name: str) -> threading.Lock:
+    """
+    Get the lock used to serialise the writes into a given collection when several scrapers run concurrently.
+    :param collection_name: collection name
+    :return: lock of the collection
+    """
+    with _collection_locks_lock:
+        return _collection_locks.setdefault(collection_name, threading.Lock())
+
+
+def ensure_indexes(db, collection_names: Iterable[str]) -> None:
+    """
+    Provision the indexes used by the synchronisation: a unique compound index on 'source' and 'hash_id', which serves
+    the per-source lookups, upserts and stale sweeps without scanning the collection, and rejects the documents inserted
+    twice into a source by concurrent runs (the same 'hash_id' can be stored in several sources). If the embedding
+    stage is enabled, a compound index on 'source' and 'embedding_model' serves its lookup of the chunks without a
+    vector of the current model. Creating an existing index is a no-op, and each collection is only checked once per
+    process.
+    :param db: database object
+    :param collection_names: names of the collections
+    """
+    for collection_name in collection_names:
+        if (db.name, collection_name) in _indexed_collections:
+            continue
+        indexes = [([('source', ASCENDING), ('hash_id', ASCENDING)], {'unique': True, 'name': 'source_hash_id'})]
+        if EMBEDDINGS_ENABLED:
+            indexes.append(([('source', ASCENDING), (EMBEDDING_MODEL_FIELD, ASCENDING)],
+                            {'name': 'source_embedding_model'}))
+        for keys, options in indexes:
+            try:
+                db[collection_name].create_index(keys, **options)
+            except pymongo_errors.OperationFailure as e:
+                # E.g. the database user cannot create indexes, the collection already has duplicated keys or a
+                # conflicting index on the same fields: the synchronisation still works, without the index
+                logging.warning(f"Could not create the '{options['name']}' index of the '{collection_name}' "
+                                f"collection: {e}")
+        _indexed_collections.add((db.name, collection_name))
+        logging.info(f"The indexes of the '{collection_name}' collection are provisioned")
+
+
+class DocumentSync:
+    """
+    Streaming synchronisation of scraped documents with a collection. The documents are added one by one (or in
+    groups) and flushed to the database in batches: each batch is checked against the collection and only the documents
+    whose 'hash_id' does not exist for their 'source' are inserted. When the stream finishes, the documents of the
+    scraped sources that were not seen in the stream are removed.
+
+    Only the 'hash_id' of the seen documents is kept in memory, so the memory used is bounded by the batch size and not
+    by the size of the scraped documents. If the embedding stage is enabled, the inserted chunks are embedded.
+    """
+
+    def __init__(self, collection, batch_size: int = DB_BATCH_SIZE, write_mode: str = DB_WRITE_MODE):
+        """
+        :param collection: database collection object
+        :param batch_size: maximum number of documents sent to the database in each write operation
+        :param write_mode: 'diff' or 'upsert' (see DB_WRITE_MODE)
+        """
+        self.collection = collection
+        self.batch_size = batch_size
+        self.write_mode = write_mode
+        self.stats = {'inserted': 0, 'deleted': 0, 'unchanged': 0, 'collapsed': 0}
+        self._seen_hash_ids = {}
+        self._removed_keys = []
+        self._discarded_sources = set()
+        self._batch = []
+        self._lock = threading.Lock()
+        self._embedder = create_chunk_embedder(collection)
+
+    def add(self, document) -> None:
+        """
+        Add a scraped document to the stream, flushing the current batch if it is full.
+        :param document: ChunkRecord object or document dict (with at least the 'hash_id' and 'source' keys)
+        """
+        source, hash_id = get_record_key(document)
+        near_duplicate_index = get_near_duplicate_index()
+        # The signature is computed outside the lock, so the scrapers writing into the same sync do not wait for it
+        signature = near_duplicate_index.signature(document.description) if near_duplicate_index is not None and \
+            isinstance(document, ChunkRecord) else None
+        with self._lock:
+            source_hash_ids = self._seen_hash_ids.setdefault(source, set())
+            # Remove duplicated documents with the same 'hash_id'
+            if hash_id in source_hash_ids:
+                return
+            source_hash_ids.add(hash_id)
+            # A near-duplicate of a canonical chunk is not written: its canonical document references it instead. It is
+            # kept as seen, so the copy stored by a previous run is only removed at the end of the run, once the
+            # document of its canonical chunk is confirmed (see NearDuplicateIndex.remove_duplicates)
+            if signature is not None and near_duplicate_index.find_or_add(document, self.collection.name,
+                                                                          signature) is not None:
+                self.stats['collapsed'] += 1
+                return
+            self._batch.append(document)
+            if len(self._batch) >= self.batch_size:
+                self._flush()
+
+    def add_many(self, documents: Iterable) -> None:
+        """
+        Add several scraped documents to the stream.
+        :param documents: iterable of ChunkRecord objects or document dicts
+        """
+        for document in documents:
+            self.add(document)
+
+    def discard_source(self, source: str) -> None:
+        """
+        Mark a source as incomplete (e.g. its scraper failed), so its documents are not removed when the stream
+        finishes, and the near-duplicates of its chunks are kept.
+        :param source: source name
+        """
+        with self._lock:
+            self._discarded_sources.add(source)
+
+    @contextmanager
+    def track_source(self, source: str):
+        """
+        Context manager around the scraping of a source: if the scraping raises an exception, the source is discarded.
+        :param source: source name
+        """
+        try:
+            yield self
+        except BaseException:
+            self.discard_source(source)
+            raise
+
+    def _flush(self) -> None:
+        if not self._batch:
+            return
+        with timer('db_write'):
+            self._write_batch()
+
+    @profiled_stage('db_write')
+    def _write_batch(self) -> None:
+        batch, self._batch = self._batch, []
+        near_duplicate_index = get_near_duplicate_index()
+        if near_duplicate_index is not None:
+            # The chunks demoted to near-duplicates since they were added are not written
+            demoted = near_duplicate_index.demoted_keys(self.collection.name)
+            batch = [document for document in batch if get_record_key(document) not in demoted]
+        batch_keys = [get_record_key(document) for document in batch]
+        if not batch:
+            return
+
+        if self.write_mode == 'upsert':
+            self._upsert(batch, batch_keys)
+            return
+
+        with get_collection_lock(self.collection.name):
+            # Get the documents of the batch that already exist for their source
+            existing = {(row['source'], row['hash_id']) for row in self.collection.find(
+                {'source': {'$in': list({source for source, _ in batch_keys})},
+                 'hash_id': {'$in': [hash_id for _, hash_id in batch_keys]}},
+                {'_id': 0, 'source': 1, 'hash_id': 1})}
+
+            new_documents = [document for document, key in zip(batch, batch_keys) if key not in existing]
+            result = self._bulk_write([InsertOne(to_document(document)) for document in new_documents]) if \
+                new_documents else {'nInserted': 0}
+            self.stats['inserted'] += result['nInserted']
+            self.stats['unchanged'] += len(batch) - result['nInserted']
+
+        if new_documents:
+            # The documents rejected by the unique index were not inserted by this sync
+            rejected = {error['index'] for error in result.get('writeErrors', [])}
+            self._embed([document for index, document in enumerate(new_documents) if index not in rejected])
+
+    def _upsert(self, batch: list, batch_keys: list) -> None:
+        # The documents are only written if they do not exist, so the upserts need neither a previous lookup nor the
+        # collection lock
+        operations = []
+        for document, (source, hash_id) in zip(batch, batch_keys):
+            fields = {key: value for key, value in to_document(document).items() if key not in ('source', 'hash_id')}
+            operations.append(UpdateOne({'source': source, 'hash_id': hash_id}, {'$setOnInsert': fields}, upsert=True))
+
+        result = self._bulk_write(operations)
+        self.stats['inserted'] += result['nUpserted']
+        self.stats['unchanged'] += len(batch) - result['nUpserted']
+        self._embed([batch[upsert['index']] for upsert in result.get('upserted', [])])
+
+    def _embed(self, inserted: list) -> None:
+        if self._embedder is None:
+            return
+        for document in inserted:
+            # Only the chunks are embedded (e.g. not the partners)
+            if isinstance(document, ChunkRecord):
+                self._embedder.add(document)
+
+    def _bulk_write(self, operations: list) -> dict:
+        try:
+            return self.collection.bulk_write(operations, ordered=False).bulk_api_result
+        except pymongo_errors.BulkWriteError as e:
+            # The documents rejected by the unique 'source' and 'hash_id' index were inserted first into their source by
+            # a concurrent run, which leaves the collection as if they had been written
+            if any(error['code'] != DUPLICATE_KEY_ERROR for error in e.details['writeErrors']):
+                raise
+            return e.details
+
+    def flush(self) -> None:
+        """
+        Send the current batch to the database.
+        """
+        with self._lock:
+            self._flush()
+
+    def finish(self) -> dict:
+        """
+        Flush the last batch and remove the documents of the scraped sources that were not seen in the stream (and, with
+        them, their vectors). If the embedding stage is enabled, the chunks of those sources that are still without a
+        vector are embedded.
+        :return: dictionary with the number of inserted, deleted and unchanged documents
+        """
+        with self._lock:
+            self._flush()
+            if self._embedder is not None:
+                self._embedder.flush()
+            near_duplicate_index = get_near_duplicate_index()
+            demoted = near_duplicate_index.demoted_keys(self.collection.name) if near_duplicate_index is not None \
+                else set()
+            for source, source_hash_ids in self._seen_hash_ids.items():
+                demoted_hash_ids = {hash_id for key_source, hash_id in demoted if key_source == source}
+                self.stats['collapsed'] += len(source_hash_ids & demoted_hash_ids)
+                if source in self._discarded_sources:
+                    logging.warning(f"The '{source}' source is incomplete, so its stale documents are not removed")
+                    continue
+                # The near-duplicates (even those written before being demoted) are kept as seen: they are removed at
+                # the end of the run, once the documents of their canonical chunks are confirmed
+                with timer('db_write'):
+                    self._remove_stale_documents(source, source_hash_ids)
+                if near_duplicate_index is not None:
+                    near_duplicate_index.confirm((source, hash_id) for hash_id in source_hash_ids)
+                if self._embedder is not None:
+                    self._embedder.add_missing(source)
+            if self._embedder is not None:
+                self._embedder.finish()
+            # The vector index is updated with the chunks embedded and removed by this sync
+            record_vector_changes(self.collection.name, self._embedder.embedded_keys if self._embedder is not None
+                                  else (), self._removed_keys)
+        for key, value in self.stats.items():
+            increment(f"db_{key}", value)
+        return self.stats
+
+    def _remove_stale_documents(self, source: str, source_hash_ids: set) -> None:
+        hash_ids_to_remove = []
+        cursor = self.collection.find({'source': source}, {'_id': 0, 'hash_id': 1})
+        for row in cursor:
+            if row['hash_id'] not in source_hash_ids:
+                hash_ids_to_remove.append(row['hash_id'])
+
+        # Remove from the database the documents of this source that were not scraped
+        for i in range(0, len(hash_ids_to_remove), self.batch_size):
+            with get_collection_lock(self.collection.name):
+                result = self.collection.delete_many(
+                    {'source': source, 'hash_id': {'$in': hash_ids_to_remove[i:i + self.batch_size]}})
+            self.stats['deleted'] += result.deleted_count
+        self._removed_keys.extend((source, hash_id) for hash_id in hash_ids_to_remove)
+
+
+def sync_documents(collection, documents: Iterable, batch_size: int = DB_BATCH_SIZE) -> dict:
+    """
+    Synchronise a stream of documents with a given collection in the MongoDB database. Documents whose 'hash_id' does
+    not exist for their source are inserted, and the documents of those sources that are no longer scraped are removed.
+    Both operations are sent in batches.
+    :param collection: database collection object
+    :param documents: iterable of ChunkRecord objects or document dicts (with at least the 'hash_id' and 'source' keys)
+    :param batch_size: maximum number of documents sent to the database in each write operation
+    :return: dictionary with the number of inserted, deleted and unchanged documents
+    """
+    document_sync = DocumentSync(collection, batch_size)
+    document_sync.add_many(documents)
+    return document_sync.finish()
+
+
+def log_sync_stats(collection, stats: dict) -> None:
+    """
+    Log the result of the synchronisation of a collection.
+    :param collection: database collection object
+    :param stats: dictionary with the number of inserted, deleted, unchanged and collapsed documents
+    """
+    collapsed = f" ({stats['collapsed']} near-duplicates were collapsed)" if stats.get('collapsed') else ""
+    logging.info(
+        f"Process finished successfully. {stats['deleted']} rows were removed, {stats['inserted']} new rows were "
+        f"inserted and {stats['unchanged']} rows were unchanged in the '{collection.name}' collection{collapsed}")
+
+
+def insert_records_into_db(collection, records: Iterable, batch_size: int = DB_BATCH_SIZE) -> Optional[dict]:
+    """
+    Insert a stream of records into a given collection in the MongoDB database. Only the documents that do not exist
+    in the collection for their source will be inserted, and those of the same sources that are not in the stream will
+    be removed once the stream has been fully consumed
+    :param collection: database collection object
+    :param records: iterable of ChunkRecord objects or document dicts, e.g. a scraper generator
+    :param batch_size: maximum number of documents sent to the database in each write operation
+    :return: dictionary with the number of inserted, deleted and unchanged documents, or None if the database failed
+    """
+    try:
+        stats = sync_documents(collection, records, batch_size)
+        log_sync_stats(collection, stats)
+        return stats
+
+    except pymongo_errors.PyMongoError as e:
+        logging.info(f"Failed to insert documents into '{collection.name}' collection: {e}")
+    except Exception as e:
+        raise e
+
+    return None
@@ -0,0 +1,184 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+from typing import Optional, Tuple
+
+# Names of the files written by the cache: the values, named after the SHA-256 digest of their key, the index, and their
+# temporary files
+CACHE_FILE_NAME = re.compile(r'([0-9a-f]{64}|index\.json)(\.\d+)?(\.tmp)?')
+
+
+class DiskCache:
+    """
+    Persistent key-value cache stored in a directory, with a size limit and least recently used eviction. Each value is
+    stored in its own file, and an 'index.json' file keeps the metadata, size and last access time of every entry. The
+    values stored after the last flush of the index are removed when the cache is loaded.
+    """
+
+    def __init__(self, directory: str, max_bytes: int):
+        """
+        :param directory: directory where the cache is stored
+        :param max_bytes: maximum size of the stored values, in bytes
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._index_path = os.path.join(directory, 'index.json')
+        os.makedirs(directory, exist_ok=True)
+        self._index = self._load_index()
+        self._remove_orphans()
+        self._size = sum(entry['size'] for entry in self._index.values())
+
+    def _load_index(self) -> dict:
+        try:
+            with open(self._index_path, 'r') as index_file:
+                return json.load(index_file)
+        except (OSError, ValueError):
+            return {}
+
+    def _remove_orphans(self) -> None:
+        # The values written since the last flush (e.g. before a crash) are not in the index, or do not match their
+        # entry, so they would never be evicted or would be returned with the metadata of the previous value: they are
+        # removed together with the temporary files, and the entries whose file is missing are dropped. The files not
+        # written by the cache (e.g. if the directory is shared by mistake) are not touched
+        keys = {hashlib.sha256(key.encode('utf-8')).hexdigest(): key for key in self._index}
+        try:
+            with os.scandir(self.directory) as entries:
+                files = [entry for entry in entries if entry.is_file() and CACHE_FILE_NAME.fullmatch(entry.name)]
+        except OSError as e:
+            logging.warning(f"Failed to list the files of the cache '{self.directory}': {e}")
+            return
+
+        stored = set()
+        removed_files = 0
+        for file in files:
+            key = keys.get(file.name)
+            try:
+                if key is not None and file.stat().st_size == self._index[key]['size']:
+                    stored.add(key)
+                elif file.name != 'index.json':
+                    os.remove(file.path)
+                    removed_files += 1
+            except OSError:
+                pass
+        missing_keys = set(self._index) - stored
+        for key in missing_keys:
+            del self._index[key]
+        if removed_files or missing_keys:
+            logging.info(f"Cache '{self.directory}': {removed_files} files not saved in the index were removed, and "
+                         f"{len(missing_keys)} entries without their file were dropped")
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, hashlib.sha256(key.encode('utf-8')).hexdigest())
+
+    def get(self, key: str) -> Optional[Tuple[bytes, dict]]:
+        """
+        Get a value from the cache, marking it as recently used.
+        :param key: cache key
+        :return: tuple with the value and its metadata, or None if the key is not cached
+        """
+        with self._lock:
+            entry = self._index.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            try:
+                with open(self._path(key), 'rb') as value_file:
+                    value = value_file.read()
+            except OSError:
+                self._remove(key)
+                self.misses += 1
+                return None
+            entry['last_access'] = time.time()
+            self.hits += 1
+            return value, entry['metadata']
+
+    def get_metadata(self, key: str) -> Optional[dict]:
+        """
+        Get the metadata of a cached value without reading the value.
+        :param key: cache key
+        :return: metadata dictionary, or None if the key is not cached
+        """
+        with self._lock:
+            entry = self._index.get(key)
+            return entry['metadata'] if entry is not None else None
+
+    def set(self, key: str, value: bytes, metadata: dict = None) -> None:
+        """
+        Store a value in the cache, evicting the least recently used entries if the size limit is exceeded.
+        :param key: cache key
+        :param value: value to store
+        :param metadata: JSON serialisable metadata of the value
+        """
+        if len(value) > self.max_bytes:
+            return
+        path = self._path(key)
+        with self._lock:
+            temp_path = f"{path}.{threading.get_ident()}.tmp"
+            try:
+                with open(temp_path, 'wb') as value_file:
+                    value_file.write(value)
+                os.replace(temp_path, path)
+            except OSError as e:
+                # E.g. the disk is full: the value is not cached, but the caller goes on with it
+                logging.warning(f"Failed to store a value in the cache '{self.directory}': {e}")
+                try:
+                    os.remove(temp_path)
+                except OSError:
+                    pass
+                self._remove(key)
+                return
+
+            if key in self._index:
+                self._size -= self._index[key]['size']
+            self._index[key] = {'size': len(value), 'last_access': time.time(), 'metadata': metadata or {}}
+            self._size += len(value)
+            self._evict()
+
+    def delete(self, key: str) -> None:
+        """
+        Remove a value from the cache.
+        :param key: cache key
+        """
+        with self._lock:
+            self._remove(key)
+
+    def _remove(self, key: str) -> None:
+        entry = self._index.pop(key, None)
+        if entry is not None:
+            self._size -= entry['size']
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+
+    def _evict(self) -> None:
+        if self._size <= self.max_bytes:
+            return
+        for key in sorted(self._index, key=lambda k: self._index[k]['last_access']):
+            self._remove(key)
+            if self._size <= self.max_bytes:
+                break
+
+    def flush(self) -> None:
+        """
+        Persist the index of the cache to disk.
+        """
+        with self._lock:
+            temp_path = f"{self._index_path}.tmp"
+            try:
+                with open(temp_path, 'w') as index_file:
+                    json.dump(self._index, index_file)
+                os.replace(temp_path, self._index_path)
+            except OSError as e:
+                # The previous index is kept, and the entries stored since then are lost like cache misses
+                logging.warning(f"Failed to save the index of the cache '{self.directory}': {e}")
+                return
+        logging.info(f"Cache '{self.directory}' saved: {len(self._index)} entries, {self._size} bytes, "
+                     f"{self.hits} hits and {self.misses} misses")
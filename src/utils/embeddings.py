@@ -0,0 +1,321 @@
+import hashlib
+import importlib
+import logging
+import os
+import threading
+import zlib
+from abc import ABC, abstractmethod
+from typing import TYPE_CHECKING, List, Optional
+
+from pymongo import UpdateOne, errors as pymongo_errors
+
+from src.utils.chunk_record import ChunkRecord
+from src.utils.disk_cache import DiskCache
+from src.utils.metrics import increment, timer
+from src.utils.profiling import profiled_stage
+
+# NumPy is imported in the functions that use it, so importing this module does not load it when the stage is disabled
+if TYPE_CHECKING:
+    import numpy as np
+
+# Embed the chunks inserted into the database (and those left without a vector by a previous run)
+EMBEDDINGS_ENABLED = os.environ.get('EMBEDDINGS_ENABLED', 'false').lower() == 'true'
+# Embedding backend: 'hashing' (deterministic local feature hashing model) or the 'module:attribute' path of a
+# callable that returns an EmbeddingBackend
+EMBEDDING_BACKEND = os.environ.get('EMBEDDING_BACKEND', 'hashing')
+# Dimensions of the vectors of the hashing backend
+EMBEDDING_DIMENSIONS = int(os.environ.get('EMBEDDING_DIMENSIONS', 256))
+# Maximum number of chunks sent to the backend in each request
+EMBEDDING_BATCH_SIZE = int(os.environ.get('EMBEDDING_BATCH_SIZE', 64))
+# Enable the persistent cache of the vectors, keyed by the model and the digest of the embedded text
+EMBEDDING_CACHE_ENABLED = os.environ.get('EMBEDDING_CACHE_ENABLED', 'true').lower() == 'true'
+# Directory of the cache (only /tmp is writable in AWS Lambda)
+EMBEDDING_CACHE_DIR = os.environ.get('EMBEDDING_CACHE_DIR', '/tmp/airzone_cache/embeddings' if os.environ.get(
+    'DEPLOYMENT_OPTION') == 'LAMBDA' else '.cache/embeddings')
+# Maximum size of the cache, in megabytes (smaller in AWS Lambda, see HTTP_CACHE_MAX_MB)
+EMBEDDING_CACHE_MAX_MB = int(os.environ.get('EMBEDDING_CACHE_MAX_MB', 32 if os.environ.get(
+    'DEPLOYMENT_OPTION') == 'LAMBDA' else 256))
+
+# The vectors are stored in the chunk documents, as the raw bytes of a float32 array, next to the model that computed
+# them
+EMBEDDING_FIELD = 'embedding'
+EMBEDDING_MODEL_FIELD = 'embedding_model'
+
+_backend = None
+_embedding_cache = None
+_embeddings_lock = threading.Lock()
+
+
+class EmbeddingBackend(ABC):
+    """
+    Model that converts texts into vectors. The model_id identifies the model and its parameters: the vectors of
+    different models are never mixed, in the cache or in the database.
+    """
+    model_id = None
+
+    @abstractmethod
+    def embed(self, texts: List[str]) -> 'np.ndarray':
+        """
+        Compute the vectors of a batch of texts.
+        :param texts: texts to embed
+        :return: float32 array with a row per text
+        """
+
+
+class HashingEmbeddingBackend(EmbeddingBackend):
+    """
+    Deterministic local model: the words and word pairs of each text are hashed into a signed bag of features, which is
+    normalised to unit length. It needs neither a network nor a model download, so it serves the tests and the
+    benchmarks, and the vectors of texts sharing many words are close.
+    """
+
+    def __init__(self, dimensions: int = EMBEDDING_DIMENSIONS):
+        """
+        :param dimensions: dimensions of the vectors
+        """
+        self.dimensions = dimensions
+        self.model_id = f"hashing-{dimensions}"
+
+    def embed(self, texts: List[str]) -> 'np.ndarray':
+        import numpy as np
+
+        vectors = np.zeros((len(texts), self.dimensions), dtype=np.float32)
+        for row, text in enumerate(texts):
+            words = text.lower().split()
+            features = words + [f"{first} {second}" for first, second in zip(words, words[1:])]
+            if not features:
+                continue
+            hashes = np.fromiter((zlib.crc32(feature.encode('utf-8')) for feature in features), dtype=np.int64,
+                                 count=len(features))
+            # The lowest bit of each hash is its sign and the rest its dimension
+            vectors[row] = np.bincount((hashes >> 1) % self.dimensions, weights=1 - 2 * (hashes & 1),
+                                       minlength=self.dimensions)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.where(norms > 0, norms, 1)
+
+
+# Backends that can be selected by name with EMBEDDING_BACKEND
+EMBEDDING_BACKENDS = {'hashing': HashingEmbeddingBackend}
+
+
+def load_embedding_backend(name: str) -> EmbeddingBackend:
+    """
+    Create an embedding backend from its name or from the 'module:attribute' path of a callable that returns it.
+    :param name: backend name or path
+    :return: EmbeddingBackend object
+    """
+    if name in EMBEDDING_BACKENDS:
+        return EMBEDDING_BACKENDS[name]()
+    module_name, _, attribute = name.partition(':')
+    if not attribute:
+        raise ValueError(f"Unknown embedding backend '{name}'")
+    return getattr(importlib.import_module(module_name), attribute)()
+
+
+class EmbeddingCache:
+    """
+    Content-addressed cache of the vectors. Each entry is keyed by the model and the digest of the embedded text, so a
+    chunk whose text was already embedded (e.g. a chunk re-inserted with a new hash_id, or the same text in two
+    sources) is not sent to the backend again.
+    """
+
+    def __init__(self, directory: str, max_bytes: int):
+        """
+        :param directory: directory where the cache is stored
+        :param max_bytes: maximum size of the cache, in bytes
+        """
+        self.store = DiskCache(directory, max_bytes)
+
+    @staticmethod
+    def key(model_id: str, text: str) -> str:
+        """
+        Get the cache key of the vector of a text.
+        :param model_id: model of the vector
+        :param text: embedded text
+        :return: cache key
+        """
+        return f"{model_id}|sha256:{hashlib.sha256(text.encode('utf-8')).hexdigest()}"
+
+    def get(self, key: str) -> Optional[bytes]:
+        """
+        Get a cached vector.
+        :param key: cache key
+        :return: bytes of the float32 vector, or None if it is not cached
+        """
+        cached = self.store.get(key)
+        return cached[0] if cached is not None else None
+
+    def set(self, key: str, vector: bytes) -> None:
+        """
+        Store a vector.
+        :param key: cache key
+        :param vector: bytes of the float32 vector
+        """
+        self.store.set(key, vector)
+
+    def flush(self) -> None:
+        """
+        Persist the cache index to disk.
+        """
+        self.store.flush()
+
+
+def get_embedding_backend() -> Optional[EmbeddingBackend]:
+    """
+    Get the embedding backend, creating it on first use.
+    :return: EmbeddingBackend object, or None if the stage is disabled
+    """
+    global _backend
+    with _embeddings_lock:
+        if EMBEDDINGS_ENABLED and _backend is None:
+            _backend = load_embedding_backend(EMBEDDING_BACKEND)
+    return _backend
+
+
+def get_embedding_cache() -> Optional[EmbeddingCache]:
+    """
+    Get the vector cache, creating it on first use.
+    :return: EmbeddingCache object, or None if the cache is disabled
+    """
+    global _embedding_cache
+    with _embeddings_lock:
+        if EMBEDDING_CACHE_ENABLED and _embedding_cache is None:
+            _embedding_cache = EmbeddingCache(EMBEDDING_CACHE_DIR, EMBEDDING_CACHE_MAX_MB * 1024 * 1024)
+    return _embedding_cache
+
+
+def flush_embedding_cache() -> None:
+    """
+    Persist the vector cache to disk, if it has been used.
+    """
+    if _embedding_cache is not None:
+        _embedding_cache.flush()
+
+
+def get_embedding_text(record: ChunkRecord) -> str:
+    """
+    Get the text embedded for a chunk: its title followed by its text.
+    :param record: ChunkRecord object
+    :return: text to embed
+    """
+    return f"{record.title}\n{record.description}"
+
+
+class ChunkEmbedder:
+    """
+    Incremental embedding stage of a collection. The chunks inserted by a DocumentSync are queued and embedded in
+    batches, and their vectors are written into their documents, so the embedding cost is proportional to the chunks
+    that changed and not to the size of the corpus. The vectors of the removed chunks are removed with their documents.
+    """
+
+    def __init__(self, collection, backend: EmbeddingBackend, cache: Optional[EmbeddingCache] = None,
+                 batch_size: int = EMBEDDING_BATCH_SIZE):
+        """
+        :param collection: database collection object
+        :param backend: embedding backend
+        :param cache: vector cache (None to always call the backend)
+        :param batch_size: maximum number of chunks sent to the backend in each request
+        """
+        self.collection = collection
+        self.backend = backend
+        self.cache = cache
+        self.batch_size = batch_size
+        self.stats = {'embedded': 0, 'cached': 0, 'failed': 0}
+        # Source and hash_id of the chunks whose vectors were written
+        self.embedded_keys = set()
+        self._pending = []
+
+    def add(self, record: ChunkRecord) -> None:
+        """
+        Queue an inserted chunk, embedding the queued chunks if the batch is full.
+        :param record: ChunkRecord object
+        """
+        self._pending.append((record.source, record.hash_id, get_embedding_text(record)))
+        if len(self._pending) >= self.batch_size:
+            self.flush()
+
+    def add_missing(self, source: str) -> None:
+        """
+        Queue the chunks of a source stored without a vector of the current model, e.g. because the backend failed
+        in a previous run or the model has changed. The query is served by the 'source' and 'embedding_model' index
+        (see ensure_indexes), which only reads the entries of those chunks.
+        :param source: source name
+        """
+        try:
+            cursor = self.collection.find({'source': source, 'description': {'$exists': True},
+                                           EMBEDDING_MODEL_FIELD: {'$ne': self.backend.model_id}},
+                                          {'_id': 0, 'hash_id': 1, 'title': 1, 'description': 1})
+            for row in cursor:
+                self._pending.append((source, row['hash_id'], f"{row.get('title')}\n{row['description']}"))
+                if len(self._pending) >= self.batch_size:
+                    self.flush()
+        except pymongo_errors.PyMongoError as e:
+            logging.error(f"Failed to find the chunks of '{source}' without a vector: {e}")
+
+    def flush(self) -> None:
+        """
+        Embed the queued chunks and write their vectors into their documents. If the backend or the database fails,
+        the chunks are left without a vector and are embedded again in the next run.
+        """
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, []
+        try:
+            with timer('embed'):
+                vectors = self._embed([text for _, _, text in pending])
+            with timer('db_write'):
+                self.collection.bulk_write(
+                    [UpdateOne({'source': source, 'hash_id': hash_id},
+                               {'$set': {EMBEDDING_FIELD: vector, EMBEDDING_MODEL_FIELD: self.backend.model_id}})
+                     for (source, hash_id, _), vector in zip(pending, vectors)], ordered=False)
+            self.embedded_keys.update((source, hash_id) for source, hash_id, _ in pending)
+        except Exception as e:
+            logging.error(f"Failed to embed {len(pending)} chunks of the '{self.collection.name}' collection: {e}")
+            self.stats['failed'] += len(pending)
+
+    @profiled_stage('embed')
+    def _embed(self, texts: List[str]) -> List[bytes]:
+        # The texts are looked up in the cache, and the missing ones (once per distinct text) are sent to the backend
+        model_id = self.backend.model_id
+        keys = [EmbeddingCache.key(model_id, text) for text in texts]
+        vectors = {}
+        if self.cache is not None:
+            for key in dict.fromkeys(keys):
+                vector = self.cache.get(key)
+                if vector is not None:
+                    vectors[key] = vector
+        missing = {key: text for key, text in zip(keys, texts) if key not in vectors}
+        self.stats['cached'] += len(texts) - sum(1 for key in keys if key in missing)
+        if missing:
+            embedded = self.backend.embed(list(missing.values())).astype('float32', copy=False)
+            for key, vector in zip(missing, embedded):
+                vectors[key] = vector.tobytes()
+                if self.cache is not None:
+                    self.cache.set(key, vectors[key])
+        self.stats['embedded'] += len(texts)
+        return [vectors[key] for key in keys]
+
+    def finish(self) -> dict:
+        """
+        Embed the last queued chunks.
+        :return: dictionary with the number of embedded chunks, those whose vector was cached and those that failed
+        """
+        self.flush()
+        for key, value in self.stats.items():
+            increment(f"embeddings_{key}", value)
+        if any(self.stats.values()):
+            logging.info(f"{self.stats['embedded']} chunks of the '{self.collection.name}' collection were embedded "
+                         f"({self.stats['cached']} vectors were cached and {self.stats['failed']} chunks failed)")
+        return self.stats
+
+
+def create_chunk_embedder(collection) -> Optional[ChunkEmbedder]:
+    """
+    Create the embedding stage of a collection, if it is enabled.
+    :param collection: database collection object
+    :return: ChunkEmbedder object, or None if the stage is disabled
+    """
+    backend = get_embedding_backend()
+    if backend is None:
+        return None
+    return ChunkEmbedder(collection, backend, get_embedding_cache())
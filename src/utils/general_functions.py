@@ -1,16 +1,50 @@
+import asyncio
 import concurrent
+import contextvars
 import hashlib
+import json
 import logging
+import multiprocessing
 import os
-import tempfile
-from typing import List
-import fitz
-import requests
-import yaml
-from concurrent.futures import ThreadPoolExecutor
-from bs4 import BeautifulSoup
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from pymongo import errors as pymongo_errors
+import random
+import time
+from functools import lru_cache
+from typing import TYPE_CHECKING, Iterable, Iterator, List
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from src.utils.http_cache import get_cache_key
+from src.utils.metrics import increment, record_time, timed_call, timer
+from src.utils.pdf_cache import get_pdf_text_cache
+from src.utils.profiling import profiled_stage, profiling_stages_enabled
+
+# The heavy dependencies (aiohttp, BeautifulSoup, langchain, PyMuPDF and PyYAML) are imported in the functions that use
+# them, so importing this module (e.g. in a Lambda cold start or in a PDF extraction worker) does not load all of them
+if TYPE_CHECKING:
+    import aiohttp
+    from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+# Base URLs of the Airzone API and the Myzone website, which can be pointed to a stand-in server (e.g. in load tests)
+AIRZONE_API_URL = os.environ.get('AIRZONE_API_URL', 'https://api.airzonecloud.com').rstrip('/')
+MYZONE_URL = os.environ.get('MYZONE_URL', 'https://myzone.airzone.es').rstrip('/')
+# Number of threads downloading PDFs (I/O-bound stage)
+PDF_DOWNLOAD_WORKERS = int(os.environ.get('PDF_DOWNLOAD_WORKERS', 8))
+# Maximum number of PDFs being downloaded or extracted at the same time (bounds the PDF contents kept in memory)
+PDF_MAX_IN_FLIGHT = int(os.environ.get('PDF_MAX_IN_FLIGHT', 2 * PDF_DOWNLOAD_WORKERS))
+# Limits of the aiohttp connection pool: total connections and connections to the same host
+HTTP_MAX_CONNECTIONS = int(os.environ.get('HTTP_MAX_CONNECTIONS', 30))
+HTTP_MAX_CONNECTIONS_PER_HOST = int(os.environ.get('HTTP_MAX_CONNECTIONS_PER_HOST', 10))
+# Seconds an idle keep-alive connection is kept in the pool
+HTTP_KEEPALIVE_TIMEOUT = float(os.environ.get('HTTP_KEEPALIVE_TIMEOUT', 30))
+# Timeout of each request, in seconds
+HTTP_REQUEST_TIMEOUT = float(os.environ.get('HTTP_REQUEST_TIMEOUT', 60))
+# Retries of a failed request, and base delay (in seconds) of the exponential backoff between them
+HTTP_MAX_RETRIES = int(os.environ.get('HTTP_MAX_RETRIES', 3))
+HTTP_RETRY_BACKOFF = float(os.environ.get('HTTP_RETRY_BACKOFF', 0.5))
+RETRYABLE_STATUSES = (429, 500, 502, 503, 504)
+# Number of cores available to the process
+AVAILABLE_CPUS = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count() or 1
+# Number of workers extracting the text of the PDFs (CPU-bound stage), one per available core by default
+PDF_EXTRACTION_WORKERS = int(os.environ.get('PDF_EXTRACTION_WORKERS', AVAILABLE_CPUS))
 
 
 def remove_html_tags(text: str) -> str:
@@ -19,74 +53,138 @@ def remove_html_tags(text: str) -> str:
     :param text: text to clean
     :return: cleaned text
     """
+    from bs4 import BeautifulSoup
+
     soup = BeautifulSoup(text, "html.parser")
     cleaned_text = soup.get_text()
     return cleaned_text
 
 
-async def fetch(session, url, output_format='text') -> str:
+def create_client_session(**kwargs) -> 'aiohttp.ClientSession':
+    """
+    Create an aiohttp session with a bounded keep-alive connection pool and a timeout for each request.
+    :param kwargs: additional arguments of the session (e.g. headers)
+    :return: aiohttp session
+    """
+    import aiohttp
+
+    connector = aiohttp.TCPConnector(limit=HTTP_MAX_CONNECTIONS, limit_per_host=HTTP_MAX_CONNECTIONS_PER_HOST,
+                                     keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT, ttl_dns_cache=300)
+    timeout = aiohttp.ClientTimeout(total=HTTP_REQUEST_TIMEOUT)
+    return aiohttp.ClientSession(connector=connector, timeout=timeout, **kwargs)
+
+
+async def with_retries(request_function, url):
+    """
+    Run an async request function, retrying it with exponential backoff and full jitter when the request fails with a
+    connection error, a timeout or a retryable status code (429 and 5xx).
+    :param request_function: coroutine function without arguments that sends the request
+    :param url: URL of the request (only used in the logs)
+    :return: result of the request function
+    """
+    import aiohttp
+
+    for attempt in range(HTTP_MAX_RETRIES + 1):
+        try:
+            return await request_function()
+        except (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError, asyncio.TimeoutError) as e:
+            error = e
+        except aiohttp.ClientResponseError as e:
+            if e.status not in RETRYABLE_STATUSES:
+                raise
+            error = e
+        if attempt == HTTP_MAX_RETRIES:
+            raise error
+        increment('retries')
+        delay = random.uniform(0, HTTP_RETRY_BACKOFF * 2 ** attempt)
+        logging.warning(f"Request to {url} failed ({type(error).__name__}: {error}), retrying in {delay:.2f} seconds...")
+        await asyncio.sleep(delay)
+
+
+def raise_for_retryable_status(response) -> None:
+    """
+    Raise an aiohttp.ClientResponseError if the response has a retryable status code (429 and 5xx).
+    :param response: aiohttp response
+    """
+    if response.status in RETRYABLE_STATUSES:
+        response.raise_for_status()
+
+
+async def fetch(session, url, output_format='text', params=None) -> str:
     """
     Async function to fetch the response for a given URL.
     :param session: aiohttp session
     :param url: URL to fetch
     :param output_format: output format of the response (text or json)
+    :param params: query string parameters of the request
     """
-    async with session.get(url) as response:
-        if output_format == 'text':
-            return await response.text()
-        elif output_format == 'json':
-            return await response.json()
-        else:
-            raise ValueError("Invalid output format")
+    if output_format not in ('text', 'json'):
+        raise ValueError("Invalid output format")
 
+    async def request():
+        async with session.get(url, params=params) as response:
+            increment('requests')
+            raise_for_retryable_status(response)
+            body = await response.read()
+            increment('bytes', len(body))
+            text = body.decode(response.get_encoding())
+            return text if output_format == 'text' else json.loads(text)
 
-def calculate_hash(concatenated_string) -> str:
-    """
-    Calculate the SHA256 hash for a given string.
-    :param concatenated_string: string to calculate the hash
-    :return: SHA256 hash
-    """
-    sha256_hash = hashlib.sha256(concatenated_string.encode('utf-8')).hexdigest()
-    return sha256_hash
+    with timer('fetch'):
+        return await with_retries(request, url)
 
 
-def insert_df_into_db(collection, df) -> None:
+async def fetch_cached(session, url, cache, output_format='text', params=None) -> tuple:
     """
-    Insert a DataFrame into a given collection in the MongoDB database. Only the documents that do not exist in the
-    collection will be inserted, and those that already exist and are not in the dataframe will be removed
-    :param collection: database collection object
-    :param df: pandas Dataframe
+    Async function to fetch the response for a given URL with a conditional request, using the HTTP cache.
+    :param session: aiohttp session
+    :param url: URL to fetch
+    :param cache: HttpCache object (if None, the URL is fetched without cache)
+    :param output_format: output format of the response (text or json)
+    :param params: query string parameters of the request
+    :return: tuple with the response and a boolean that is True if the response was not modified since the last run
     """
-    try:
-        source = df['source'][0]
-        # Remove duplicate values from the dataframe with the same 'hash_id'
-        df.drop_duplicates(subset='hash_id', keep='first', inplace=True)
+    if output_format not in ('text', 'json'):
+        raise ValueError("Invalid output format")
+    if cache is None:
+        return await fetch(session, url, output_format, params), False
 
-        # Get the existing hash IDs from the 'Support' collection in the database
-        db_hash_ids = collection.distinct('hash_id')
+    cache_key = get_cache_key(url, params)
 
-        # Remove rows in the DataFrame that already exist in the database
-        rows_to_insert = df[~df['hash_id'].isin(db_hash_ids)]
+    async def request():
+        async with session.get(url, params=params, headers=cache.conditional_headers(cache_key)) as response:
+            increment('requests')
+            if response.status == 304:
+                increment('cache_hits')
+                body = cache.get_response(cache_key)
+                # The cached bodies are always UTF-8 encoded (Myzone pages and Airzone API payloads)
+                return body.decode('utf-8') if body is not None else None, True
+            response.raise_for_status()
+            body = await response.read()
+            increment('bytes', len(body))
+            cache.save_response(cache_key, response.headers, body)
+            return body.decode(response.get_encoding()), False
 
-        # Insert the new rows into the database
-        if not rows_to_insert.empty:
-            documents_to_insert = rows_to_insert.to_dict(orient='records')
-            collection.insert_many(documents_to_insert)
+    with timer('fetch'):
+        text, not_modified = await with_retries(request, url)
 
-        # Remove from the database the documents that are not in the DataFrame
-        rows_to_remove = collection.find({'source': source, 'hash_id': {'$nin': df['hash_id'].to_list()}})
-        if rows_to_remove:
-            for row in rows_to_remove:
-                collection.delete_one({'_id': row['_id']})
+    # The cached body was evicted, so the page is fetched again without conditional headers
+    if text is None:
+        return await fetch(session, url, output_format, params), False
 
-        logging.info(
-            f"Process finished successfully. {len(list(rows_to_remove))} rows were removed and {len(rows_to_insert)} new "
-            f"rows were inserted into the '{collection.name}' collection")
+    return (json.loads(text) if output_format == 'json' else text), not_modified
 
-    except pymongo_errors.PyMongoError as e:
-        logging.info(f"Failed to insert documents into '{collection.name}' collection: {e}")
-    except Exception as e:
-        raise e
+
+def calculate_hash(concatenated_string) -> str:
+    """
+    Calculate the SHA256 hash for a given string.
+    :param concatenated_string: string to calculate the hash
+    :return: SHA256 hash
+    """
+    start = time.perf_counter()
+    sha256_hash = hashlib.sha256(concatenated_string.encode('utf-8')).hexdigest()
+    record_time('hash', time.perf_counter() - start)
+    return sha256_hash
 
 
 def setup_logging() -> None:
@@ -96,6 +194,8 @@ def setup_logging() -> None:
     if os.environ.get('DEPLOYMENT_OPTION') == 'LAMBDA':
         logging.getLogger().setLevel(logging.INFO)
     else:
+        import yaml
+
         with open('src/utils/logger_config.yaml', 'r') as config_file:
             config = yaml.safe_load(config_file)
         # Configure the logging system
@@ -104,61 +204,185 @@ def setup_logging() -> None:
         logger = logging.getLogger(__name__)
 
 
-def extract_text_from_pdf(pdf) -> tuple:
+@profiled_stage('pdf_extraction')
+def extract_text_from_pdf_bytes(content: bytes) -> str:
+    """
+    Extract the text of a PDF directly from its content in memory.
+    :param content: content of the PDF
+    :return: extracted text
+    """
+    import fitz
+
+    with fitz.open(stream=content, filetype='pdf') as pdf_document:
+        # Iterate through all the pages and extract text
+        return ''.join(page.get_text() for page in pdf_document)
+
+
+def download_pdf(pdf, cache=None) -> tuple:
+    """
+    Download a PDF given its URL, unless its text is already cached.
+    :param pdf: tuple with the title and the URL of the PDF
+    :param cache: PdfTextCache object used to skip the download and parsing of unchanged PDFs
+    :return: tuple with the title, the URL, the content of the PDF (None if it was not downloaded), the cached text
+    (None if it is not cached) and the cache key of the PDF
+    """
+    from src.utils.connections import get_http_session
+
+    title, url = pdf
+    # The PDFs are downloaded without the API headers, through a pooled session reused by the next invocations
+    session = get_http_session('downloads', cached=False)
+    cache_key = None
+    if cache is not None:
+        # Identify the PDF content by its headers, so an unchanged PDF is not even downloaded
+        head_response = session.head(url, allow_redirects=True)
+        if head_response.ok:
+            cache_key = cache.header_key(url, head_response.headers)
+        if cache_key is not None:
+            text = cache.get(cache_key)
+            if text is not None:
+                increment('cache_hits')
+                return title, url, None, text, cache_key
+
+    logging.info(f"Downloading PDF: {url}")
+    response = session.get(url)
+    response.raise_for_status()
+
+    if cache is not None and cache_key is None:
+        # The server did not identify the content, so the PDF is identified by its digest instead
+        cache_key = cache.content_key(url, response.content)
+        text = cache.get(cache_key)
+        if text is not None:
+            increment('cache_hits')
+            return title, url, None, text, cache_key
+
+    return title, url, response.content, None, cache_key
+
+
+def extract_text_from_pdf(pdf, cache=None) -> tuple:
     """
     Extract text from a PDF given its URL.
     :param pdf: tuple with the title and the URL of the PDF
+    :param cache: PdfTextCache object used to skip the download and parsing of unchanged PDFs
     :return: tuple with the title and the extracted text
     """
-    title = pdf[1]
-    url = pdf[2]
+    title, url = pdf
     try:
-        logging.info(f"Extracting text from PDF: {url}")
-        # Download the PDF content
-        response = requests.get(url)
-        response.raise_for_status()
-
-        # Creation of a temporary file to store the pdf
-        with tempfile.NamedTemporaryFile(delete=False) as temp_file:
-            temp_file.write(response.content)
-            temp_file_path = temp_file.name
-
-        with fitz.open(temp_file_path) as pdf_document:
-            text = ""
-            # Iterate through all the pages and extract text
-            for page_number in range(len(pdf_document)):
-                page = pdf_document.load_page(page_number)
-                text += page.get_text()
+        title, url, content, text, cache_key = download_pdf(pdf, cache)
+        if text is None:
+            logging.info(f"Extracting text from PDF: {url}")
+            text = extract_text_from_pdf_bytes(content)
+            if cache is not None:
+                cache.set(cache_key, text)
 
         return title, url, text
 
     except Exception as e:
         logging.error(f"An error occurred while extracting text from PDF {url}: {e}")
         return title, url, ""
-    finally:
-        # Remove temporary file
-        if os.path.exists(temp_file_path):
-            os.remove(temp_file_path)
 
 
-def extract_text_from_pdfs_parallel(pdf_df) -> List[str]:
+def create_cpu_executor(max_workers: int, use_processes: bool = True) -> concurrent.futures.Executor:
     """
-    Extract text from multiple PDFs in parallel using ThreadPoolExecutor.
-    :param pdf_df: dataframe with the title and the URL of the PDFs
-    :return: list with the extracted text of each PDF
+    Create the executor of a CPU-bound stage. A process pool is used so the work is not serialised by the GIL, except
+    in AWS Lambda, where there is no /dev/shm for the process pool synchronisation, with a single worker, or when the
+    stages are being profiled (the profiles of the worker processes would be lost).
+    :param max_workers: number of workers
+    :param use_processes: use a process pool when it is available (a thread pool otherwise)
+    :return: executor
     """
-    extracted_texts = []
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        # Submit tasks for each PDF URL
-        futures = [executor.submit(extract_text_from_pdf, pdf) for pdf in pdf_df.itertuples()]
-        # Get results as they become available
-        for future in concurrent.futures.as_completed(futures):
-            try:
-                extracted_texts.append(future.result())
-            except Exception as e:
-                print(f"An error occurred: {e}")
+    if not use_processes or os.environ.get('DEPLOYMENT_OPTION') == 'LAMBDA' or max_workers == 1 or \
+            profiling_stages_enabled():
+        return ThreadPoolExecutor(max_workers=max_workers)
+    # The workers are spawned instead of forked, since the scrapers run in several threads
+    return ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context('spawn'))
 
-    return extracted_texts
+
+def submit_in_context(executor: concurrent.futures.Executor, function, *args) -> concurrent.futures.Future:
+    """
+    Submit a function to an executor. In a thread pool, the function runs in a copy of the current context, so its
+    metrics and profiles are attributed to the source of the caller.
+    :param executor: executor
+    :param function: function to run
+    :param args: arguments of the function
+    :return: future with the result of the function
+    """
+    if isinstance(executor, ThreadPoolExecutor):
+        return executor.submit(contextvars.copy_context().run, function, *args)
+    return executor.submit(function, *args)
+
+
+def run_in_executor(executor: concurrent.futures.Executor, function, *args) -> asyncio.Future:
+    """
+    Run a function in an executor from the event loop. In a thread pool, the function runs in a copy of the current
+    context, so its metrics are tagged with the source of the caller.
+    :param executor: executor
+    :param function: function to run
+    :param args: arguments of the function
+    :return: future with the result of the function
+    """
+    loop = asyncio.get_running_loop()
+    if isinstance(executor, ThreadPoolExecutor):
+        return loop.run_in_executor(executor, contextvars.copy_context().run, function, *args)
+    return loop.run_in_executor(executor, function, *args)
+
+
+def create_pdf_extraction_executor() -> concurrent.futures.Executor:
+    """
+    Create the executor of the CPU-bound PDF text extraction stage.
+    :return: executor
+    """
+    return create_cpu_executor(PDF_EXTRACTION_WORKERS)
+
+
+def iter_text_from_pdfs(pdfs: Iterable[tuple]) -> Iterator[tuple]:
+    """
+    Extract text from multiple PDFs in parallel, yielding each text as soon as it is available. The PDFs are downloaded
+    in a thread pool (I/O-bound stage) and, as soon as each download finishes, its text is extracted in a process pool
+    (CPU-bound stage). At most PDF_MAX_IN_FLIGHT PDFs are downloaded or extracted at the same time, so the memory used
+    does not depend on the number of PDFs.
+    :param pdfs: iterable of tuples with the title and the URL of each PDF
+    :return: generator of tuples with the title, the URL and the extracted text of each PDF (None if it failed)
+    """
+    cache = get_pdf_text_cache()
+    pdfs = iter(pdfs)
+    in_flight = {}
+    with ThreadPoolExecutor(max_workers=PDF_DOWNLOAD_WORKERS) as download_executor, \
+            create_pdf_extraction_executor() as extraction_executor:
+        while True:
+            # Submit the download tasks while there is room for more PDFs in flight
+            while len(in_flight) < PDF_MAX_IN_FLIGHT:
+                pdf = next(pdfs, None)
+                if pdf is None:
+                    break
+                in_flight[submit_in_context(download_executor, download_pdf, pdf, cache)] = ('download', pdf)
+            if not in_flight:
+                break
+
+            done, _ = concurrent.futures.wait(in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                stage, pdf = in_flight.pop(future)
+                title, url = pdf[:2]
+                try:
+                    if stage == 'download':
+                        title, url, content, text, cache_key = future.result()
+                        if text is None:
+                            # Submit the extraction task as soon as the download is available
+                            logging.info(f"Extracting text from PDF: {url}")
+                            in_flight[submit_in_context(extraction_executor, timed_call, extract_text_from_pdf_bytes,
+                                                        content)] = ('extraction', (title, url, cache_key))
+                            continue
+                    else:
+                        text, seconds = future.result()
+                        record_time('parse', seconds)
+                        if cache is not None:
+                            cache.set(pdf[2], text)
+                except Exception as e:
+                    logging.error(f"An error occurred while extracting text from PDF {url}: {e}")
+                    text = None
+                yield title, url, text
+
+    if cache is not None:
+        cache.flush()
 
 
 def find_missing_documents_in_db(db, collection_name, field_name, document_list) -> List[dict]:
@@ -178,14 +402,14 @@ def find_missing_documents_in_db(db, collection_name, field_name, document_list)
         # Query MongoDB and remove from the list the items that already exist in the database
         existing_documents = collection.find({field_name: {'$in': [d[field_name] for d in document_list]}})
 
-        existing_document_fields = [doc[field_name] for doc in existing_documents]
+        existing_document_fields = {doc[field_name] for doc in existing_documents}
 
         missing_documents = [d for d in document_list if d[field_name] not in existing_document_fields]
 
         return missing_documents
 
     except Exception as e:
-        print(f"An error occurred: {e}")
+        logging.warning(f"An error occurred: {e}")
         return []
 
 
@@ -216,6 +440,33 @@ def extract_json_text(obj) -> str:
     return clean_text
 
 
+@lru_cache(maxsize=None)
+def get_text_splitter(chunk_size: int, chunk_overlap: int) -> 'RecursiveCharacterTextSplitter':
+    """
+    Get the text splitter configured with the given parameters, creating it only the first time.
+    :param chunk_size: chunk size
+    :param chunk_overlap: chunk overlap size
+    :return: text splitter
+    """
+    from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+    return RecursiveCharacterTextSplitter(
+        chunk_size=chunk_size,
+        chunk_overlap=chunk_overlap,
+        length_function=len,
+    )
+
+
+def contains_markup(text: str) -> bool:
+    """
+    Check if a text has to go through the HTML parser to be cleaned. A text without tags or character references, and
+    with any non-whitespace character, is returned unchanged by the parser.
+    :param text: text to check
+    :return: True if the text has to be cleaned
+    """
+    return '<' in text or '&' in text or not text.strip()
+
+
 # Create a function to split a text into chunks using CharacterTextSplitter
 def split_text_into_chunks(text: str, chunk_size: int, chunk_overlap: int) -> List[str]:
     """
@@ -225,12 +476,25 @@ def split_text_into_chunks(text: str, chunk_size: int, chunk_overlap: int) -> Li
     :param chunk_size: chunk size
     :return: list of chunks
     """
-    clean_text = remove_html_tags(text)
-    text_splitter = RecursiveCharacterTextSplitter(
-        chunk_size=1000,
-        chunk_overlap=200,
-        length_function=len,
-    )
-    chunks = text_splitter.split_text(clean_text)
+    with timer('chunk'):
+        clean_text = remove_html_tags(text) if contains_markup(text) else text
+        text_splitter = get_text_splitter(chunk_size, chunk_overlap)
+        chunks = text_splitter.split_text(clean_text)
+    increment('chunks', len(chunks))
+
+    return chunks
 
+
+def split_texts_into_chunks(texts: Iterable[str], chunk_size: int, chunk_overlap: int) -> List[List[str]]:
+    """
+    Split a batch of texts into chunks with the same text splitter
+    :param texts: texts to split
+    :param chunk_size: chunk size
+    :param chunk_overlap: chunk overlap size
+    :return: list with the list of chunks of each text
+    """
+    with timer('chunk'):
+        text_splitter = get_text_splitter(chunk_size, chunk_overlap)
+        chunks = [text_splitter.split_text(remove_html_tags(text) if contains_markup(text) else text) for text in texts]
+    increment('chunks', sum(len(text_chunks) for text_chunks in chunks))
     return chunks
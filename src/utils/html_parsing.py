@@ -0,0 +1,72 @@
+import importlib.util
+import logging
+import os
+from typing import Optional
+
+from bs4 import BeautifulSoup, SoupStrainer
+
+# HTML parser used by BeautifulSoup: 'auto' (lxml if it is installed, html.parser otherwise), 'lxml' or 'html.parser'
+HTML_PARSER = os.environ.get('HTML_PARSER', 'auto')
+# Parse only the subtrees of the Myzone product pages that are used by the scraper
+HTML_PARTIAL_PARSING = os.environ.get('HTML_PARTIAL_PARSING', 'true').lower() == 'true'
+
+_parser_backend = None
+
+
+def get_parser_backend() -> str:
+    """
+    Get the HTML parser backend selected with the HTML_PARSER environment variable.
+    :return: name of the BeautifulSoup parser
+    """
+    global _parser_backend
+    if _parser_backend is None:
+        if HTML_PARSER == 'auto':
+            _parser_backend = 'lxml' if importlib.util.find_spec('lxml') is not None else 'html.parser'
+        else:
+            _parser_backend = HTML_PARSER
+        logging.info(f"Using the '{_parser_backend}' HTML parser")
+    return _parser_backend
+
+
+def is_product_page_subtree(name, attrs) -> bool:
+    """
+    Check if a tag of a Myzone product page is the root of a subtree used by the scraper: the description, the FAQ
+    questions (under 'div.row') and the FAQ and autodiagnosis answers ('div.m-b-lg').
+    :param name: tag name
+    :param attrs: tag attributes, as given by the tree builder
+    :return: True if the subtree has to be parsed
+    """
+    if name != 'div':
+        return False
+    if attrs.get('itemprop') == 'description':
+        return True
+    classes = attrs.get('class') or ''
+    if isinstance(classes, str):
+        classes = classes.split()
+    return 'row' in classes or 'm-b-lg' in classes
+
+
+PRODUCT_PAGE_STRAINER = SoupStrainer(is_product_page_subtree)
+
+
+def parse_html(markup: str, parse_only: Optional[SoupStrainer] = None, backend: Optional[str] = None) -> BeautifulSoup:
+    """
+    Parse an HTML document with the selected parser backend.
+    :param markup: HTML document
+    :param parse_only: strainer with the subtrees to parse (the whole document is parsed if None)
+    :param backend: parser backend (the one selected with HTML_PARSER if None)
+    :return: BeautifulSoup object
+    """
+    return BeautifulSoup(markup, backend or get_parser_backend(), parse_only=parse_only)
+
+
+def parse_product_page_html(markup: str, partial: bool = HTML_PARTIAL_PARSING,
+                            backend: Optional[str] = None) -> BeautifulSoup:
+    """
+    Parse a Myzone product page, keeping only the subtrees used by the scraper if partial parsing is enabled.
+    :param markup: HTML document
+    :param partial: parse only the subtrees used by the scraper
+    :param backend: parser backend (the one selected with HTML_PARSER if None)
+    :return: BeautifulSoup object
+    """
+    return parse_html(markup, PRODUCT_PAGE_STRAINER if partial else None, backend)
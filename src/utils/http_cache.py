@@ -0,0 +1,210 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+from typing import Optional
+
+from requests.adapters import HTTPAdapter
+from yarl import URL
+
+from src.utils.disk_cache import DiskCache
+
+# Enable the on-disk HTTP conditional-request cache
+HTTP_CACHE_ENABLED = os.environ.get('HTTP_CACHE_ENABLED', 'true').lower() == 'true'
+# Directory of the cache (only /tmp is writable in AWS Lambda)
+HTTP_CACHE_DIR = os.environ.get('HTTP_CACHE_DIR', '/tmp/airzone_cache/http' if os.environ.get(
+    'DEPLOYMENT_OPTION') == 'LAMBDA' else '.cache/http')
+# Maximum size of the cache, in megabytes (in AWS Lambda, the HTTP, PDF and embedding caches use less than half of the
+# default 512 MB of ephemeral storage, which they share with the vector index)
+HTTP_CACHE_MAX_MB = int(os.environ.get('HTTP_CACHE_MAX_MB', 128 if os.environ.get(
+    'DEPLOYMENT_OPTION') == 'LAMBDA' else 512))
+# Version of the processing of the pages into derived results: it has to be increased when a change of the code (e.g. of
+# the text normalizer) changes the derived results of an unchanged body, so the results of the previous runs are not
+# reused
+DERIVED_RESULTS_VERSION = 1
+
+_http_cache = None
+_http_cache_lock = threading.Lock()
+
+
+class HttpCache:
+    """
+    Conditional-request cache shared by the requests and aiohttp clients. It stores the body of each response together
+    with its ETag/Last-Modified headers and the body digest, so the next request for the same URL can be sent as a
+    conditional request. Results derived from a body (e.g. its chunks) can also be stored, and are only returned while
+    the body digest and the version of the processing that derived them do not change.
+    """
+
+    def __init__(self, directory: str, max_bytes: int):
+        """
+        :param directory: directory where the cache is stored
+        :param max_bytes: maximum size of the cache, in bytes
+        """
+        self.store = DiskCache(directory, max_bytes)
+        self.not_modified = 0
+
+    def conditional_headers(self, url: str) -> dict:
+        """
+        Get the conditional request headers for a given URL.
+        :param url: URL of the request, including the query string
+        :return: dictionary with the If-None-Match/If-Modified-Since headers
+        """
+        metadata = self.store.get_metadata(url)
+        headers = {}
+        if metadata is not None:
+            if metadata.get('etag'):
+                headers['If-None-Match'] = metadata['etag']
+            if metadata.get('last_modified'):
+                headers['If-Modified-Since'] = metadata['last_modified']
+        return headers
+
+    def save_response(self, url: str, headers, body: bytes) -> None:
+        """
+        Store a response body if it can be validated with a conditional request.
+        :param url: URL of the request, including the query string
+        :param headers: response headers
+        :param body: response body
+        """
+        etag = headers.get('ETag')
+        last_modified = headers.get('Last-Modified')
+        if etag or last_modified:
+            metadata = {'etag': etag, 'last_modified': last_modified, 'digest': hashlib.sha256(body).hexdigest()}
+            self.store.set(url, body, metadata)
+
+    def get_response(self, url: str) -> Optional[bytes]:
+        """
+        Get the cached body of a URL after a "304 Not Modified" response.
+        :param url: URL of the request, including the query string
+        :return: cached body, or None if it is not cached
+        """
+        cached = self.store.get(url)
+        if cached is None:
+            return None
+        self.not_modified += 1
+        return cached[0]
+
+    def get_derived(self, url: str, version: str):
+        """
+        Get the result derived from the current cached body of a URL.
+        :param url: URL of the request, including the query string
+        :param version: version of the processing of the body (see processing_version)
+        :return: derived result, or None if it is not cached, the body has changed or it was derived by another version
+        """
+        metadata = self.store.get_metadata(url)
+        derived_metadata = self.store.get_metadata(f"derived:{url}")
+        if metadata is None or derived_metadata is None or derived_metadata.get('digest') != metadata.get('digest') \
+                or derived_metadata.get('version') != version:
+            return None
+        cached = self.store.get(f"derived:{url}")
+        return json.loads(cached[0]) if cached is not None else None
+
+    def set_derived(self, url: str, value, version: str) -> None:
+        """
+        Store a result derived from the current cached body of a URL.
+        :param url: URL of the request, including the query string
+        :param value: JSON serialisable result
+        :param version: version of the processing of the body (see processing_version)
+        """
+        metadata = self.store.get_metadata(url)
+        if metadata is not None:
+            self.store.set(f"derived:{url}", json.dumps(value).encode('utf-8'),
+                           {'digest': metadata.get('digest'), 'version': version})
+
+    def flush(self) -> None:
+        """
+        Persist the cache index to disk.
+        """
+        logging.info(f"{self.not_modified} HTTP responses were not modified since the last run")
+        self.store.flush()
+
+
+class CachingHTTPAdapter(HTTPAdapter):
+    """
+    requests transport adapter that sends conditional GET requests using an HttpCache. A "304 Not Modified" response
+    is replaced by the cached body with a 200 status code, and every response gets a 'not_modified' attribute.
+    """
+
+    def __init__(self, cache: HttpCache, **kwargs):
+        self.cache = cache
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        if request.method != 'GET':
+            return super().send(request, **kwargs)
+
+        conditional_headers = self.cache.conditional_headers(request.url)
+        request.headers.update(conditional_headers)
+        response = super().send(request, **kwargs)
+        response.not_modified = False
+
+        if response.status_code == 304:
+            body = self.cache.get_response(request.url)
+            if body is not None:
+                response.status_code = 200
+                response._content = body
+                response.not_modified = True
+                return response
+
+            # The cached body was evicted, so the request is sent again without the conditional headers
+            for header in conditional_headers:
+                del request.headers[header]
+            response = super().send(request, **kwargs)
+            response.not_modified = False
+
+        if response.status_code == 200:
+            self.cache.save_response(request.url, response.headers, response.content)
+
+        return response
+
+
+def get_cache_key(url: str, params: dict = None) -> str:
+    """
+    Get the cache key of a request, which is its URL including the query string.
+    :param url: URL of the request
+    :param params: query string parameters of the request
+    :return: cache key
+    """
+    return str(URL(url).update_query(params)) if params else url
+
+
+def processing_version(*parameters) -> str:
+    """
+    Get the version of the processing of the pages into derived results, which changes with DERIVED_RESULTS_VERSION
+    and with the parameters of the processing (e.g. the HTML parser, the text normalizer and the chunk sizes).
+    :param parameters: parameters of the processing, with a stable representation
+    :return: version string
+    """
+    return hashlib.sha256(repr((DERIVED_RESULTS_VERSION, parameters)).encode('utf-8')).hexdigest()[:16]
+
+
+def get_http_cache() -> Optional[HttpCache]:
+    """
+    Get the HTTP cache shared by all the scrapers, creating it on first use.
+    :return: HttpCache object, or None if the cache is disabled
+    """
+    global _http_cache
+    with _http_cache_lock:
+        if HTTP_CACHE_ENABLED and _http_cache is None:
+            _http_cache = HttpCache(HTTP_CACHE_DIR, HTTP_CACHE_MAX_MB * 1024 * 1024)
+    return _http_cache
+
+
+def mount_http_cache(session, **adapter_kwargs) -> None:
+    """
+    Mount the shared HTTP cache in a requests session.
+    :param session: requests session
+    :param adapter_kwargs: additional arguments of the transport adapters (e.g. the connection pool sizes)
+    """
+    cache = get_http_cache()
+    if cache is not None:
+        session.mount('https://', CachingHTTPAdapter(cache, **adapter_kwargs))
+        session.mount('http://', CachingHTTPAdapter(cache, **adapter_kwargs))
+
+
+def flush_http_cache() -> None:
+    """
+    Persist the shared HTTP cache to disk, if it has been used.
+    """
+    if _http_cache is not None:
+        _http_cache.flush()
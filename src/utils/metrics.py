@@ -0,0 +1,220 @@
+import contextvars
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager, nullcontext
+from typing import Optional
+
+# Record the per-stage timers and counters of the scrapers
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', 'true').lower() == 'true'
+# File of the summary of the last run (only /tmp is writable in AWS Lambda)
+METRICS_SUMMARY_PATH = os.environ.get('METRICS_SUMMARY_PATH', '/tmp/airzone_cache/metrics/run_summary.json' if
+                                      os.environ.get('DEPLOYMENT_OPTION') == 'LAMBDA' else
+                                      '.cache/metrics/run_summary.json')
+# CloudWatch namespace of the metrics emitted in the Embedded Metric Format (Lambda mode)
+METRICS_NAMESPACE = os.environ.get('METRICS_NAMESPACE', 'AirzoneScraper')
+
+# The scrapers time the 'fetch', 'parse', 'chunk', 'hash' and 'db_write' stages. The timers are inclusive: e.g. the
+# 'parse' stage of a page includes the 'chunk' and 'hash' stages of its chunks when they run inside the parsing
+UNATTRIBUTED_SOURCE = 'unattributed'
+
+# Source (scraper) of the metrics recorded by the current thread or asyncio task
+_current_source = contextvars.ContextVar('metrics_source', default=UNATTRIBUTED_SOURCE)
+
+
+class MetricsRegistry:
+    """
+    Timers and counters of a run, tagged by source. Each timer keeps the number of calls, the total and the maximum
+    seconds of its stage.
+    """
+
+    def __init__(self):
+        self.run_id = uuid.uuid4().hex
+        self.started_at = time.time()
+        self.timers = {}
+        self.counters = {}
+        self._lock = threading.Lock()
+
+    def record_time(self, source: str, stage: str, seconds: float) -> None:
+        with self._lock:
+            timer = self.timers.setdefault((source, stage), [0, 0.0, 0.0])
+            timer[0] += 1
+            timer[1] += seconds
+            timer[2] = max(timer[2], seconds)
+
+    def increment(self, source: str, counter: str, value: float) -> None:
+        with self._lock:
+            self.counters[(source, counter)] = self.counters.get((source, counter), 0) + value
+
+    def snapshot(self) -> dict:
+        """
+        Get the metrics of each source.
+        :return: dictionary with the timers and counters of each source
+        """
+        sources = {}
+        with self._lock:
+            for (source, stage), (count, total, maximum) in self.timers.items():
+                sources.setdefault(source, {'timers': {}, 'counters': {}})['timers'][stage] = {
+                    'count': count, 'total_seconds': round(total, 4), 'max_seconds': round(maximum, 4)}
+            for (source, counter), value in self.counters.items():
+                sources.setdefault(source, {'timers': {}, 'counters': {}})['counters'][counter] = value
+        return sources
+
+
+_registry = MetricsRegistry()
+
+
+@contextmanager
+def metrics_source(source: str):
+    """
+    Tag the metrics recorded inside the context (including the asyncio tasks and the threads started with
+    asyncio.to_thread) with a source.
+    :param source: source name
+    """
+    token = _current_source.set(source)
+    try:
+        yield
+    finally:
+        _current_source.reset(token)
+
+
+def get_current_source() -> str:
+    """
+    Get the source of the current context.
+    :return: source name
+    """
+    return _current_source.get()
+
+
+def record_time(stage: str, seconds: float, source: Optional[str] = None) -> None:
+    """
+    Record the duration of a stage.
+    :param stage: stage name
+    :param seconds: duration of the stage
+    :param source: source name (the source of the current context if None)
+    """
+    if METRICS_ENABLED:
+        _registry.record_time(source or _current_source.get(), stage, seconds)
+
+
+def increment(counter: str, value: float = 1, source: Optional[str] = None) -> None:
+    """
+    Increment a counter.
+    :param counter: counter name
+    :param value: increment
+    :param source: source name (the source of the current context if None)
+    """
+    if METRICS_ENABLED:
+        _registry.increment(source or _current_source.get(), counter, value)
+
+
+@contextmanager
+def _timer(stage: str, source: Optional[str]):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_time(stage, time.perf_counter() - start, source)
+
+
+def timer(stage: str, source: Optional[str] = None):
+    """
+    Context manager that records the duration of a stage.
+    :param stage: stage name
+    :param source: source name (the source of the current context if None)
+    :return: context manager
+    """
+    return _timer(stage, source) if METRICS_ENABLED else nullcontext()
+
+
+def timed_call(function, *args) -> tuple:
+    """
+    Call a function and measure its duration, so the caller can record it when the function runs in a worker process
+    (whose metrics are not recorded).
+    :param function: function to call (a module-level function, if it runs in a process pool)
+    :param args: arguments of the function
+    :return: tuple with the result of the function and its duration in seconds
+    """
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+
+def start_metrics_run() -> None:
+    """
+    Reset the metrics at the beginning of a run (the module outlives the warm Lambda invocations).
+    """
+    global _registry
+    _registry = MetricsRegistry()
+
+
+def get_metrics() -> dict:
+    """
+    Get the metrics of the current run.
+    :return: dictionary with the timers and counters of each source
+    """
+    return _registry.snapshot()
+
+
+def to_emf(source: str, metrics: dict, run_id: str) -> dict:
+    """
+    Convert the metrics of a source to the CloudWatch Embedded Metric Format.
+    :param source: source name
+    :param metrics: timers and counters of the source
+    :param run_id: run identifier
+    :return: EMF document
+    """
+    values = {f"{stage}_seconds": timer_metrics['total_seconds'] for stage, timer_metrics in metrics['timers'].items()}
+    definitions = [{'Name': name, 'Unit': 'Seconds'} for name in values]
+    values.update(metrics['counters'])
+    definitions += [{'Name': name, 'Unit': 'Bytes' if name.endswith('bytes') else 'Count'}
+                    for name in metrics['counters']]
+    return {'_aws': {'Timestamp': int(time.time() * 1000),
+                     'CloudWatchMetrics': [{'Namespace': METRICS_NAMESPACE, 'Dimensions': [['Source']],
+                                            'Metrics': definitions}]},
+            'Source': source, 'RunId': run_id, **values}
+
+
+def emit_metrics() -> None:
+    """
+    Emit the metrics of each source as a JSON line: in the CloudWatch Embedded Metric Format to the standard output in
+    Lambda (so CloudWatch extracts the metrics from the logs), and through the 'metrics' logger otherwise.
+    """
+    if not METRICS_ENABLED:
+        return
+    run_id = _registry.run_id
+    for source, metrics in get_metrics().items():
+        if os.environ.get('DEPLOYMENT_OPTION') == 'LAMBDA':
+            # The EMF documents must be whole log events, without the prefix of the Lambda log handler
+            print(json.dumps(to_emf(source, metrics, run_id)), flush=True)
+        else:
+            logging.getLogger('metrics').info(json.dumps({'run_id': run_id, 'source': source, **metrics}))
+
+
+def write_run_summary(scrapers: Optional[dict] = None, path: str = METRICS_SUMMARY_PATH) -> Optional[dict]:
+    """
+    Persist the summary of the run: the status and time of each scraper and the metrics of each source.
+    :param scrapers: dictionary with the status and wall-clock time of each scraper (as returned by run_scrapers)
+    :param path: file of the summary
+    :return: summary dictionary, or None if the metrics are disabled
+    """
+    if not METRICS_ENABLED:
+        return None
+    summary = {'run_id': _registry.run_id,
+               'started_at': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(_registry.started_at)),
+               'seconds': round(time.time() - _registry.started_at, 3), 'scrapers': scrapers or {},
+               'sources': get_metrics()}
+    try:
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        # Write to a temporary file first, so an interrupted run cannot leave a corrupted summary
+        temporary_path = f"{path}.tmp"
+        with open(temporary_path, 'w') as summary_file:
+            json.dump(summary, summary_file, indent=2)
+        os.replace(temporary_path, path)
+        logging.info(f"Run summary written to {path}")
+    except OSError as e:
+        logging.warning(f"Could not write the run summary to {path}: {e}")
+    return summary
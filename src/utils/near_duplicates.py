@@ -0,0 +1,328 @@
+import logging
+import os
+import threading
+import zlib
+from typing import TYPE_CHECKING, Optional, Tuple
+
+from pymongo import UpdateOne, errors as pymongo_errors
+
+from src.utils.chunk_record import ChunkRecord
+from src.utils.vector_index import record_vector_changes
+
+# NumPy is imported in the functions that use it, so importing this module does not load it when the stage is disabled
+if TYPE_CHECKING:
+    import numpy as np
+
+# Collapse the near-duplicate chunks of all the sources into a canonical document before they are written
+NEAR_DUPLICATES_ENABLED = os.environ.get('NEAR_DUPLICATES_ENABLED', 'false').lower() == 'true'
+# Estimated Jaccard similarity of the word shingles of two chunks above which they are near-duplicates
+NEAR_DUPLICATES_THRESHOLD = float(os.environ.get('NEAR_DUPLICATES_THRESHOLD', 0.85))
+# Number of hash functions of the MinHash signatures (more are slower, but estimate the similarity better)
+NEAR_DUPLICATES_PERMUTATIONS = int(os.environ.get('NEAR_DUPLICATES_PERMUTATIONS', 128))
+# Number of consecutive words of each shingle
+NEAR_DUPLICATES_SHINGLE_SIZE = int(os.environ.get('NEAR_DUPLICATES_SHINGLE_SIZE', 3))
+# Chunks with fewer words are never collapsed (e.g. a short answer shared by unrelated questions)
+NEAR_DUPLICATES_MIN_WORDS = int(os.environ.get('NEAR_DUPLICATES_MIN_WORDS', 12))
+
+# Prime modulus of the universal hash functions of the signatures (2^61 - 1)
+MERSENNE_PRIME = (1 << 61) - 1
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def lsh_parameters(threshold: float, num_perm: int) -> Tuple[int, int]:
+    """
+    Choose the number of bands and rows per band of the LSH index that minimise the probability of missing a pair
+    above the threshold plus the probability of checking a pair below it (both integrated over the similarity).
+    :param threshold: similarity threshold
+    :param num_perm: number of hash functions of the signatures
+    :return: tuple with the number of bands and the number of rows per band
+    """
+    def integrate(function, start: float, end: float, steps: int = 100) -> float:
+        width = (end - start) / steps
+        return sum(function(start + (step + 0.5) * width) for step in range(steps)) * width
+
+    best = None
+    for bands in range(1, num_perm + 1):
+        for rows in range(1, num_perm // bands + 1):
+            false_positives = integrate(lambda s: 1 - (1 - s ** rows) ** bands, 0, threshold)
+            false_negatives = integrate(lambda s: (1 - s ** rows) ** bands, threshold, 1)
+            if best is None or false_positives + false_negatives < best[0]:
+                best = (false_positives + false_negatives, bands, rows)
+    return best[1], best[2]
+
+
+class NearDuplicateIndex:
+    """
+    MinHash LSH index of the chunks written in a run. Of each group of near-duplicates (by the Jaccard similarity of
+    their word shingles, ignoring the titles), only the canonical chunk is written: the one with the smallest
+    collection, source and hash_id, so it does not depend on the order in which the concurrent scrapers write them. The
+    others are not written, and are referenced in the 'duplicates' field of the canonical document at the end of the
+    run. Their documents stored by previous runs are only removed then, if the document of their canonical chunk is
+    confirmed in the database.
+    """
+
+    def __init__(self, threshold: float = NEAR_DUPLICATES_THRESHOLD, num_perm: int = NEAR_DUPLICATES_PERMUTATIONS,
+                 shingle_size: int = NEAR_DUPLICATES_SHINGLE_SIZE, min_words: int = NEAR_DUPLICATES_MIN_WORDS,
+                 seed: int = 1):
+        import numpy as np
+
+        self.threshold = threshold
+        self.shingle_size = shingle_size
+        self.min_words = min_words
+        self.bands, self.rows = lsh_parameters(threshold, num_perm)
+        generator = np.random.default_rng(seed)
+        # Coefficients of the hash functions h(x) = (a * x + b) mod p, small enough for a * x + b to fit in 64 bits
+        self._a = generator.integers(1, 1 << 31, size=num_perm, dtype=np.uint64)
+        self._b = generator.integers(0, 1 << 31, size=num_perm, dtype=np.uint64)
+        # Signature, collection, reference and duplicates of each canonical chunk, keyed by its source and hash_id
+        self.canonicals = {}
+        # Source and hash_id of the chunks that were canonical until a preceding near-duplicate arrived, by collection
+        self.demoted = {}
+        # Collection of each indexed chunk, keyed by its source and hash_id
+        self.collections = {}
+        # Chunks whose documents are confirmed in the database: written by a synchronisation that finished without
+        # discarding their source, or stored by a source skipped in this run
+        self.confirmed = set()
+        # Chunks of the sources skipped in this run, which cannot be written again in the run, so they are never removed
+        self.stored = set()
+        self.sources = set()
+        self._buckets = [{} for _ in range(self.bands)]
+        self._lock = threading.Lock()
+
+    def signature(self, text: str) -> Optional['np.ndarray']:
+        """
+        Compute the MinHash signature of the word shingles of a text.
+        :param text: text of the chunk
+        :return: signature, or None if the text is too short to be collapsed
+        """
+        import numpy as np
+
+        words = text.lower().split()
+        if len(words) < max(self.min_words, self.shingle_size):
+            return None
+        # The shingles are hashed by combining the hashes of their words, so each word is hashed once
+        word_hashes = np.fromiter((zlib.crc32(word.encode('utf-8')) for word in words), dtype=np.uint64,
+                                  count=len(words))
+        shingle_count = len(words) - self.shingle_size + 1
+        shingles = np.zeros(shingle_count, dtype=np.uint64)
+        for offset in range(self.shingle_size):
+            shingles = (shingles * np.uint64(1000003) + word_hashes[offset:offset + shingle_count]) & np.uint64(
+                0xFFFFFFFF)
+        shingles = np.unique(shingles)
+        hashes = (np.outer(shingles, self._a) + self._b) % np.uint64(MERSENNE_PRIME)
+        return hashes.min(axis=0).astype(np.uint32)
+
+    def _band_keys(self, signature: 'np.ndarray') -> list:
+        return [signature[band * self.rows:(band + 1) * self.rows].tobytes() for band in range(self.bands)]
+
+    def _order(self, key: tuple) -> tuple:
+        return (self.canonicals[key]['collection'], *key)
+
+    def find_or_add(self, record, collection_name: str, signature: 'np.ndarray') -> Optional[tuple]:
+        """
+        Find the canonical chunk of a near-duplicate, recording the chunk as one of its duplicates, or add the chunk to
+        the index as a canonical one. If the chunk precedes the canonical chunk of its group, it replaces it, and the
+        replaced chunk is demoted to one of its duplicates (see demoted_keys).
+        :param record: ChunkRecord object
+        :param collection_name: collection the chunk is written into
+        :param signature: MinHash signature of the chunk text
+        :return: source and hash_id of the canonical chunk, or None if the chunk is canonical
+        """
+        key = (record.source, record.hash_id)
+        band_keys = self._band_keys(signature)
+        reference = {'source': record.source, 'title': record.title, 'hash_id': record.hash_id}
+        if record.url is not None:
+            reference['url'] = record.url
+        with self._lock:
+            self.sources.add(record.source)
+            self.collections[key] = collection_name
+            if key in self.canonicals:
+                return None
+            candidates = dict.fromkeys(candidate for band, band_key in enumerate(band_keys)
+                                       for candidate in self._buckets[band].get(band_key, ()))
+            similar = [candidate for candidate in candidates
+                       if (self.canonicals[candidate]['signature'] == signature).mean() >= self.threshold]
+            duplicates = {}
+            if similar:
+                canonical_key = min(similar, key=self._order)
+                if self._order(canonical_key) < (collection_name, *key):
+                    self.canonicals[canonical_key]['duplicates'][key] = reference
+                    return canonical_key
+                canonical = self._remove_canonical(canonical_key)
+                duplicates = {canonical_key: canonical['reference'], **canonical['duplicates']}
+                self.demoted.setdefault(canonical['collection'], set()).add(canonical_key)
+
+            self.canonicals[key] = {'collection': collection_name, 'signature': signature, 'reference': reference,
+                                    'duplicates': duplicates}
+            for band, band_key in enumerate(band_keys):
+                self._buckets[band].setdefault(band_key, []).append(key)
+        return None
+
+    def _remove_canonical(self, key: tuple) -> dict:
+        canonical = self.canonicals.pop(key)
+        for band, band_key in enumerate(self._band_keys(canonical['signature'])):
+            self._buckets[band][band_key].remove(key)
+        return canonical
+
+    def demoted_keys(self, collection_name: str) -> set:
+        """
+        Get the chunks of a collection demoted to near-duplicates in this run. They are not written if they have not
+        been yet, and the documents of those written before they were demoted are removed at the end of the run, with
+        the rest of the near-duplicates.
+        :param collection_name: collection name
+        :return: set with the source and the hash_id of each demoted chunk
+        """
+        with self._lock:
+            return set(self.demoted.get(collection_name, ()))
+
+    def confirm(self, keys) -> None:
+        """
+        Confirm that the documents of some chunks are stored in the database, so the near-duplicates of those that are
+        canonical can be removed at the end of the run.
+        :param keys: source and hash_id of each chunk
+        """
+        with self._lock:
+            self.confirmed.update(keys)
+
+    def add_stored(self, collection) -> int:
+        """
+        Add the chunks stored in a collection to the index (e.g. those of a source skipped in this run because its
+        payloads have not changed), so they are taken into account when the canonical chunks are chosen. Their documents
+        are confirmed, and, as the chunks cannot be written again in this run, they are never removed.
+        :param collection: database collection object
+        :return: number of chunks added
+        """
+        added = 0
+        # Only the chunks are indexed (e.g. not the partners)
+        for document in collection.find({'description': {'$exists': True}},
+                                        {'_id': 0, 'hash_id': 1, 'upload_date': 1, 'source': 1, 'title': 1,
+                                         'description': 1, 'url': 1}):
+            signature = self.signature(document['description'])
+            if signature is None:
+                continue
+            record = ChunkRecord(document['hash_id'], document.get('upload_date'), document['source'],
+                                 document.get('title'), document['description'], document.get('url'))
+            with self._lock:
+                self.stored.add((record.source, record.hash_id))
+                self.confirmed.add((record.source, record.hash_id))
+            self.find_or_add(record, collection.name, signature)
+            added += 1
+        return added
+
+    def write_references(self, db) -> int:
+        """
+        Write the references to the duplicates of each canonical chunk into its document, and remove the references
+        left by previous runs from the other canonical documents of the sources indexed in this run.
+        :param db: database object
+        :return: number of canonical documents with duplicates
+        """
+        with self._lock:
+            # Canonical chunks with duplicates of each collection
+            collections = {}
+            for key, canonical in self.canonicals.items():
+                canonicals = collections.setdefault(canonical['collection'], {})
+                if canonical['duplicates']:
+                    canonicals[key] = list(canonical['duplicates'].values())
+            sources = list(self.sources)
+
+        for collection_name, canonicals in collections.items():
+            collection = db[collection_name]
+            try:
+                if canonicals:
+                    collection.bulk_write([UpdateOne({'source': source, 'hash_id': hash_id},
+                                                     {'$set': {'duplicates': duplicates}})
+                                           for (source, hash_id), duplicates in canonicals.items()], ordered=False)
+                collection.update_many({'source': {'$in': sources}, 'duplicates': {'$exists': True},
+                                        'hash_id': {'$nin': [hash_id for _, hash_id in canonicals]}},
+                                       {'$unset': {'duplicates': ''}})
+            except pymongo_errors.PyMongoError as e:
+                logging.error(f"Failed to write the near-duplicate references into '{collection_name}': {e}")
+        return sum(len(canonicals) for canonicals in collections.values())
+
+    def remove_duplicates(self, db) -> int:
+        """
+        Remove the documents of the near-duplicates (stored by previous runs, or written before they were demoted) whose
+        canonical document is confirmed in the database. If it is not (e.g. the synchronisation of its source failed or
+        was discarded), its near-duplicates are kept.
+        :param db: database object
+        :return: number of canonical chunks whose near-duplicates were kept
+        """
+        with self._lock:
+            # Near-duplicates to remove from each collection
+            collections = {}
+            unconfirmed = 0
+            for key, canonical in self.canonicals.items():
+                if not canonical['duplicates']:
+                    continue
+                if key not in self.confirmed:
+                    unconfirmed += 1
+                    continue
+                for duplicate_key in canonical['duplicates']:
+                    if duplicate_key not in self.stored:
+                        collections.setdefault(self.collections[duplicate_key], set()).add(duplicate_key)
+
+        for collection_name, keys in collections.items():
+            hash_ids = {}
+            for source, hash_id in keys:
+                hash_ids.setdefault(source, []).append(hash_id)
+            try:
+                for source, source_hash_ids in hash_ids.items():
+                    db[collection_name].delete_many({'source': source, 'hash_id': {'$in': source_hash_ids}})
+            except pymongo_errors.PyMongoError as e:
+                logging.error(f"Failed to remove the near-duplicates from '{collection_name}': {e}")
+                continue
+            record_vector_changes(collection_name, removed=keys)
+        return unconfirmed
+
+
+def start_near_duplicates_run(enabled: Optional[bool] = None) -> None:
+    """
+    Start a new near-duplicate index for a run, if the stage is enabled (the index does not outlive the run).
+    :param enabled: collapse the near-duplicate chunks (NEAR_DUPLICATES_ENABLED if None)
+    """
+    global _index
+    with _index_lock:
+        _index = NearDuplicateIndex() if (NEAR_DUPLICATES_ENABLED if enabled is None else enabled) else None
+
+
+def get_near_duplicate_index() -> Optional[NearDuplicateIndex]:
+    """
+    Get the near-duplicate index of the current run.
+    :return: NearDuplicateIndex object, or None if the stage is disabled
+    """
+    return _index
+
+
+def add_stored_chunks(collection) -> None:
+    """
+    Add the chunks stored in a collection to the near-duplicate index of the current run, if the stage is enabled (e.g.
+    those of a source skipped because its payloads have not changed).
+    :param collection: database collection object
+    """
+    index = get_near_duplicate_index()
+    if index is not None:
+        added = index.add_stored(collection)
+        logging.info(f"{added} chunks stored in the '{collection.name}' collection were added to the near-duplicate "
+                     f"index")
+
+
+def finish_near_duplicates_run(db) -> None:
+    """
+    Write the references to the collapsed near-duplicates into their canonical documents, remove the documents of the
+    near-duplicates whose canonical document is confirmed, and close the index.
+    :param db: database object
+    """
+    global _index
+    with _index_lock:
+        index, _index = _index, None
+    if index is None:
+        return
+    collapsed = sum(len(canonical['duplicates']) for canonical in index.canonicals.values())
+    canonicals = index.write_references(db)
+    unconfirmed = index.remove_duplicates(db)
+    if unconfirmed:
+        logging.warning(f"The near-duplicates of {unconfirmed} canonical chunks were kept, because their documents "
+                        f"were not confirmed in the database")
+    logging.info(f"{collapsed} near-duplicate chunks were collapsed into {canonicals} canonical documents")
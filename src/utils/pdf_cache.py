@@ -0,0 +1,103 @@
+import hashlib
+import logging
+import os
+import threading
+from typing import Optional
+
+from src.utils.disk_cache import DiskCache
+
+# Enable the persistent cache of the text extracted from the PDFs
+PDF_CACHE_ENABLED = os.environ.get('PDF_CACHE_ENABLED', 'true').lower() == 'true'
+# Directory of the cache (only /tmp is writable in AWS Lambda)
+PDF_CACHE_DIR = os.environ.get('PDF_CACHE_DIR', '/tmp/airzone_cache/pdf' if os.environ.get(
+    'DEPLOYMENT_OPTION') == 'LAMBDA' else '.cache/pdf')
+# Maximum size of the cache, in megabytes (smaller in AWS Lambda, see HTTP_CACHE_MAX_MB)
+PDF_CACHE_MAX_MB = int(os.environ.get('PDF_CACHE_MAX_MB', 64 if os.environ.get(
+    'DEPLOYMENT_OPTION') == 'LAMBDA' else 256))
+
+_pdf_text_cache = None
+_pdf_text_cache_lock = threading.Lock()
+
+
+class PdfTextCache:
+    """
+    Content-addressed cache of the text extracted from the PDFs. Each entry is keyed by the URL of the PDF plus its
+    fingerprint: the ETag/Last-Modified/Content-Length headers when the server sends an ETag or a Last-Modified date (so
+    the download can be skipped), or the digest of the downloaded content otherwise (so only the parsing is skipped).
+    """
+
+    def __init__(self, directory: str, max_bytes: int):
+        """
+        :param directory: directory where the cache is stored
+        :param max_bytes: maximum size of the cache, in bytes
+        """
+        self.store = DiskCache(directory, max_bytes)
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def header_key(url: str, headers) -> Optional[str]:
+        """
+        Get the cache key of a PDF from the headers of a HEAD response.
+        :param url: URL of the PDF
+        :param headers: response headers
+        :return: cache key, or None if the headers do not identify the content
+        """
+        etag = headers.get('ETag')
+        last_modified = headers.get('Last-Modified')
+        # The length alone does not identify the content (e.g. a replaced manual of the same size)
+        if not etag and not last_modified:
+            return None
+        return f"{url}|etag:{etag}|last_modified:{last_modified}|length:{headers.get('Content-Length')}"
+
+    @staticmethod
+    def content_key(url: str, content: bytes) -> str:
+        """
+        Get the cache key of a PDF from its content.
+        :param url: URL of the PDF
+        :param content: content of the PDF
+        :return: cache key
+        """
+        return f"{url}|sha256:{hashlib.sha256(content).hexdigest()}"
+
+    def get(self, key: Optional[str]) -> Optional[str]:
+        """
+        Get the extracted text of a PDF.
+        :param key: cache key
+        :return: extracted text, or None if it is not cached
+        """
+        cached = self.store.get(key) if key is not None else None
+        with self._lock:
+            if cached is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return cached[0].decode('utf-8')
+
+    def set(self, key: str, text: str) -> None:
+        """
+        Store the extracted text of a PDF.
+        :param key: cache key
+        :param text: extracted text
+        """
+        self.store.set(key, text.encode('utf-8'))
+
+    def flush(self) -> None:
+        """
+        Persist the cache index to disk and log the hit/miss counters.
+        """
+        logging.info(f"PDF text cache: {self.hits} hits and {self.misses} misses")
+        self.store.flush()
+
+
+def get_pdf_text_cache() -> Optional[PdfTextCache]:
+    """
+    Get the PDF text cache, creating it on first use.
+    :return: PdfTextCache object, or None if the cache is disabled
+    """
+    global _pdf_text_cache
+    with _pdf_text_cache_lock:
+        if PDF_CACHE_ENABLED and _pdf_text_cache is None:
+            _pdf_text_cache = PdfTextCache(PDF_CACHE_DIR, PDF_CACHE_MAX_MB * 1024 * 1024)
+    return _pdf_text_cache
@@ -0,0 +1,215 @@
+import functools
+import io
+import logging
+import os
+import pstats
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+from typing import Optional
+
+from src.utils.metrics import get_current_source
+
+# Profile each scraper with cProfile and tracemalloc (it can also be enabled with the --profile switch)
+PROFILING_ENABLED = os.environ.get('PROFILING_ENABLED', 'false').lower() == 'true'
+# Also profile the stages (product page parsing, PDF text extraction and database writes) on their own
+PROFILING_STAGES = os.environ.get('PROFILING_STAGES', 'false').lower() == 'true'
+# Directory of the profiles, with a subdirectory per run (only /tmp is writable in AWS Lambda)
+PROFILING_DIR = os.environ.get('PROFILING_DIR', '/tmp/airzone_cache/profiles' if
+                               os.environ.get('DEPLOYMENT_OPTION') == 'LAMBDA' else '.cache/profiles')
+# Number of functions and allocation sites in the text reports
+PROFILING_TOP_N = int(os.environ.get('PROFILING_TOP_N', 30))
+# Frames stored by tracemalloc for each allocation (more frames are slower, but show where the allocations come from)
+PROFILING_TRACEMALLOC_FRAMES = int(os.environ.get('PROFILING_TRACEMALLOC_FRAMES', 1))
+
+# cProfile only profiles the thread that enables it, and a thread can only run one profiler at a time. Each scraper is
+# profiled in its own thread, and each stage in the thread that runs it (e.g. a parse worker), pausing the profiler of
+# the scraper if the stage runs in the scraper thread. The profile of a scraper is the merge of both
+_local = threading.local()
+
+
+class ProfilingRun:
+    """
+    Profiles and allocation reports collected during a run, written at the end of the run.
+    """
+
+    def __init__(self, directory: str, stages: bool, top_n: int):
+        self.directory = os.path.join(directory, time.strftime('%Y%m%d-%H%M%S'))
+        self.stages = stages
+        self.top_n = top_n
+        # Profiles of each (source, stage) pair, where the stage is None for the scraper thread
+        self.profiles = {}
+        # Allocation differences between the start and the end of each scraper
+        self.allocations = {}
+        self.started_tracemalloc = False
+        self._lock = threading.Lock()
+
+    def add_profile(self, key: tuple, profile) -> None:
+        with self._lock:
+            self.profiles.setdefault(key, []).append(profile)
+
+
+_run = None
+
+
+def start_profiling_run(enabled: Optional[bool] = None, stages: Optional[bool] = None,
+                        directory: str = PROFILING_DIR, top_n: int = PROFILING_TOP_N) -> None:
+    """
+    Start profiling a run, if it is enabled. When it is not, the profiling hooks do nothing.
+    :param enabled: profile each scraper (PROFILING_ENABLED if None)
+    :param stages: also profile each stage (PROFILING_STAGES if None)
+    :param directory: directory of the profiles
+    :param top_n: number of functions and allocation sites in the text reports
+    """
+    global _run
+    enabled = PROFILING_ENABLED if enabled is None else enabled
+    stages = PROFILING_STAGES if stages is None else stages
+    # Profiling the stages implies profiling the scrapers
+    if not enabled and not stages:
+        _run = None
+        return
+
+    _run = ProfilingRun(directory, stages, top_n)
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(PROFILING_TRACEMALLOC_FRAMES)
+        _run.started_tracemalloc = True
+    logging.info(f"Profiling the scrapers{' and their stages' if stages else ''} into {_run.directory}")
+
+
+def profiling_stages_enabled() -> bool:
+    """
+    Check if the stages are being profiled, in which case the CPU-bound stages must run in threads of this process.
+    :return: True if the stages are being profiled
+    """
+    return _run is not None and _run.stages
+
+
+@contextmanager
+def _profiled(key: tuple):
+    import cProfile
+
+    run = _run
+    paused_profile = getattr(_local, 'profile', None)
+    if paused_profile is not None:
+        paused_profile.disable()
+    profile = _local.profile = cProfile.Profile()
+    profile.enable()
+    try:
+        yield
+    finally:
+        profile.disable()
+        _local.profile = paused_profile
+        if paused_profile is not None:
+            paused_profile.enable()
+        run.add_profile(key, profile)
+
+
+def _allocation_snapshot() -> tracemalloc.Snapshot:
+    # The allocations of tracemalloc itself and of the import system (the modules imported by the scrapers) are ignored
+    return tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, tracemalloc.__file__),
+                                                      tracemalloc.Filter(False, '<frozen importlib.*')])
+
+
+@contextmanager
+def _profile_scraper(name: str):
+    run = _run
+    before = _allocation_snapshot()
+    try:
+        with _profiled((name, None)):
+            yield
+    finally:
+        differences = _allocation_snapshot().compare_to(before, 'traceback' if PROFILING_TRACEMALLOC_FRAMES > 1 else
+                                                        'lineno')
+        with run._lock:
+            run.allocations[name] = differences
+
+
+def profile_scraper(name: str):
+    """
+    Context manager that profiles a scraper with cProfile and records the memory it allocates with tracemalloc.
+    :param name: scraper name
+    :return: context manager
+    """
+    return _profile_scraper(name) if _run is not None else nullcontext()
+
+
+def profiled_stage(stage: str):
+    """
+    Decorator that profiles each call of a stage with cProfile, when the stages are being profiled. The profile is
+    attributed to the source of the current context.
+    :param stage: stage name
+    :return: decorator
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if _run is None or not _run.stages:
+                return function(*args, **kwargs)
+            with _profiled((get_current_source(), stage)):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def merge_profiles(profiles: list) -> pstats.Stats:
+    stats = pstats.Stats(profiles[0])
+    for profile in profiles[1:]:
+        stats.add(profile)
+    return stats
+
+
+def format_stats(stats: pstats.Stats, top_n: int) -> str:
+    stream = io.StringIO()
+    stats.stream = stream
+    stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(top_n)
+    return stream.getvalue()
+
+
+def format_allocations(differences: list, top_n: int) -> str:
+    lines = [f"Top {top_n} allocation sites by memory still allocated at the end of the scraper. The scrapers run "
+             f"concurrently, so they include the allocations of the other scrapers (set SCRAPER_MAX_WORKERS=1 to "
+             f"isolate them)", '']
+    for difference in differences[:top_n]:
+        lines.append(f"{difference.size_diff / 1024:+.1f} KiB ({difference.count_diff:+} blocks), "
+                     f"{difference.size / 1024:.1f} KiB in total")
+        lines.extend(f"    {line}" for line in difference.traceback.format())
+    return '\n'.join(lines) + '\n'
+
+
+def finish_profiling_run() -> Optional[str]:
+    """
+    Write the profiles of the run, if it is being profiled: for each scraper, its cProfile dump (<scraper>.prof, which
+    includes its stages), the functions with the highest cumulative time (<scraper>.txt) and the allocation report
+    (<scraper>.allocations.txt), and the cProfile dump of each of its stages (<scraper>.<stage>.prof).
+    :return: directory of the profiles, or None if the run is not being profiled
+    """
+    global _run
+    if _run is None:
+        return None
+    run, _run = _run, None
+    if run.started_tracemalloc:
+        tracemalloc.stop()
+
+    try:
+        os.makedirs(run.directory, exist_ok=True)
+        for source in dict.fromkeys(source for source, _ in run.profiles):
+            source_profiles = []
+            for (profile_source, stage), profiles in run.profiles.items():
+                if profile_source != source:
+                    continue
+                source_profiles.extend(profiles)
+                if stage is not None:
+                    merge_profiles(profiles).dump_stats(os.path.join(run.directory, f"{source}.{stage}.prof"))
+            stats = merge_profiles(source_profiles)
+            stats.dump_stats(os.path.join(run.directory, f"{source}.prof"))
+            with open(os.path.join(run.directory, f"{source}.txt"), 'w') as report_file:
+                report_file.write(format_stats(stats, run.top_n))
+
+        for source, differences in run.allocations.items():
+            with open(os.path.join(run.directory, f"{source}.allocations.txt"), 'w') as report_file:
+                report_file.write(format_allocations(differences, run.top_n))
+        logging.info(f"Profiles written to {run.directory}")
+    except OSError as e:
+        logging.warning(f"Could not write the profiles to {run.directory}: {e}")
+    return run.directory
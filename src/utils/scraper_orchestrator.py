@@ -0,0 +1,128 @@
+import asyncio
+import importlib
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, NamedTuple, Tuple
+
+from src.utils.metrics import metrics_source
+from src.utils.profiling import profile_scraper
+
+# Maximum number of scrapers running at the same time
+SCRAPER_MAX_WORKERS = int(os.environ.get('SCRAPER_MAX_WORKERS', 5))
+
+
+class ScraperTask(NamedTuple):
+    """
+    Node of the scraper task graph: a source, the function that scrapes it and the collections it writes into.
+    """
+    name: str
+    function: Callable
+    collections: Tuple[str, ...]
+
+
+def lazy_scraper(module_name: str, function_name: str) -> Callable:
+    """
+    Reference a scraper function whose module (and its dependencies) is only imported when the scraper runs, so
+    importing the orchestrator does not load every scraper.
+    :param module_name: module of the scraper
+    :param function_name: name of the scraper function
+    :return: function that imports and calls the scraper
+    """
+    def run_scraper(session, db):
+        return getattr(importlib.import_module(module_name), function_name)(session, db)
+
+    run_scraper.__name__ = function_name
+    return run_scraper
+
+
+def run_products_scraper(session, db) -> None:
+    """
+    Run the asyncio based Myzone products scraper in its own event loop.
+    :param session: requests session (not used, the scraper opens its own aiohttp session)
+    :param db: database object
+    """
+    from src.websites.myzone.myzone_products_scraper import airzone_products_scraper
+
+    asyncio.run(airzone_products_scraper(db))
+
+
+# The 'support' collection is written by both the Support and the Myzone products scrapers. Those writes are
+# serialised through the collection lock taken by each DocumentSync batch
+SCRAPER_TASKS = (
+    ScraperTask('support', lazy_scraper('src.websites.support.support_functions', 'support_scraper'), ('support',)),
+    ScraperTask('academia', lazy_scraper('src.websites.airzonecontrol.airzonecontrol_functions', 'academia_scraper'),
+                ('academia',)),
+    ScraperTask('general_information', lazy_scraper('src.websites.airzonecontrol.general_information_scraper',
+                                                    'general_information_scraper'), ('general_information',)),
+    ScraperTask('partner', lazy_scraper('src.websites.airzonecontrol.airzonecontrol_functions', 'partner_scraper'),
+                ('partner',)),
+    ScraperTask('products', run_products_scraper, ('product', 'support')),
+)
+
+
+def get_collections(tasks) -> List[str]:
+    """
+    Get the collections written by the scrapers of the task graph.
+    :param tasks: scraper tasks
+    :return: list of collection names, in the order of the tasks
+    """
+    return list(dict.fromkeys(collection_name for task in tasks for collection_name in task.collections))
+
+
+def get_shared_collections(tasks) -> List[str]:
+    """
+    Get the collections that are written by more than one scraper of the task graph.
+    :param tasks: scraper tasks
+    :return: list of collection names
+    """
+    writers = {}
+    for task in tasks:
+        for collection_name in task.collections:
+            writers.setdefault(collection_name, []).append(task.name)
+    return [collection_name for collection_name, names in writers.items() if len(names) > 1]
+
+
+def run_scraper_task(task: ScraperTask, session, db) -> dict:
+    """
+    Run a single scraper, isolating its failures from the rest of the sources.
+    :param task: scraper task
+    :param session: requests session
+    :param db: database object
+    :return: dictionary with the status, the elapsed seconds and the error (if any) of the scraper
+    """
+    start = time.perf_counter()
+    try:
+        # The metrics recorded by the scraper are tagged with its name
+        with metrics_source(task.name), profile_scraper(task.name):
+            task.function(session, db)
+        status, error = 'ok', None
+    except Exception as e:
+        logging.error(f"The '{task.name}' scraper failed: {e}")
+        status, error = 'failed', str(e)
+    elapsed = time.perf_counter() - start
+    logging.info(f"The '{task.name}' scraper finished in {elapsed:.2f} seconds")
+    return {'status': status, 'seconds': round(elapsed, 3), 'error': error}
+
+
+def run_scrapers(session, db, tasks=SCRAPER_TASKS, max_workers: int = SCRAPER_MAX_WORKERS) -> dict:
+    """
+    Run the scrapers of the task graph concurrently, with at most 'max_workers' of them at the same time.
+    :param session: requests session
+    :param db: database object
+    :param tasks: scraper tasks
+    :param max_workers: maximum number of scrapers running at the same time
+    :return: dictionary with the status and wall-clock time of each scraper
+    """
+    shared_collections = get_shared_collections(tasks)
+    if shared_collections:
+        logging.info(f"Writes into the {shared_collections} collections will be serialised")
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {task.name: executor.submit(run_scraper_task, task, session, db) for task in tasks}
+        breakdown = {name: future.result() for name, future in futures.items()}
+
+    logging.info(f"All the scrapers finished in {time.perf_counter() - start:.2f} seconds: {breakdown}")
+    return breakdown
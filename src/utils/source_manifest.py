@@ -0,0 +1,158 @@
+import hashlib
+import logging
+import os
+import threading
+from typing import Iterable, Optional, Union
+
+from pymongo import errors as pymongo_errors
+
+from src.utils.near_duplicates import add_stored_chunks
+
+# Skip the sources whose upstream payloads have not changed since their last successful synchronisation
+SOURCE_MANIFEST_ENABLED = os.environ.get('SOURCE_MANIFEST_ENABLED', 'true').lower() == 'true'
+# Collection of the manifest, stored in the database it describes, so every environment that writes into the database
+# sees the same digests (a local file would let a run skip a source that another environment has changed)
+SOURCE_MANIFEST_COLLECTION = os.environ.get('SOURCE_MANIFEST_COLLECTION', 'source_manifest')
+# Process every source even if its payloads have not changed
+SOURCE_FORCE_REFRESH = os.environ.get('SOURCE_FORCE_REFRESH', 'false').lower() == 'true'
+
+_source_manifest = None
+_source_manifest_lock = threading.Lock()
+
+
+class SourceManifest:
+    """
+    Digest of the raw upstream payloads of each source at its last successful synchronisation, stored in the database
+    next to the collection of the source. When the payloads of a source have the same digest in the next run and its
+    collection still has documents, the chunking, hashing and database diff of the whole source can be skipped.
+    """
+
+    def __init__(self, force_refresh: bool = False):
+        """
+        :param force_refresh: report every source as changed
+        """
+        self.force_refresh = force_refresh
+        self.skipped_sources = []
+        self._lock = threading.Lock()
+
+    def start_run(self, force_refresh: bool = False) -> None:
+        """
+        Reset the skipped sources at the beginning of a run (the manifest outlives the warm Lambda invocations).
+        :param force_refresh: report every source as changed in this run
+        """
+        with self._lock:
+            self.force_refresh = force_refresh
+            self.skipped_sources = []
+
+    def is_unchanged(self, collection, digest: str) -> bool:
+        """
+        Check if the payloads of a source have not changed since its last successful synchronisation, recording the
+        source as skipped if so.
+        :param collection: MongoDB collection of the source
+        :param digest: digest of the current payloads of the source
+        :return: True if the source can be skipped
+        """
+        if self.force_refresh:
+            return False
+        stored = collection.database[SOURCE_MANIFEST_COLLECTION].find_one({'_id': collection.name})
+        if stored is None or stored.get('digest') != digest:
+            return False
+        # The documents may have been removed since the last synchronisation (e.g. the collection was dropped to be
+        # rebuilt), and then the source has to be synchronised again
+        if collection.find_one({}, {'_id': 1}) is None:
+            logging.info(f"The '{collection.name}' collection is empty, so it is synchronised again")
+            return False
+        with self._lock:
+            self.skipped_sources.append(collection.name)
+        logging.info(f"The '{collection.name}' upstream payloads have not changed since the last run, so it is skipped")
+        return True
+
+    def update(self, collection, digest: str) -> None:
+        """
+        Record the digest of a source after its successful synchronisation.
+        :param collection: MongoDB collection of the source
+        :param digest: digest of the synchronised payloads of the source
+        """
+        try:
+            collection.database[SOURCE_MANIFEST_COLLECTION].update_one(
+                {'_id': collection.name}, {'$set': {'digest': digest}}, upsert=True)
+        except pymongo_errors.PyMongoError as e:
+            # The source is already synchronised: it is only processed again in the next run
+            logging.warning(f"Failed to record the digest of the '{collection.name}' payloads: {e}")
+
+
+def calculate_payloads_digest(payloads: Iterable[Union[bytes, str]]) -> str:
+    """
+    Calculate the digest of the raw upstream payloads of a source.
+    :param payloads: payloads, in a fixed order
+    :return: SHA256 digest
+    """
+    sha256_hash = hashlib.sha256()
+    for payload in payloads:
+        if isinstance(payload, str):
+            payload = payload.encode('utf-8')
+        # The length prefix keeps the payload boundaries in the digest
+        sha256_hash.update(len(payload).to_bytes(8, 'big'))
+        sha256_hash.update(payload)
+    return sha256_hash.hexdigest()
+
+
+def get_source_manifest() -> Optional[SourceManifest]:
+    """
+    Get the source manifest shared by all the scrapers, loading it on first use.
+    :return: SourceManifest object, or None if the manifest is disabled
+    """
+    global _source_manifest
+    with _source_manifest_lock:
+        if SOURCE_MANIFEST_ENABLED and _source_manifest is None:
+            _source_manifest = SourceManifest(SOURCE_FORCE_REFRESH)
+    return _source_manifest
+
+
+def is_source_unchanged(collection, digest: str) -> bool:
+    """
+    Check if a source can be skipped because its payloads have not changed since its last successful synchronisation.
+    If so, its stored chunks are added to the near-duplicate index of the run.
+    :param collection: MongoDB collection of the source
+    :param digest: digest of the current payloads of the source
+    :return: True if the source can be skipped
+    """
+    manifest = get_source_manifest()
+    if manifest is None or not manifest.is_unchanged(collection, digest):
+        return False
+    # The stored chunks of the skipped source still take part in the choice of the canonical near-duplicates
+    add_stored_chunks(collection)
+    return True
+
+
+def record_source_digest(collection, digest: str) -> None:
+    """
+    Record the digest of a source after its successful synchronisation.
+    :param collection: MongoDB collection of the source
+    :param digest: digest of the synchronised payloads of the source
+    """
+    manifest = get_source_manifest()
+    if manifest is not None:
+        manifest.update(collection, digest)
+
+
+def start_manifest_run(force_refresh: bool = False) -> None:
+    """
+    Prepare the source manifest for a new run.
+    :param force_refresh: process every source even if its payloads have not changed
+    """
+    manifest = get_source_manifest()
+    if manifest is not None:
+        manifest.start_run(force_refresh or SOURCE_FORCE_REFRESH)
+        if manifest.force_refresh:
+            logging.info("Force refresh: every source will be processed")
+
+
+def log_skipped_sources() -> None:
+    """
+    Log the number of sources skipped in the run because their payloads had not changed.
+    """
+    manifest = get_source_manifest()
+    if manifest is not None:
+        logging.info(f"{len(manifest.skipped_sources)} sources were skipped because their upstream payloads had not "
+                     f"changed: {manifest.skipped_sources}")
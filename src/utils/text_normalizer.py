@@ -0,0 +1,150 @@
+from typing import List, NamedTuple, Optional, Tuple
+
+from bs4 import NavigableString, Tag
+
+# Tags whose children are kept as 'child: ' items when a block is walked
+HEADING_TAGS = ('h2', 'h3', 'h4')
+# Tags whose text is quoted when a block is walked
+QUOTED_TAGS = ('a', 'em')
+
+
+def clean_text(text: str, cleanup: str = 'legacy', fix_parentheses: bool = False) -> str:
+    """
+    Clean the whitespace of a text.
+    :param text: text to clean
+    :param cleanup: 'legacy' removes the spaces before a dot, halves the runs of spaces (without collapsing them fully)
+    and replaces the line breaks with spaces, like the scrapers always did, so their hash_ids do not change; 'collapse'
+    replaces every run of whitespace with a single space
+    :param fix_parentheses: remove the space after an opening parenthesis (legacy cleanup only)
+    :return: clean text
+    """
+    if cleanup == 'collapse':
+        # Same result as re.sub(r'\s+', ' ', text).strip(), several times faster
+        return ' '.join(text.split())
+    # The chained str.replace calls run in C and are faster than a single regular expression pass with the same result
+    # (see benchmarks/bench_normalizer.py)
+    text = text.replace(" .", ".").replace("   ", " ").replace("  ", " ").replace("\n", " ")
+    if fix_parentheses:
+        text = text.replace("( ", "(")
+    return text.strip()
+
+
+class HtmlNormalizer(NamedTuple):
+    """
+    Rules to convert an HTML fragment into text, configured per source so each one keeps its output. The direct
+    children of the fragment are walked once, in order, and their texts are accumulated into a list:
+      - the text of the title tag is returned apart
+      - the inline tags are kept as they are, and the skipped tags are dropped
+      - the text of the paragraph tags is kept, followed by a space
+      - the 'li' items of the list tags are numbered: '1) item 2) item'
+      - the other tags are dropped or, with walk_blocks, their children are walked: the children of a heading are
+        followed by ': ', the 'li' items are numbered and the links and emphasised texts are quoted
+    """
+    paragraph_tags: Tuple[str, ...] = ('p',)
+    list_tags: Tuple[str, ...] = ('ul', 'ol')
+    inline_tags: Tuple[str, ...] = ()
+    skipped_tags: Tuple[str, ...] = ()
+    title_tag: Optional[str] = None
+    walk_blocks: bool = False
+    # Separator added after the strings (they are dropped if None), and whether the blank strings are dropped
+    string_separator: Optional[str] = ' '
+    skip_blank_strings: bool = False
+    # The Support sections drop the links placed at the start of a node together with the node, and the node that
+    # follows a top-level link or an empty node (their cleaning removed nodes from the list being iterated)
+    drop_links: bool = False
+    cleanup: str = 'legacy'
+    fix_parentheses: bool = False
+
+    def normalize_section(self, root) -> Tuple[Optional[str], str]:
+        """
+        Convert an HTML fragment into text.
+        :param root: BeautifulSoup object or tag of the fragment
+        :return: tuple with the text of the title tag (None if there is none) and the clean text of the fragment
+        """
+        parts = []
+        title = None
+        skip_next = False
+        # The rules are read once, the tuple fields are slower to access in the loop
+        (paragraph_tags, list_tags, inline_tags, skipped_tags, title_tag, walk_blocks, string_separator,
+         skip_blank_strings, drop_links) = self[:9]
+        for node in root.contents:
+            if skip_next:
+                skip_next = False
+                continue
+
+            if isinstance(node, NavigableString):
+                if drop_links:
+                    next_element = node.next_element
+                    if isinstance(next_element, Tag) and next_element.name == 'a':
+                        skip_next = True
+                        continue
+                if string_separator is None or (skip_blank_strings and not node.strip()):
+                    continue
+                # The text of a comment is empty
+                text = node.text
+                if text == '' and not skip_blank_strings:
+                    skip_next = drop_links
+                    continue
+                parts.append(text.strip() + string_separator)
+                continue
+
+            name = node.name
+            if drop_links:
+                next_element = node.next_element
+                if name == 'a':
+                    skip_next = True
+                    continue
+                if isinstance(next_element, Tag) and next_element.name == 'a':
+                    # The link is the first child of the node, or the next node if this one has no children
+                    skip_next = not node.contents
+                    continue
+                if not any(node.strings):
+                    skip_next = True
+                    continue
+
+            if name == title_tag:
+                title = node.text.strip().capitalize()
+            elif name in inline_tags:
+                parts.append(node.text.strip())
+            elif name in skipped_tags:
+                continue
+            elif name in paragraph_tags:
+                parts.append(node.text.strip() + " ")
+            elif name in list_tags:
+                append_numbered_items(node, parts)
+            elif walk_blocks and (drop_links or any(node.strings)):
+                # The empty nodes were already dropped if drop_links is set
+                append_block(node, parts)
+
+        return title, clean_text(''.join(parts), self.cleanup, self.fix_parentheses)
+
+    def normalize(self, root) -> str:
+        """
+        Convert an HTML fragment into text.
+        :param root: BeautifulSoup object or tag of the fragment
+        :return: clean text of the fragment
+        """
+        return self.normalize_section(root)[1]
+
+
+def append_numbered_items(tag, parts: List[str]) -> None:
+    number = 1
+    for item in tag.contents:
+        if item.name == 'li':
+            parts.append(f"{number}) {item.text.strip()} ")
+            number += 1
+
+
+def append_block(tag, parts: List[str]) -> None:
+    heading = tag.name in HEADING_TAGS
+    number = 1
+    for child in tag.contents:
+        if heading:
+            parts.append(child.text.strip() + ": ")
+        elif child.name == 'li':
+            parts.append(f"{number}) {child.text.strip()} ")
+            number += 1
+        elif child.name in QUOTED_TAGS:
+            parts.append(f"\"{child.text.strip()}\" ")
+        else:
+            parts.append(child.text.strip() + " ")
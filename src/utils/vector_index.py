@@ -0,0 +1,730 @@
+import json
+import logging
+import math
+import os
+import re
+import shutil
+import threading
+from typing import TYPE_CHECKING, Dict, Iterable, List, NamedTuple, Optional
+
+from pymongo import ReturnDocument, errors as pymongo_errors
+
+from src.utils.embeddings import EMBEDDING_BACKEND, EMBEDDING_FIELD, EMBEDDING_MODEL_FIELD, load_embedding_backend
+
+# NumPy is imported in the functions that use it, so importing this module does not load it when the index is not used
+if TYPE_CHECKING:
+    import numpy as np
+
+# Update the vector index with the chunks embedded and removed in each run (the chunks embedded by the runs without it
+# are only indexed when the index is built again)
+VECTOR_INDEX_ENABLED = os.environ.get('VECTOR_INDEX_ENABLED', 'false').lower() == 'true'
+# Directory of the index files (only /tmp is writable in AWS Lambda)
+VECTOR_INDEX_DIR = os.environ.get('VECTOR_INDEX_DIR', '/tmp/airzone_cache/vector_index' if os.environ.get(
+    'DEPLOYMENT_OPTION') == 'LAMBDA' else '.cache/vector_index')
+# Collections whose chunks are indexed (only the chunks with a vector of the current embedding model are indexed)
+VECTOR_INDEX_COLLECTIONS = os.environ.get('VECTOR_INDEX_COLLECTIONS',
+                                          'support,product,academia,general_information').split(',')
+# Search mode: 'exact' (every vector is scored) or 'ivfpq' (the vectors of the lists closest to the query are scored
+# with their product quantization codes, and the best candidates are rescored with their exact vectors)
+VECTOR_INDEX_MODE = os.environ.get('VECTOR_INDEX_MODE', 'exact')
+# Number of lists of the 'ivfpq' mode (0 to use the square root of the number of vectors)
+VECTOR_INDEX_LISTS = int(os.environ.get('VECTOR_INDEX_LISTS', 0))
+# Number of lists scored for each query (more are slower, but find more of the exact results)
+VECTOR_INDEX_PROBES = int(os.environ.get('VECTOR_INDEX_PROBES', 8))
+# Number of sub-vectors of the product quantization codes (one byte each)
+VECTOR_INDEX_SUBVECTORS = int(os.environ.get('VECTOR_INDEX_SUBVECTORS', 32))
+# Candidates rescored with their exact vectors for each requested result of the 'ivfpq' mode
+VECTOR_INDEX_RERANK = int(os.environ.get('VECTOR_INDEX_RERANK', 10))
+# The 'ivfpq' lists and codebooks are trained again when the index grows by this factor since they were trained
+VECTOR_INDEX_RETRAIN_GROWTH = float(os.environ.get('VECTOR_INDEX_RETRAIN_GROWTH', 2))
+# The removed rows are compacted away when they are more than this fraction of the rows
+VECTOR_INDEX_COMPACT_RATIO = float(os.environ.get('VECTOR_INDEX_COMPACT_RATIO', 0.2))
+# Maximum number of vectors read from the database in each query
+VECTOR_INDEX_BATCH_SIZE = int(os.environ.get('VECTOR_INDEX_BATCH_SIZE', 1000))
+# Collection of the counter of the updates of the vector index: an index that missed an update (e.g. made in another
+# environment, whose /tmp is not shared) is built again from the database instead of updated with the changes of a run
+VECTOR_INDEX_STATE_COLLECTION = os.environ.get('VECTOR_INDEX_STATE_COLLECTION', 'vector_index_state')
+
+# The hash_ids are SHA-256 hex digests (see calculate_hash), stored as fixed-width bytes
+HASH_ID_BYTES = 64
+# Rows scored at a time by the exact search, which bounds the memory used by the scores
+SEARCH_BLOCK_ROWS = 65536
+# Vectors sampled per centroid to train the lists and the codebooks, and maximum number of iterations of k-means
+# (more of either barely change the recall of the benchmark, see benchmarks/bench_vector_index.py)
+TRAINING_POINTS_PER_CENTROID = 32
+KMEANS_ITERATIONS = 10
+# k-means stops when fewer than this fraction of the vectors change their cluster in an iteration
+KMEANS_TOLERANCE = 0.001
+# Maximum number of codewords of each sub-vector (the codes are stored in one byte)
+MAX_CODEWORDS = 256
+
+METADATA_FILE = 'metadata.json'
+# Files of a generation of the index: '<name>.<generation>.bin' (rows) and '<name>.<generation>.npy' (trained arrays)
+GENERATION_FILE_PATTERN = re.compile(r'^\w+\.(\d+)\.(bin|npy)$')
+
+_index = None
+_index_mtime = None
+_index_lock = threading.Lock()
+_query_backend = None
+# Keys of the chunks embedded and removed in the current run, by collection
+_run_changes = None
+_run_changes_lock = threading.Lock()
+
+
+class SearchResult(NamedTuple):
+    """
+    Chunk found by a search, with the cosine similarity between its vector and the query.
+    """
+    score: float
+    collection: str
+    source: str
+    hash_id: str
+
+
+def normalize_rows(vectors) -> 'np.ndarray':
+    import numpy as np
+
+    vectors = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.where(norms > 0, norms, 1)
+
+
+def top_k(scores: 'np.ndarray', k: int) -> 'np.ndarray':
+    """
+    Get the columns of the k highest scores of each row, from the highest to the lowest.
+    :param scores: 2D array of scores
+    :param k: number of columns
+    :return: 2D array with the column indexes
+    """
+    import numpy as np
+
+    if k < scores.shape[1]:
+        columns = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    else:
+        columns = np.broadcast_to(np.arange(scores.shape[1]), scores.shape)
+    order = np.argsort(-np.take_along_axis(scores, columns, axis=1), axis=1, kind='stable')
+    return np.take_along_axis(columns, order, axis=1)
+
+
+def nearest_centroids(vectors: 'np.ndarray', centroids: 'np.ndarray', block_rows: int = 1024) -> 'np.ndarray':
+    """
+    Get the centroid closest (by Euclidean distance) to each vector.
+    :param vectors: 2D array of vectors
+    :param centroids: 2D array of centroids
+    :param block_rows: vectors compared at a time (the distances of a small block stay in the CPU cache)
+    :return: array with the centroid index of each vector
+    """
+    import numpy as np
+
+    # |v - c|^2 = |v|^2 - 2 v.c + |c|^2, where |v|^2 does not change the closest centroid
+    scaled_centroids = np.ascontiguousarray(centroids.T, dtype=np.float32) * np.float32(-2)
+    squared_norms = (centroids ** 2).sum(axis=1, dtype=np.float32)
+    assignments = np.empty(len(vectors), dtype=np.int32)
+    for start in range(0, len(vectors), block_rows):
+        distances = np.asarray(vectors[start:start + block_rows], dtype=np.float32) @ scaled_centroids
+        distances += squared_norms
+        assignments[start:start + len(distances)] = distances.argmin(axis=1)
+    return assignments
+
+
+def kmeans(vectors: 'np.ndarray', clusters: int, iterations: int = KMEANS_ITERATIONS, seed: int = 0) -> 'np.ndarray':
+    """
+    Cluster a set of vectors with Lloyd's algorithm.
+    :param vectors: 2D array of vectors
+    :param clusters: number of clusters (at most the number of vectors)
+    :param iterations: number of iterations
+    :param seed: seed of the initial centroids
+    :return: 2D array with the centroid of each cluster
+    """
+    import numpy as np
+
+    rng = np.random.default_rng(seed)
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    centroids = vectors[rng.choice(len(vectors), clusters, replace=False)]
+    previous_assignments = None
+    for _ in range(iterations):
+        assignments = nearest_centroids(vectors, centroids)
+        if previous_assignments is not None and \
+                np.count_nonzero(assignments != previous_assignments) <= KMEANS_TOLERANCE * len(vectors):
+            break
+        previous_assignments = assignments
+        # The vectors of each cluster are summed at once, sorted by their cluster
+        order = np.argsort(assignments, kind='stable')
+        counts = np.bincount(assignments, minlength=clusters)
+        filled = np.flatnonzero(counts)
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1]))[filled]
+        centroids[filled] = np.add.reduceat(vectors[order], starts, axis=0) / counts[filled, None]
+        # The empty clusters are moved to random vectors
+        empty = np.flatnonzero(counts == 0)
+        if empty.size:
+            centroids[empty] = vectors[rng.choice(len(vectors), empty.size, replace=False)]
+    return centroids
+
+
+def encode(vectors, centroids: 'np.ndarray', codebooks: 'np.ndarray') -> tuple:
+    """
+    Assign some vectors to the list of their closest centroid and encode their residuals with product quantization.
+    :param vectors: 2D array of vectors
+    :param centroids: 2D array with the centroid of each list
+    :param codebooks: 3D array with the codewords of each sub-vector
+    :return: tuple with the list of each vector and a 2D array with the codeword of each of its sub-vectors
+    """
+    import numpy as np
+
+    vectors = np.asarray(vectors, dtype=np.float32)
+    row_lists = nearest_centroids(vectors, centroids)
+    residuals = (vectors - centroids[row_lists]).reshape(len(vectors), len(codebooks), -1)
+    codes = np.stack([nearest_centroids(residuals[:, part], codebooks[part]) for part in range(len(codebooks))],
+                     axis=1).astype(np.uint8)
+    return row_lists, codes
+
+
+def read_metadata(directory: str) -> Optional[dict]:
+    try:
+        with open(os.path.join(directory, METADATA_FILE), 'r') as metadata_file:
+            return json.load(metadata_file)
+    except (OSError, ValueError):
+        return None
+
+
+class VectorIndex:
+    """
+    Vector index of the embedded chunks, persisted as flat files in a directory so a process can memory-map it instead
+    of reading the vectors from the database. Each row has its vector, its hash_id and its group (collection and
+    source), appended to their files as new chunks are indexed. The removed rows are only marked as removed in the
+    metadata until they are compacted away.
+
+    The metadata file is replaced atomically and holds the number of rows, so the rows appended to the files are only
+    visible once it is saved. The files are never rewritten in place: compacting or training the index writes a new
+    generation of them, so the processes that mapped the previous one keep reading it.
+
+    In the 'ivfpq' mode, each row is also assigned to the list of its closest centroid, and the residual of its vector
+    is encoded with a byte per sub-vector (product quantization). A search only scores the rows of the lists closest to
+    the query, with lookup tables of the codes, and rescores the best candidates with their exact vectors.
+    """
+
+    def __init__(self, directory: str, metadata: dict):
+        """
+        :param directory: directory of the index files
+        :param metadata: metadata of the index
+        """
+        self.directory = directory
+        self.metadata = metadata
+        self._arrays = {}
+        self._group_codes = {tuple(group): code for code, group in enumerate(metadata['groups'])}
+        # Live rows of each list of the 'ivfpq' mode, sorted by list, and the start of each list
+        self._inverted_lists = None
+        self._open_arrays()
+
+    @classmethod
+    def create(cls, directory: str, model_id: str, dimensions: int, mode: str = VECTOR_INDEX_MODE):
+        """
+        Create an empty index, replacing the index stored in the directory (if any).
+        :param directory: directory of the index files
+        :param model_id: embedding model of the vectors
+        :param dimensions: dimensions of the vectors
+        :param mode: 'exact' or 'ivfpq' (see VECTOR_INDEX_MODE)
+        :return: VectorIndex object
+        """
+        os.makedirs(directory, exist_ok=True)
+        previous = read_metadata(directory)
+        metadata = {'model_id': model_id, 'dimensions': dimensions, 'mode': mode, 'count': 0, 'groups': [],
+                    'deleted': [], 'lists': 0, 'subvectors': 0, 'trained_count': 0, 'version': None,
+                    'generation': previous['generation'] + 1 if previous else 0}
+        index = cls(directory, metadata)
+        index.save_metadata()
+        index._remove_other_generations()
+        return index
+
+    @classmethod
+    def load(cls, directory: str):
+        """
+        Load the index stored in a directory, memory-mapping its files.
+        :param directory: directory of the index files
+        :return: VectorIndex object, or None if there is no index in the directory
+        """
+        metadata = read_metadata(directory)
+        return cls(directory, metadata) if metadata is not None else None
+
+    @property
+    def model_id(self) -> str:
+        return self.metadata['model_id']
+
+    @property
+    def mode(self) -> str:
+        return self.metadata['mode']
+
+    @property
+    def trained(self) -> bool:
+        return self.metadata['lists'] > 0
+
+    def __len__(self) -> int:
+        return self.metadata['count'] - len(self.metadata['deleted'])
+
+    def _array_specs(self) -> dict:
+        # Data type and row width of each file
+        specs = {'vectors': ('<f4', self.metadata['dimensions']), 'hash_ids': (f'S{HASH_ID_BYTES}', None),
+                 'groups': ('<i2', None)}
+        if self.trained:
+            specs.update({'lists': ('<i4', None), 'codes': ('u1', self.metadata['subvectors'])})
+        return specs
+
+    def _path(self, name: str, extension: str = 'bin') -> str:
+        return os.path.join(self.directory, f"{name}.{self.metadata['generation']}.{extension}")
+
+    def _open_arrays(self) -> None:
+        import numpy as np
+
+        count = self.metadata['count']
+        self._arrays = {}
+        for name, (dtype, width) in self._array_specs().items():
+            shape = (count,) if width is None else (count, width)
+            # The files can be longer than the rows of the metadata, if a previous update was interrupted
+            self._arrays[name] = np.memmap(self._path(name), dtype=dtype, mode='r', shape=shape) if count else \
+                np.zeros(shape, dtype=dtype)
+        if self.trained:
+            self._arrays['centroids'] = np.load(self._path('centroids', 'npy'))
+            self._arrays['codebooks'] = np.load(self._path('codebooks', 'npy'))
+        self._inverted_lists = None
+
+    def save_metadata(self) -> None:
+        """
+        Persist the metadata of the index, which makes the rows appended to its files visible to the readers.
+        """
+        temp_path = os.path.join(self.directory, f"{METADATA_FILE}.tmp")
+        with open(temp_path, 'w') as metadata_file:
+            json.dump(self.metadata, metadata_file)
+        os.replace(temp_path, os.path.join(self.directory, METADATA_FILE))
+
+    def _append_rows(self, arrays: dict) -> None:
+        import numpy as np
+
+        for name, (dtype, width) in self._array_specs().items():
+            with open(self._path(name), 'ab') as array_file:
+                # The rows left by an interrupted update, which no reader can see, are overwritten
+                array_file.truncate(self.metadata['count'] * np.dtype(dtype).itemsize * (width or 1))
+                array_file.write(np.ascontiguousarray(arrays[name], dtype=dtype).tobytes())
+
+    def _write_generation(self, arrays: dict, metadata: dict) -> None:
+        """
+        Write a new generation of the index files, with the given arrays and the files of the current generation that
+        do not change, and switch the index to it.
+        :param arrays: new arrays, by file name
+        :param metadata: changes of the metadata
+        """
+        import numpy as np
+
+        previous_paths = {name: self._path(name) for name in self._array_specs()}
+        self.metadata.update(metadata, generation=self.metadata['generation'] + 1)
+        for name, (dtype, _) in self._array_specs().items():
+            if name in arrays:
+                with open(self._path(name), 'wb') as array_file:
+                    array_file.write(np.ascontiguousarray(arrays[name], dtype=dtype).tobytes())
+            else:
+                shutil.copyfile(previous_paths[name], self._path(name))
+        if self.trained:
+            for name in ('centroids', 'codebooks'):
+                np.save(self._path(name, 'npy'), arrays[name] if name in arrays else self._arrays[name])
+        self.save_metadata()
+        self._remove_other_generations()
+        self._open_arrays()
+
+    def _remove_other_generations(self) -> None:
+        # The processes that mapped the removed files keep reading them until they load the index again
+        for file_name in os.listdir(self.directory):
+            match = GENERATION_FILE_PATTERN.match(file_name)
+            if match and int(match.group(1)) != self.metadata['generation']:
+                try:
+                    os.remove(os.path.join(self.directory, file_name))
+                except OSError:
+                    pass
+
+    def key_rows(self) -> Dict[tuple, int]:
+        """
+        Get the row of each live chunk of the index.
+        :return: dictionary with the row of each (collection, source, hash_id) key
+        """
+        groups = self.metadata['groups']
+        deleted = set(self.metadata['deleted'])
+        return {(*groups[group], hash_id.decode('ascii')): row
+                for row, (group, hash_id) in enumerate(zip(self._arrays['groups'].tolist(),
+                                                           self._arrays['hash_ids'].tolist()))
+                if row not in deleted}
+
+    def append(self, collection_name: str, keys: List[tuple], vectors) -> None:
+        """
+        Append the vectors of some chunks of a collection to the index.
+        :param collection_name: collection of the chunks
+        :param keys: list with the source and the hash_id of each chunk
+        :param vectors: 2D array with the vector of each chunk
+        """
+        import numpy as np
+
+        if not keys:
+            return
+        vectors = normalize_rows(vectors)
+        groups = []
+        for source, _ in keys:
+            group = (collection_name, source)
+            if group not in self._group_codes:
+                self._group_codes[group] = len(self.metadata['groups'])
+                self.metadata['groups'].append(list(group))
+            groups.append(self._group_codes[group])
+
+        arrays = {'vectors': vectors, 'hash_ids': np.array([hash_id.encode('ascii') for _, hash_id in keys],
+                                                           dtype=f'S{HASH_ID_BYTES}'), 'groups': groups}
+        if self.trained:
+            arrays['lists'], arrays['codes'] = encode(vectors, self._arrays['centroids'], self._arrays['codebooks'])
+        self._append_rows(arrays)
+        self.metadata['count'] += len(keys)
+        self.save_metadata()
+        self._open_arrays()
+
+    def remove(self, rows: List[int]) -> None:
+        """
+        Mark some rows as removed. They are no longer returned, and are compacted away by maintain().
+        :param rows: rows to remove
+        """
+        if rows:
+            self.metadata['deleted'] = sorted(set(self.metadata['deleted']).union(rows))
+            self.save_metadata()
+            self._inverted_lists = None
+
+    def maintain(self, lists: int = VECTOR_INDEX_LISTS, subvectors: int = VECTOR_INDEX_SUBVECTORS) -> None:
+        """
+        Compact the index if too many rows are removed and, in the 'ivfpq' mode, train the lists and the codebooks if
+        they are not trained or the index has grown too much since they were.
+        :param lists: number of lists (0 to use the square root of the number of vectors)
+        :param subvectors: maximum number of sub-vectors of the codes
+        """
+        if len(self.metadata['deleted']) > VECTOR_INDEX_COMPACT_RATIO * self.metadata['count']:
+            self.compact()
+        if self.mode == 'ivfpq' and len(self) and (
+                not self.trained or len(self) > VECTOR_INDEX_RETRAIN_GROWTH * self.metadata['trained_count']):
+            self.train(lists, subvectors)
+
+    def _live_rows(self) -> 'np.ndarray':
+        import numpy as np
+
+        return np.setdiff1d(np.arange(self.metadata['count']), np.array(self.metadata['deleted'], dtype=np.int64))
+
+    def compact(self) -> None:
+        """
+        Rewrite the files of the index without the removed rows.
+        """
+        live_rows = self._live_rows()
+        logging.info(f"{len(self.metadata['deleted'])} removed rows are compacted away from the vector index")
+        self._write_generation({name: self._arrays[name][live_rows] for name in self._array_specs()},
+                               {'count': len(live_rows), 'deleted': []})
+
+    def train(self, lists: int = VECTOR_INDEX_LISTS, subvectors: int = VECTOR_INDEX_SUBVECTORS, seed: int = 0) -> None:
+        """
+        Train the lists and the product quantization codebooks of the 'ivfpq' mode on a sample of the live vectors, and
+        encode every row with them.
+        :param lists: number of lists (0 to use the square root of the number of vectors)
+        :param subvectors: maximum number of sub-vectors of the codes (the largest divisor of the dimensions that is
+        not above it is used)
+        :param seed: seed of the sample and of k-means
+        """
+        import numpy as np
+
+        rng = np.random.default_rng(seed)
+        live_rows = self._live_rows()
+        lists = min(lists or max(1, round(math.sqrt(len(live_rows)))), len(live_rows))
+        codewords = min(MAX_CODEWORDS, len(live_rows))
+        # The sample is in random order, so any prefix of it is a random sample too
+        sample = np.asarray(self._arrays['vectors'][rng.choice(
+            live_rows, min(TRAINING_POINTS_PER_CENTROID * max(lists, codewords), len(live_rows)), replace=False)])
+        dimensions = self.metadata['dimensions']
+        subvectors = max(divisor for divisor in range(1, min(subvectors, dimensions) + 1) if dimensions % divisor == 0)
+
+        centroids = kmeans(sample[:TRAINING_POINTS_PER_CENTROID * lists], lists, seed=seed)
+        residuals = (sample - centroids[nearest_centroids(sample, centroids)]).reshape(len(sample), subvectors, -1)
+        codebooks = np.stack([kmeans(residuals[:, part], codewords, seed=seed) for part in range(subvectors)])
+
+        # Every row is encoded again (including the removed ones, so the rows of all the files match)
+        encoded = [encode(self._arrays['vectors'][start:start + SEARCH_BLOCK_ROWS], centroids, codebooks)
+                   for start in range(0, self.metadata['count'], SEARCH_BLOCK_ROWS)]
+        self._write_generation({'centroids': centroids, 'codebooks': codebooks,
+                                'lists': np.concatenate([row_lists for row_lists, _ in encoded]),
+                                'codes': np.concatenate([codes for _, codes in encoded])},
+                               {'lists': lists, 'subvectors': subvectors, 'trained_count': len(live_rows)})
+        logging.info(f"The vector index was trained with {lists} lists and {subvectors} sub-vectors on "
+                     f"{len(sample)} vectors")
+
+    def search(self, queries, k: int = 10, probes: int = VECTOR_INDEX_PROBES,
+               rerank: int = VECTOR_INDEX_RERANK) -> List[List[SearchResult]]:
+        """
+        Find the chunks whose vectors are the most similar to a batch of queries.
+        :param queries: vector or 2D array with a vector per query (of the embedding model of the index)
+        :param k: number of results of each query
+        :param probes: number of lists scored for each query ('ivfpq' mode)
+        :param rerank: candidates rescored with their exact vectors for each result ('ivfpq' mode)
+        :return: list with the results of each query, from the most to the least similar
+        """
+        queries = normalize_rows(queries)
+        if not len(self) or k <= 0:
+            return [[] for _ in queries]
+        if self.mode == 'ivfpq' and self.trained:
+            rows, scores = self._search_ivfpq(queries, k, probes, rerank)
+        else:
+            rows, scores = self._search_exact(queries, k)
+
+        groups = self.metadata['groups']
+        results = []
+        for query_rows, query_scores in zip(rows, scores):
+            results.append([SearchResult(float(score), *groups[self._arrays['groups'][row]],
+                                         self._arrays['hash_ids'][row].decode('ascii'))
+                            for row, score in zip(query_rows.tolist(), query_scores.tolist()) if score > -math.inf])
+        return results
+
+    def _search_exact(self, queries: 'np.ndarray', k: int) -> tuple:
+        import numpy as np
+
+        deleted = np.array(self.metadata['deleted'], dtype=np.int64)
+        best_rows = np.empty((len(queries), 0), dtype=np.int64)
+        best_scores = np.empty((len(queries), 0), dtype=np.float32)
+        # The vectors are scored in blocks, keeping the best k rows of each query
+        for start in range(0, self.metadata['count'], SEARCH_BLOCK_ROWS):
+            block = np.asarray(self._arrays['vectors'][start:start + SEARCH_BLOCK_ROWS])
+            scores = queries @ block.T
+            block_deleted = deleted[(deleted >= start) & (deleted < start + len(block))] - start
+            scores[:, block_deleted] = -np.inf
+            rows = np.concatenate([best_rows, np.broadcast_to(np.arange(start, start + len(block)), scores.shape)],
+                                  axis=1)
+            scores = np.concatenate([best_scores, scores], axis=1)
+            columns = top_k(scores, k)
+            best_rows = np.take_along_axis(rows, columns, axis=1)
+            best_scores = np.take_along_axis(scores, columns, axis=1)
+        return best_rows, best_scores
+
+    def _get_inverted_lists(self) -> tuple:
+        import numpy as np
+
+        if self._inverted_lists is None:
+            live_rows = self._live_rows()
+            row_lists = np.asarray(self._arrays['lists'][live_rows])
+            order = live_rows[np.argsort(row_lists, kind='stable')]
+            offsets = np.concatenate(([0], np.cumsum(np.bincount(row_lists, minlength=self.metadata['lists']))))
+            self._inverted_lists = order, offsets
+        return self._inverted_lists
+
+    def _search_ivfpq(self, queries: 'np.ndarray', k: int, probes: int, rerank: int) -> tuple:
+        import numpy as np
+
+        order, offsets = self._get_inverted_lists()
+        centroids, codebooks = self._arrays['centroids'], self._arrays['codebooks']
+        coarse_scores = queries @ centroids.T
+        probed_lists = top_k(coarse_scores, min(probes, len(centroids)))
+        # Score of each codeword of each sub-vector for each query: the score of a row is the score of its list plus
+        # the scores of its codewords
+        subvectors = len(codebooks)
+        lookup_tables = np.einsum('qms,mcs->qmc', queries.reshape(len(queries), subvectors, -1), codebooks)
+
+        best_rows = np.full((len(queries), k), -1, dtype=np.int64)
+        best_scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        for query, lists in enumerate(probed_lists):
+            rows = np.sort(np.concatenate([order[offsets[row_list]:offsets[row_list + 1]] for row_list in lists]))
+            if not rows.size:
+                continue
+            approximate = coarse_scores[query, self._arrays['lists'][rows]] + \
+                lookup_tables[query][np.arange(subvectors), self._arrays['codes'][rows]].sum(axis=1)
+            candidates = np.sort(rows[top_k(approximate[None], k * max(rerank, 1))[0]])
+            scores = np.asarray(self._arrays['vectors'][candidates]) @ queries[query]
+            columns = top_k(scores[None], k)[0]
+            best_rows[query, :len(columns)] = candidates[columns]
+            best_scores[query, :len(columns)] = scores[columns]
+        return best_rows, best_scores
+
+
+def read_vectors(collection, keys: List[tuple], model_id: str, batch_size: int = VECTOR_INDEX_BATCH_SIZE):
+    """
+    Read the vectors of some chunks of a collection, in batches.
+    :param collection: database collection object
+    :param keys: list with the source and the hash_id of each chunk
+    :param model_id: embedding model of the vectors (the chunks without a vector of this model are skipped)
+    :param batch_size: maximum number of vectors read from the database in each query
+    :return: generator of lists with the source, the hash_id and the vector of each chunk of a batch
+    """
+    for start in range(0, len(keys), batch_size):
+        batch_keys = set(keys[start:start + batch_size])
+        rows = [row for row in collection.find(
+            {'source': {'$in': list({source for source, _ in batch_keys})},
+             'hash_id': {'$in': [hash_id for _, hash_id in batch_keys]}},
+            {'_id': 0, 'source': 1, 'hash_id': 1, EMBEDDING_FIELD: 1, EMBEDDING_MODEL_FIELD: 1})
+            if (row['source'], row['hash_id']) in batch_keys and row.get(EMBEDDING_MODEL_FIELD) == model_id and
+            len(row['hash_id']) <= HASH_ID_BYTES]
+        if rows:
+            yield rows
+
+
+def update_vector_index(db, directory: str = VECTOR_INDEX_DIR, collections: List[str] = VECTOR_INDEX_COLLECTIONS,
+                        mode: str = VECTOR_INDEX_MODE, batch_size: int = VECTOR_INDEX_BATCH_SIZE,
+                        changes: Optional[dict] = None) -> Optional[dict]:
+    """
+    Update the vector index with the chunks stored in the database. If the changes of the run are given and the index
+    has every previous update, only the vectors of the chunks embedded by the run are read and the chunks removed by it
+    are removed. Otherwise the index is reconciled with the database: the chunks with a vector of the current embedding
+    model that are not indexed are appended, and the indexed chunks that are no longer stored (or no longer have such a
+    vector) are removed. The index is built again if the model or the mode changed.
+    :param db: database object
+    :param directory: directory of the index files
+    :param collections: collections whose chunks are indexed
+    :param mode: 'exact' or 'ivfpq' (see VECTOR_INDEX_MODE)
+    :param batch_size: maximum number of vectors read from the database in each query
+    :param changes: keys of the chunks embedded and removed by the run, by collection (see start_vector_index_run)
+    :return: dictionary with the number of added, removed and indexed chunks, or None if the database failed
+    """
+    import numpy as np
+
+    model_id = load_embedding_backend(EMBEDDING_BACKEND).model_id
+    index = VectorIndex.load(directory)
+    if index is not None and (index.model_id != model_id or index.mode != mode):
+        logging.info(f"The vector index of the '{index.model_id}' model in '{index.mode}' mode is built again")
+        index = None
+    stats = {'added': 0, 'removed': 0}
+    try:
+        version = db[VECTOR_INDEX_STATE_COLLECTION].find_one_and_update(
+            {'_id': 'vector_index'}, {'$inc': {'version': 1}}, upsert=True,
+            return_document=ReturnDocument.AFTER)['version']
+        incremental = index is not None and changes is not None and index.metadata.get('version') == version - 1
+        if index is not None and not incremental:
+            logging.info("The vector index missed some updates, so it is reconciled with the database")
+        indexed = index.key_rows() if index is not None else {}
+        for collection_name in collections:
+            collection = db[collection_name]
+            if incremental:
+                collection_changes = changes.get(collection_name, {})
+                new_keys = list(collection_changes.get('added', ()))
+                # The chunks embedded again replace their rows
+                removed_rows = [indexed[(collection_name, *key)] for key in
+                                set(collection_changes.get('removed', ())).union(new_keys)
+                                if (collection_name, *key) in indexed]
+            else:
+                stored = {(row['source'], row['hash_id']) for row in collection.find(
+                    {EMBEDDING_MODEL_FIELD: model_id}, {'_id': 0, 'source': 1, 'hash_id': 1})}
+                removed_rows = [row for (key_collection, *key), row in indexed.items()
+                                if key_collection == collection_name and tuple(key) not in stored]
+                new_keys = [key for key in stored if (collection_name, *key) not in indexed]
+
+            if index is not None:
+                index.remove(removed_rows)
+                stats['removed'] += len(removed_rows)
+            for rows in read_vectors(collection, new_keys, model_id, batch_size):
+                vectors = np.frombuffer(b''.join(row[EMBEDDING_FIELD] for row in rows), dtype=np.float32)
+                if index is None:
+                    index = VectorIndex.create(directory, model_id, len(rows[0][EMBEDDING_FIELD]) // 4, mode)
+                index.append(collection_name, [(row['source'], row['hash_id']) for row in rows],
+                             vectors.reshape(len(rows), -1))
+                stats['added'] += len(rows)
+    except pymongo_errors.PyMongoError as e:
+        logging.error(f"Failed to update the vector index: {e}")
+        return None
+
+    if index is None:
+        logging.info("There are no embedded chunks to index")
+        return None
+    index.maintain()
+    index.metadata['version'] = version
+    index.save_metadata()
+    stats['indexed'] = len(index)
+    logging.info(f"Vector index updated: {stats['added']} chunks were added and {stats['removed']} were removed, "
+                 f"{stats['indexed']} chunks are indexed")
+    return stats
+
+
+def start_vector_index_run(enabled: Optional[bool] = None) -> None:
+    """
+    Start recording the chunks embedded and removed in a run, if the vector index is enabled.
+    :param enabled: update the vector index (VECTOR_INDEX_ENABLED if None)
+    """
+    global _run_changes
+    with _run_changes_lock:
+        _run_changes = {} if (VECTOR_INDEX_ENABLED if enabled is None else enabled) else None
+
+
+def record_vector_changes(collection_name: str, added: Iterable[tuple] = (), removed: Iterable[tuple] = ()) -> None:
+    """
+    Record the chunks of a collection embedded and removed in the current run, if it is recorded.
+    :param collection_name: collection of the chunks
+    :param added: source and hash_id of each embedded chunk
+    :param removed: source and hash_id of each removed chunk
+    """
+    with _run_changes_lock:
+        if _run_changes is None:
+            return
+        collection_changes = _run_changes.setdefault(collection_name, {'added': set(), 'removed': set()})
+        collection_changes['added'].update(added)
+        collection_changes['removed'].update(removed)
+
+
+def finish_vector_index_run(db) -> Optional[dict]:
+    """
+    Update the vector index with the chunks embedded and removed in the run, and stop recording them.
+    :param db: database object
+    :return: dictionary with the number of added, removed and indexed chunks, or None if the index is disabled or the
+    database failed
+    """
+    global _run_changes
+    with _run_changes_lock:
+        changes, _run_changes = _run_changes, None
+    if changes is None:
+        return None
+    return update_vector_index(db, changes=changes)
+
+
+def get_vector_index(directory: str = VECTOR_INDEX_DIR) -> Optional[VectorIndex]:
+    """
+    Get the vector index stored in a directory, loading it on first use (the warm invocations of the same Lambda
+    environment reuse it) and again whenever it has been updated.
+    :param directory: directory of the index files
+    :return: VectorIndex object, or None if there is no index
+    """
+    global _index, _index_mtime
+    try:
+        mtime = os.stat(os.path.join(directory, METADATA_FILE)).st_mtime_ns
+    except OSError:
+        return None
+    with _index_lock:
+        if _index is None or _index.directory != directory or _index_mtime != mtime:
+            _index, _index_mtime = VectorIndex.load(directory), mtime
+        return _index
+
+
+def retrieve(db, query: str, k: int = 5, collections: Optional[List[str]] = None,
+             directory: str = VECTOR_INDEX_DIR) -> List[dict]:
+    """
+    Retrieve the chunks most similar to a query: the query is embedded with the embedding backend, searched in the
+    vector index, and only the documents of the results are read from the database.
+    :param db: database object
+    :param query: text of the query
+    :param k: number of chunks
+    :param collections: only return the chunks of these collections (all of them if None)
+    :param directory: directory of the index files
+    :return: list with the document of each chunk, plus its 'collection' and its 'score', from the most similar
+    """
+    global _query_backend
+    index = get_vector_index(directory)
+    if index is None:
+        logging.warning(f"There is no vector index in {directory}")
+        return []
+    with _index_lock:
+        if _query_backend is None:
+            _query_backend = load_embedding_backend(EMBEDDING_BACKEND)
+    if _query_backend.model_id != index.model_id:
+        raise ValueError(f"The vector index has vectors of the '{index.model_id}' model, not of the "
+                         f"'{_query_backend.model_id}' model")
+
+    # More results are searched when they are filtered by collection
+    results = index.search(_query_backend.embed([query]), k if collections is None else k * 4)[0]
+    results = [result for result in results if collections is None or result.collection in collections][:k]
+    documents = {}
+    for collection_name in dict.fromkeys(result.collection for result in results):
+        keys = [(result.source, result.hash_id) for result in results if result.collection == collection_name]
+        for document in db[collection_name].find({'source': {'$in': list({source for source, _ in keys})},
+                                                  'hash_id': {'$in': [hash_id for _, hash_id in keys]}},
+                                                 {'_id': 0, EMBEDDING_FIELD: 0}):
+            documents[(collection_name, document['source'], document['hash_id'])] = document
+    return [{**documents[key], 'collection': result.collection, 'score': result.score}
+            for result in results for key in [(result.collection, result.source, result.hash_id)]
+            if key in documents]
@@ -1,64 +1,70 @@
 import logging
 import time
-import pandas as pd
+from typing import Iterator
 import requests
 from bs4 import BeautifulSoup
 
-from src.utils.general_functions import insert_df_into_db, calculate_hash, split_text_into_chunks
+from src.utils.chunk_record import ChunkRecord
+from src.utils.db_sync import insert_records_into_db
+from src.utils.general_functions import AIRZONE_API_URL, calculate_hash, split_text_into_chunks
+from src.utils.metrics import timer
+from src.utils.source_manifest import calculate_payloads_digest, is_source_unchanged, record_source_digest
+from src.utils.text_normalizer import clean_text
+
+ACADEMIA_ENDPOINT = f'{AIRZONE_API_URL}/msacademy.pv1/courses/'
+PARTNERS_ENDPOINT = f'{AIRZONE_API_URL}/mscrm.pv1/crm-associates/categories'
+
+
+def iter_academia_records(response_json) -> Iterator[ChunkRecord]:
+    """
+    Process the Academia courses, yielding the chunks of their descriptions one by one.
+    :param response_json: JSON response of the courses endpoint
+    :return: generator of ChunkRecord objects
+    """
+    courses = response_json['body']['courses']
+
+    # If the categories are found in the response, extract the 'name' values for each list element in
+    # 'digital_sections'
+    for course in courses or []:
+        course_title = course['title']
+        course_raw_description = course['description']
+
+        with timer('parse'):
+            # In order to clean the description, we will use BeautifulSoup
+            soup = BeautifulSoup(course_raw_description, 'html.parser')
+            for p_tag in soup.find_all('p'):
+                if p_tag.find('strong'):
+                    p_tag.decompose()
+                    break
+
+            # Clean the final description removing double whitespaces and whitespaces before a dot
+            course_clean_description = clean_text(soup.text.lstrip('Webinar'))
+
+        chunks = split_text_into_chunks(course_clean_description, chunk_size=1000, chunk_overlap=200)
+
+        for i, text in enumerate(chunks):
+            # Calculate the hash_id based on the title and the description
+            hash_id_data = f"{course_title}{text}"
+            hash_id = calculate_hash(hash_id_data)
+
+            yield ChunkRecord.create(hash_id, 'Academia', course_title, text)
 
 
 def academia_scraper(session, db_connection):
     logging.info("Starting the 'Academia' scraper...")
     try:
-        support_endpoint = 'https://api.airzonecloud.com/msacademy.pv1/courses/'
-        response = session.get(support_endpoint)
-        response_json = response.json()
-
-        courses = response_json['body']['courses']
-
-        # If the categories are found in the response, extract the 'name' values for each list element in
-        # 'digital_sections'
-        course_list = []
-        if courses:
-            for course in courses:
-                course_title = course['title']
-                course_raw_description = course['description']
-
-                # In order to clean the description, we will use BeautifulSoup
-                soup = BeautifulSoup(course_raw_description, 'html.parser')
-                for p_tag in soup.find_all('p'):
-                    if p_tag.find('strong'):
-                        p_tag.decompose()
-                        break
-
-                # Clean the final description removing double whitespaces and whitespaces before a dot
-                course_clean_description = soup.text.lstrip('Webinar').replace(" .", ".").replace("   ", " ").replace(
-                    "  ",
-                    " ").replace(
-                    "\n", " ").strip()
-
-                chunks = split_text_into_chunks(course_clean_description, chunk_size=1000, chunk_overlap=200)
-
-                for i, text in enumerate(chunks):
-                    # Calculate the hash_id based on the title and the description
-                    hash_id_data = f"{course_title}{text}"
-                    hash_id = calculate_hash(hash_id_data)
-
-                    chunk_dict = {
-                        'hash_id': hash_id,
-                        'upload_date': time.strftime('%Y-%m-%d %H:%M:%S'),
-                        'source': 'Academia',
-                        'title': course_title,
-                        'description': text
-                    }
-                    course_list.append(chunk_dict)
-
-            logging.info("Inserting the 'Academia' scraped data into a dataframe...")
-            df = pd.DataFrame(course_list)
-
-            logging.info("Inserting the 'Academia' data into the database...")
-            collection = db_connection['academia']
-            insert_df_into_db(collection, df)
+        response = session.get(ACADEMIA_ENDPOINT)
+
+        # The courses are only processed if they have changed since the last successful run
+        digest = calculate_payloads_digest([response.content])
+        collection = db_connection['academia']
+        if is_source_unchanged(collection, digest):
+            return
+
+        # The chunks are written into the database in batches while the courses are being processed
+        logging.info("Inserting the 'Academia' data into the database...")
+        if insert_records_into_db(collection, iter_academia_records(response.json())) is not None:
+            record_source_digest(collection, digest)
 
     except requests.exceptions.Timeout as e:
         logging.error(f"Request timed out: {str(e)}")
@@ -68,48 +74,51 @@ def academia_scraper(session, db_connection):
         logging.error(f"An error occurred in the academia_scraper function: {str(e)}")
 
 
+def iter_partner_records(response_json) -> Iterator[dict]:
+    """
+    Process the Airzone partners, yielding them one by one.
+    :param response_json: JSON response of the partner categories endpoint
+    :return: generator of partner dicts
+    """
+    partner_categories = response_json['body']['categories']['data']
+    for category in partner_categories:
+        category_name = category['name']
+        for partner in category['associates']:
+            name = partner['name']
+            alias = partner['alias']
+            address = partner['address']
+            city = partner['city']
+            postal_code = partner['postal_code']
+            phone = partner['phone']
+            email = partner['email']
+
+            # Include primary_hash_id and mod_hash_id
+            hash_id_data = f"{category_name}{name}{address}{city}{postal_code}{phone}{email}{alias}"
+            hash_id = calculate_hash(hash_id_data)
+
+            yield {'hash_id': hash_id,
+                   'uploaded_date': time.strftime('%Y-%m-%d %H:%M:%S'),
+                   'source': 'Partner',
+                   'category': category_name,
+                   'name': name, 'alias': alias, 'address': address,
+                   'city': city, 'postal_code': postal_code, 'phone': phone, 'email': email}
+
+
 def partner_scraper(session, db_connection):
     logging.info("Starting the 'Partner' scraper...")
     try:
-        partners_endpoint = 'https://api.airzonecloud.com/mscrm.pv1/crm-associates/categories'
-        response = session.get(partners_endpoint)
-
-        partner_list = []
-        response_json = response.json()
-        partner_categories = response_json['body']['categories']['data']
-        for category in partner_categories:
-            category_name = category['name']
-            for partner in category['associates']:
-                name = partner['name']
-                alias = partner['alias']
-                address = partner['address']
-                city = partner['city']
-                postal_code = partner['postal_code']
-                phone = partner['phone']
-                email = partner['email']
-
-                # Include primary_hash_id and mod_hash_id
-                hash_id_data = f"{category_name}{name}{address}{city}{postal_code}{phone}{email}{alias}"
-                hash_id = calculate_hash(hash_id_data)
-
-                partner_dict = {'hash_id': hash_id,
-                                'uploaded_date': time.strftime('%Y-%m-%d %H:%M:%S'),
-                                'source': 'Partner',
-                                'category': category_name,
-                                'name': name, 'alias': alias, 'address': address,
-                                'city': city, 'postal_code': postal_code, 'phone': phone, 'email': email}
-
-                partner_list.append(partner_dict)
-
-        logging.info("Inserting the 'Partner' scraped data into a dataframe...")
-
-        # Store the data from the partner_list the dataframe
-        df = pd.DataFrame(partner_list)
+        response = session.get(PARTNERS_ENDPOINT)
+
+        # The partners are only processed if they have changed since the last successful run
+        digest = calculate_payloads_digest([response.content])
+        collection = db_connection['partner']
+        if is_source_unchanged(collection, digest):
+            return
 
         logging.info("Inserting the 'Partner' data into the database...")
 
-        collection = db_connection['partner']
-        insert_df_into_db(collection, df)
+        if insert_records_into_db(collection, iter_partner_records(response.json())) is not None:
+            record_source_digest(collection, digest)
 
     except requests.exceptions.Timeout as e:
         logging.error(f"Request timed out: {str(e)}")
@@ -1,93 +1,85 @@
 import logging
-import re
-import time
-import pandas as pd
+from typing import Iterator
 import requests
 from bs4 import BeautifulSoup
 
-from src.utils.general_functions import calculate_hash, insert_df_into_db, extract_json_text, split_text_into_chunks
+from src.utils.chunk_record import ChunkRecord
+from src.utils.db_sync import insert_records_into_db
+from src.utils.general_functions import AIRZONE_API_URL, MYZONE_URL, calculate_hash, extract_json_text, \
+    split_text_into_chunks
+from src.utils.metrics import timer
+from src.utils.source_manifest import calculate_payloads_digest, is_source_unchanged, record_source_digest
+from src.utils.text_normalizer import HtmlNormalizer
+
+TRANSLATIONS_ENDPOINT = f'{AIRZONE_API_URL}/msairpress.pv1/translations/es-ES'
+# Footer sections of the Myzone website
+FOOTER_ENDPOINTS = (('Política de privacidad', f'{MYZONE_URL}/politica-privacidad'),
+                    ('Condiciones de uso', f'{MYZONE_URL}/condiciones-uso'),
+                    ('Aviso legal', f'{MYZONE_URL}/aviso-legal'),
+                    ('Política de cookies', f'{MYZONE_URL}/politica-cookies'))
+# Conversion of the footer sections into text: the 'h5' title, the paragraphs and the numbered lists
+FOOTER_NORMALIZER = HtmlNormalizer(title_tag='h5', string_separator=None, cleanup='collapse')
+
+
+def iter_general_information_records(response_json, footer_pages) -> Iterator[ChunkRecord]:
+    """
+    Process the Airzone Control translations and the Myzone footer pages, yielding their chunks one by one.
+    :param response_json: JSON response of the translations endpoint
+    :param footer_pages: list of tuples with the title and the HTML of each footer page
+    :return: generator of ChunkRecord objects
+    """
+    # Iterate over the items in the "body" object
+    key = None
+    for key, value in response_json["body"].items():
+        with timer('parse'):
+            text = extract_json_text(value)
 
+        chunks = split_text_into_chunks(text, chunk_size=500, chunk_overlap=100)
 
-def general_information_scraper(session, db):
-    logging.info("Starting the General Information scraper...")
-    try:
-        translations_endpoint = 'https://api.airzonecloud.com/msairpress.pv1/translations/es-ES'
-        response = session.get(translations_endpoint)
-        response_json = response.json()
-        general_information_list = []
+        for i, text in enumerate(chunks):
+            hash_id_data = f"{key}{text}"
+            hash_id = calculate_hash(hash_id_data)
 
-        # Iterate over the items in the "body" object
-        for key, value in response_json["body"].items():
-            text = extract_json_text(value)
+            yield ChunkRecord.create(hash_id, 'Airzone Control', key, text)
+
+    # Next, process the footer sections from Myzone website
+    for title, html in footer_pages:
+        with timer('parse'):
+            soup = BeautifulSoup(html, 'html.parser')
+            sections = soup.select('div.col-md-10 > div.row')
+        for section in sections:
+            section_name, clean_description = FOOTER_NORMALIZER.normalize_section(section)
+            if section_name is None:
+                continue
 
-            chunks = split_text_into_chunks(text, chunk_size=500, chunk_overlap=100)
+            chunks = split_text_into_chunks(clean_description, chunk_size=1000, chunk_overlap=200)
 
             for i, text in enumerate(chunks):
                 hash_id_data = f"{key}{text}"
                 hash_id = calculate_hash(hash_id_data)
 
-                chunk_dict = {
-                    'hash_id': hash_id,
-                    'upload_date': time.strftime('%Y-%m-%d %H:%M:%S'),
-                    'source': 'Airzone Control',
-                    'title': key,
-                    'description': text
-                }
-                general_information_list.append(chunk_dict)
-
-        # Next, get the footer sections from Myzone website
-        endpoints = (('Política de privacidad', 'https://myzone.airzone.es/politica-privacidad'),
-                     ('Condiciones de uso', 'https://myzone.airzone.es/condiciones-uso'),
-                     ('Aviso legal', 'https://myzone.airzone.es/aviso-legal'),
-                     ('Política de cookies', 'https://myzone.airzone.es/politica-cookies'))
-
-        footer_list = []
-        for endpoint in endpoints:
-            response = session.get(endpoint[1])
-            soup = BeautifulSoup(response.text, 'html.parser')
-            sections = soup.select('div.col-md-10 > div.row')
-            for section in sections:
-                description = ''
-                section_name = None
-                for tag in section.contents:
-                    if tag.name == 'h5':
-                        section_name = tag.text.strip().capitalize()
-                    elif tag.name == 'p':
-                        description += tag.text.strip() + " "
-                    elif tag.name == 'ul' or tag.name == 'ol':
-                        list_number = 1
-                        for li in tag.contents:
-                            if li.name == 'li':
-                                description += str(list_number) + ") " + li.text.strip() + " "
-                                list_number += 1
-
-                if section_name is not None:
-                    clean_description = re.sub(r'\s+', ' ', description).strip()
-                    footer_list.append((endpoint[0], clean_description))
-
-        for item in footer_list:
-            chunks = split_text_into_chunks(item[1], chunk_size=1000, chunk_overlap=200)
+                yield ChunkRecord.create(hash_id, 'Myzone', title, text)
 
-            for i, text in enumerate(chunks):
-                hash_id_data = f"{key}{text}"
-                hash_id = calculate_hash(hash_id_data)
 
-                chunk_dict = {
-                    'hash_id': hash_id,
-                    'upload_date': time.strftime('%Y-%m-%d %H:%M:%S'),
-                    'source': 'Myzone',
-                    'title': item[0],
-                    'description': text
-                }
-                general_information_list.append(chunk_dict)
+def general_information_scraper(session, db):
+    logging.info("Starting the General Information scraper...")
+    try:
+        translations_response = session.get(TRANSLATIONS_ENDPOINT)
+        footer_responses = [(title, session.get(url)) for title, url in FOOTER_ENDPOINTS]
 
-        logging.info("Inserting the General Information scraped data into a dataframe...")
-        # Store the categories, units, subunits and descriptions in the dataframe
-        df = pd.DataFrame(general_information_list)
+        # The pages are only processed if any of them has changed since the last successful run
+        digest = calculate_payloads_digest(
+            [translations_response.content] + [response.content for _, response in footer_responses])
+        collection = db['general_information']
+        if is_source_unchanged(collection, digest):
+            return
 
+        # The chunks are written into the database in batches while the pages are being processed
         logging.info("Inserting the General Information data into the database...")
-        collection = db['general_information']
-        insert_df_into_db(collection, df)
+        footer_pages = [(title, response.text) for title, response in footer_responses]
+        records = iter_general_information_records(translations_response.json(), footer_pages)
+        if insert_records_into_db(collection, records) is not None:
+            record_source_digest(collection, digest)
 
     except requests.exceptions.Timeout as e:
         logging.error(f"Request timed out: {str(e)}")
@@ -1,42 +1,112 @@
 import asyncio
 import logging
+import os
 import re
 import aiohttp
-from bs4 import BeautifulSoup
-from bs4 import NavigableString
-import pandas as pd
-import time
+from collections import deque
+from functools import lru_cache
+
+from src.utils.chunk_record import ChunkRecord
+from src.utils.db_sync import DocumentSync, log_sync_stats
+from src.utils.general_functions import AVAILABLE_CPUS, MYZONE_URL, calculate_hash, create_client_session, \
+    create_cpu_executor, fetch, fetch_cached, run_in_executor, split_text_into_chunks
+from src.utils.html_parsing import HTML_PARTIAL_PARSING, get_parser_backend, parse_html, parse_product_page_html
+from src.utils.http_cache import get_http_cache, processing_version
+from src.utils.metrics import timer
+from src.utils.profiling import profiled_stage
+from src.utils.text_normalizer import HtmlNormalizer
+
+
+# Executor of the parsing stage: 'process' (a process pool, when available) or 'thread'
+PRODUCTS_PARSE_EXECUTOR = os.environ.get('PRODUCTS_PARSE_EXECUTOR', 'process')
+# Number of workers parsing the product pages, one per available core by default
+PRODUCTS_PARSE_WORKERS = int(os.environ.get('PRODUCTS_PARSE_WORKERS', AVAILABLE_CPUS))
+# Number of workers downloading the product pages
+PRODUCTS_FETCH_WORKERS = int(os.environ.get('PRODUCTS_FETCH_WORKERS', 10))
+# Maximum number of downloaded product pages waiting to be parsed
+PRODUCTS_PARSE_QUEUE_SIZE = int(os.environ.get('PRODUCTS_PARSE_QUEUE_SIZE', 20))
+
+PRODUCTS_SOURCE = 'Airzone Products'
+PRODUCT_FAQS_SOURCE = 'Product FAQs'
+
+# Conversion of the product descriptions and of the FAQ answers into text: paragraphs, numbered lists and non-blank
+# strings
+PRODUCT_NORMALIZER = HtmlNormalizer(skip_blank_strings=True)
+# Chunk size and overlap of the product descriptions and of the FAQ answers
+PRODUCT_CHUNK_SIZE = 1000
+PRODUCT_CHUNK_OVERLAP = 200
+
+
+def parse_products_index(response: str, backend: str = None) -> list:
+    """
+    Parse the categories, units and subunits of the Myzone products page.
+    :param response: HTML of the products page
+    :param backend: HTML parser backend (the one selected with HTML_PARSER if None)
+    :return: list of tuples with the category name, unit name, subunit name and subunit endpoint of each subunit
+    """
+    soup = parse_html(response, backend=backend)
+
+    categories = soup.find_all('h3', {'class': 'sidelines text-center'})
+
+    subunit_list = []
+    for category in categories:
+        category_name = category.text.strip()
+        units = category.find_next_sibling('ul').select('li.categoria')
+
+        for unit in units:
+            unit_name = unit.select('a > span.sidebar-nav-item')[0].text
+            subunits = unit.select('ul > li')
 
-from src.utils.general_functions import calculate_hash, insert_df_into_db, fetch, split_text_into_chunks
+            for subunit in subunits:
+                # If subunit text does not contain 'Ver todos'
+                if 'Ver todos' not in subunit.text:
+                    subunit_name = subunit.text.split('(')[0].strip()
+                    subunit_endpoint = subunit.select('a')[0]['href']
+                    subunit_list.append((category_name, unit_name, subunit_name, subunit_endpoint))
+    return subunit_list
+
+
+@lru_cache(maxsize=None)
+def get_processing_version() -> str:
+    """
+    Get the version of the parsing of the Myzone pages, so the results cached by a run that parsed them with other
+    parameters are not reused.
+    :return: version string
+    """
+    return processing_version(get_parser_backend(), HTML_PARTIAL_PARSING, PRODUCT_NORMALIZER, PRODUCT_CHUNK_SIZE,
+                              PRODUCT_CHUNK_OVERLAP)
 
 
-async def process_subunit(session, category_name, unit_name, subunit):
+async def process_subunit(session, category_name, unit_name, subunit_name, subunit_endpoint, executor, cache=None):
     """
-    Process a subunit.
+    Process a subunit, parsing its products grid in the executor.
     :param session: aiohttp session
     :param category_name: category name
     :param unit_name: unit name
-    :param subunit: subunit to process
-    :return:
+    :param subunit_name: subunit name
+    :param subunit_endpoint: subunit endpoint
+    :param executor: executor of the parsing stage
+    :param cache: HttpCache object used to skip the parsing of pages not modified since the last run
+    :return: list of tuples with the category, unit, subunit and product names and the product endpoint (None if the
+    subunit failed)
     """
-    subunit_name = subunit.text.split('(')[0].strip()
-    subunit_endpoint = subunit.select('a')[0]['href']
-    subunit_response = await fetch(session, f"https://myzone.airzone.es{subunit_endpoint}")
-    subunit_soup = BeautifulSoup(subunit_response, 'html.parser')
-
-    products = subunit_soup.select('div.col-xs-4.col-sm-3.col-lg-4.inner-bottom-xs.text-center.li-img-holder')
-
-    tasks = []
-    for product in products:
-        product_endpoint = product.select('a')[0]['href']
-        product_name = product.find_next_sibling('div').select('h2')[0].text
-
-        tasks.append(process_product(session, category_name, unit_name, subunit_name, product_name, product_endpoint))
+    subunit_url = f"{MYZONE_URL}{subunit_endpoint}"
+    try:
+        subunit_response, not_modified = await fetch_cached(session, subunit_url, cache)
+
+        products = cache.get_derived(subunit_url, get_processing_version()) if not_modified else None
+        if products is None:
+            with timer('parse'):
+                products = await run_in_executor(executor, parse_subunit_page, subunit_response)
+            if cache is not None:
+                cache.set_derived(subunit_url, products, get_processing_version())
+    except Exception as e:
+        # A failed subunit does not stop the rest of the crawl
+        logging.error(f"Failed to process the subunit {subunit_url}: {e}")
+        return None
 
-        # The previous line does not take into account that process_product returns two values, so we need to change
-        # it to: product_dict, faqs = await process_product(session, category_name, unit_name, subunit_name,
-        # product_name, product_endpoint) tasks.append((product_dict, faqs))
-    return await asyncio.gather(*tasks)
+    return [(category_name, unit_name, subunit_name, product_name, product_endpoint)
+            for product_endpoint, product_name in products]
 
 
 # If question starts with a number followed by a dot, it will be a 'Preguntas Frecuentes' question
@@ -52,57 +122,56 @@ def determine_question_type(question):
         return 'Autodiagnostico'
 
 
-async def process_product(session, category_name, unit_name, subunit_name, product_name, product_endpoint):
+def parse_subunit_page(subunit_response: str, backend: str = None) -> list:
     """
-    Process a product, including its FAQs.
-    :param session: aiohttp session
+    Parse the products grid of a subunit page.
+    :param subunit_response: HTML of the subunit page
+    :param backend: HTML parser backend (the one selected with HTML_PARSER if None)
+    :return: list of tuples with the endpoint and the name of each product
+    """
+    subunit_soup = parse_html(subunit_response, backend=backend)
+
+    products = []
+    for product in subunit_soup.select('div.col-xs-4.col-sm-3.col-lg-4.inner-bottom-xs.text-center.li-img-holder'):
+        product_endpoint = product.select('a')[0]['href']
+        product_name = product.find_next_sibling('div').select('h2')[0].text
+        products.append((product_endpoint, product_name))
+    return products
+
+
+@profiled_stage('product_page')
+def parse_product_page(product_response, category_name, unit_name, subunit_name, product_name,
+                       partial: bool = HTML_PARTIAL_PARSING, backend: str = None) -> dict:
+    """
+    Parse a product page, including its FAQs, into chunks.
+    :param product_response: HTML of the product page
     :param category_name: category name
     :param unit_name: unit name
     :param subunit_name: subunit name
     :param product_name: product name
-    :param product_endpoint: product endpoint
+    :param partial: parse only the subtrees of the page used by the scraper
+    :param backend: HTML parser backend (the one selected with HTML_PARSER if None)
     :return: product dictionary with faqs list
     """
     product_chunks_list = []
     faqs = []
-    product_response = await fetch(session, f"https://myzone.airzone.es{product_endpoint}")
 
     # Remove any <br> from the response before continuing
     filtered_response = product_response.replace('<br/>', '').replace('<br />', '').replace('</br>', '').replace('\n',
                                                                                                                  '')
-    product_soup = BeautifulSoup(filtered_response, 'html.parser')
+    product_soup = parse_product_page_html(filtered_response, partial, backend)
 
     raw_description = product_soup.find('div', itemprop='description')
-    final_description = ''
-    for tag in raw_description.contents:
-        if tag.name == 'p' or (isinstance(tag, NavigableString) and tag.strip() != ''):
-            final_description += tag.text.strip() + " "
-        elif tag.name == 'ul' or tag.name == 'ol':
-            list_number = 1
-            for li in tag.contents:
-                if li.name == 'li':
-                    final_description += str(list_number) + ") " + li.text.strip() + " "
-                    list_number += 1
-
-    # Clean the final description removing double whitespaces and whitespaces before a dot
-    clean_final_description = final_description.replace(" .", ".").replace("   ", " ").replace("  ",
-                                                                                               " ").replace(
-        "\n", " ").strip()
-    chunks = split_text_into_chunks(clean_final_description, chunk_size=1000, chunk_overlap=200)
+    clean_final_description = PRODUCT_NORMALIZER.normalize(raw_description)
+    chunks = split_text_into_chunks(clean_final_description, chunk_size=PRODUCT_CHUNK_SIZE,
+                                    chunk_overlap=PRODUCT_CHUNK_OVERLAP)
 
     for i, text in enumerate(chunks):
         # Calculate the hash_id based on the title and the description
         hash_id_data = f"{product_name}{text}"
         hash_id = calculate_hash(hash_id_data)
 
-        chunk_dict = {
-            'hash_id': hash_id,
-            'upload_date': time.strftime('%Y-%m-%d %H:%M:%S'),
-            'source': 'Airzone Products',
-            'title': product_name,
-            'description': text
-        }
-        product_chunks_list.append(chunk_dict)
+        product_chunks_list.append(ChunkRecord.create(hash_id, PRODUCTS_SOURCE, product_name, text))
 
     # Check also if there are FAQs for this product
     questions = [q.get_text(strip=True) for q in
@@ -131,89 +200,146 @@ async def process_product(session, category_name, unit_name, subunit_name, produ
 
     for idx, answer in enumerate(answers):
         try:
-            answer_description = ''
-            for answer_tag in answer.contents:
-                if answer_tag.name == 'p' or (isinstance(answer_tag, NavigableString) and answer_tag.strip() != ''):
-                    answer_description += answer_tag.text.strip() + " "
-                elif answer_tag.name == 'ul' or answer_tag.name == 'ol':
-                    list_number = 1
-                    for li in answer_tag.contents:
-                        if li.name == 'li':
-                            answer_description += str(list_number) + ") " + li.text.strip() + " "
-                            list_number += 1
-
-            # Clean the final answer removing double whitespaces and whitespaces before a dot
-            clean_final_answer = answer_description.replace(" .", ".").replace("   ", " ").replace("  ",
-                                                                                                   " ").replace(
-                "\n", " ").strip()
-
-            chunks = split_text_into_chunks(clean_final_answer, chunk_size=1000, chunk_overlap=200)
+            clean_final_answer = PRODUCT_NORMALIZER.normalize(answer)
+
+            chunks = split_text_into_chunks(clean_final_answer, chunk_size=PRODUCT_CHUNK_SIZE,
+                                            chunk_overlap=PRODUCT_CHUNK_OVERLAP)
 
             for i, text in enumerate(chunks):
                 # Calculate the hash_id based on the title and the description
                 hash_id_data = f"{clean_questions[idx]}{text}"
                 hash_id = calculate_hash(hash_id_data)
 
-                faq_chunk = {
-                    'hash_id': hash_id,
-                    'upload_date': time.strftime('%Y-%m-%d %H:%M:%S'),
-                    'source': 'Product FAQs',
-                    'title': clean_questions[idx],
-                    'description': text
-                }
-                faqs.append(faq_chunk)
+                faqs.append(ChunkRecord.create(hash_id, PRODUCT_FAQS_SOURCE, clean_questions[idx], text))
 
         except IndexError:
-            print(f"IndexError: {category_name}, {unit_name}, {subunit_name}, {product_name}")
+            logging.warning(f"IndexError: {category_name}, {unit_name}, {subunit_name}, {product_name}")
 
     product_dict = {'products': product_chunks_list, 'faqs': faqs}
 
     return product_dict
 
 
+async def crawl_products(session, product_jobs, executor, on_product, cache=None) -> int:
+    """
+    Crawl the product pages as a pipeline: the fetch workers download the pages and put them into a bounded queue, and
+    the parse workers take them from the queue and parse them in the executor, out of the event loop. When the queue is
+    full, the fetch workers wait, so the downloads cannot run far ahead of the parsing. Each product dictionary is
+    handed to a callback as soon as it is available, so the results of the crawl are not kept in memory.
+    :param session: aiohttp session
+    :param product_jobs: list of tuples with the category, unit, subunit and product names and the product endpoint
+    :param executor: executor of the parsing stage
+    :param on_product: coroutine function called with the product dictionary of each product page
+    :param cache: HttpCache object used to skip the parsing of pages not modified since the last run
+    :return: number of product pages that failed
+    """
+    pending_jobs = deque(product_jobs)
+    parse_queue = asyncio.Queue(maxsize=PRODUCTS_PARSE_QUEUE_SIZE)
+    failed_pages = 0
+    fetch_depths = []
+    parse_depths = []
+
+    async def fetch_worker():
+        nonlocal failed_pages
+        while pending_jobs:
+            job = pending_jobs.popleft()
+            fetch_depths.append(len(pending_jobs))
+            product_url = f"{MYZONE_URL}{job[4]}"
+            try:
+                product_response, not_modified = await fetch_cached(session, product_url, cache)
+            except Exception as e:
+                logging.error(f"Failed to fetch the product page {product_url}: {e}")
+                failed_pages += 1
+                continue
+
+            # If the page has not changed since the last run, reuse its chunks instead of parsing it again
+            try:
+                product_dict = cache.get_derived(product_url, get_processing_version()) if not_modified else None
+                if product_dict is not None:
+                    await on_product({key: [ChunkRecord.from_json(chunk) for chunk in chunks]
+                                      for key, chunks in product_dict.items()})
+                    continue
+            except Exception as e:
+                logging.error(f"Failed to reuse the cached chunks of the product page {product_url}: {e}")
+                failed_pages += 1
+                continue
+            await parse_queue.put((job, product_url, product_response))
+            parse_depths.append(parse_queue.qsize())
+
+    async def parse_worker():
+        nonlocal failed_pages
+        while True:
+            job, product_url, product_response = await parse_queue.get()
+            try:
+                with timer('parse'):
+                    product_dict = await run_in_executor(executor, parse_product_page, product_response, *job[:4])
+                if cache is not None:
+                    cache.set_derived(product_url, product_dict, get_processing_version())
+                await on_product(product_dict)
+            except Exception as e:
+                logging.error(f"Failed to parse the product page {product_url}: {e}")
+                failed_pages += 1
+            finally:
+                parse_queue.task_done()
+
+    parse_workers = [asyncio.create_task(parse_worker()) for _ in range(PRODUCTS_PARSE_WORKERS)]
+    try:
+        await asyncio.gather(*[fetch_worker() for _ in range(PRODUCTS_FETCH_WORKERS)])
+        await parse_queue.join()
+    finally:
+        for worker in parse_workers:
+            worker.cancel()
+
+    if fetch_depths:
+        logging.info(f"Products pipeline: {len(product_jobs)} pages. Fetch stage queue depth: max "
+                     f"{max(fetch_depths)}, mean {sum(fetch_depths) / len(fetch_depths):.1f}. Parse stage queue depth: "
+                     f"max {max(parse_depths, default=0)}, mean {sum(parse_depths) / max(len(parse_depths), 1):.1f} "
+                     f"(limit {PRODUCTS_PARSE_QUEUE_SIZE})")
+    return failed_pages
+
+
 async def airzone_products_scraper(db):
     """
-    Scrape the products from the Myzone website and their FAQs.
-    :param db_connection: MySQL's connection object
+    Scrape the products from the Myzone website and their FAQs. The chunks of each product page are written into the
+    database in batches while the pages are being crawled.
+    :param db: MongoDB database object
     """
     try:
-        async with aiohttp.ClientSession() as session:
-            logging.info("Starting the 'Myzone Products' scraper...")
-            products_endpoint = 'https://myzone.airzone.es/productos/'
-            response = await fetch(session, products_endpoint)
-            soup = BeautifulSoup(response, 'html.parser')
-
-            categories = soup.find_all('h3', {'class': 'sidelines text-center'})
-
-            tasks = []
-            for category in categories:
-                category_name = category.text.strip()
-                units = category.find_next_sibling('ul').select('li.categoria')
-
-                for unit in units:
-                    unit_name = unit.select('a > span.sidebar-nav-item')[0].text
-                    subunits = unit.select('ul > li')
-
-                    for subunit in subunits:
-                        # If subunit text does not contain 'Ver todos'
-                        if 'Ver todos' not in subunit.text:
-                            tasks.append(process_subunit(session, category_name, unit_name, subunit))
-
-            # Wait for all tasks to finish
-            result = await asyncio.gather(*tasks)
-
-            product_list = [product for sublist in result for chunk_list in sublist for product in
-                            chunk_list['products']]
-            # Extract all faqs elements from the product_list 'faqs' item in each product
-            faqs = [faq for sublist in result for chunk_list in sublist for faq in chunk_list['faqs']]
-
-            product_df = pd.DataFrame(product_list)
-            product_collection = db['product']
-            insert_df_into_db(product_collection, product_df)
-
-            faq_df = pd.DataFrame(faqs)
-            support_collection = db['support']
-            insert_df_into_db(support_collection, faq_df)
+        cache = get_http_cache()
+        product_collection = db['product']
+        support_collection = db['support']
+        product_sync = DocumentSync(product_collection)
+        faq_sync = DocumentSync(support_collection)
+
+        async def on_product(product_dict):
+            # The database writes are blocking, so they run outside the event loop
+            await asyncio.to_thread(product_sync.add_many, product_dict['products'])
+            await asyncio.to_thread(faq_sync.add_many, product_dict['faqs'])
+
+        with create_cpu_executor(PRODUCTS_PARSE_WORKERS, PRODUCTS_PARSE_EXECUTOR == 'process') as executor:
+            async with create_client_session() as session:
+                logging.info("Starting the 'Myzone Products' scraper...")
+                products_endpoint = f'{MYZONE_URL}/productos/'
+                response = await fetch(session, products_endpoint)
+                with timer('parse'):
+                    subunits = await run_in_executor(executor, parse_products_index, response)
+
+                # Get the products of every subunit, and then crawl all the product pages
+                subunits_products = await asyncio.gather(
+                    *[process_subunit(session, *subunit, executor, cache) for subunit in subunits])
+                product_jobs = [job for subunit_products in subunits_products if subunit_products is not None
+                                for job in subunit_products]
+                failed_pages = await crawl_products(session, product_jobs, executor, on_product, cache)
+                failed_pages += subunits_products.count(None)
+
+        # The stored chunks of the pages that could not be crawled must not be removed
+        if failed_pages:
+            logging.warning(f"{failed_pages} Myzone pages failed, so the stale products and FAQs are not removed")
+            product_sync.discard_source(PRODUCTS_SOURCE)
+            faq_sync.discard_source(PRODUCT_FAQS_SOURCE)
+
+        log_sync_stats(product_collection, product_sync.finish())
+        log_sync_stats(support_collection, faq_sync.finish())
 
     except aiohttp.ClientError as e:
         logging.error(f"Aiohttp client error: {str(e)}")
@@ -1,107 +1,283 @@
+import asyncio
 import logging
-import time
-import pandas as pd
+import os
+from typing import AsyncIterator, Iterator
+import aiohttp
 import requests
 import warnings
-from bs4 import BeautifulSoup, NavigableString
+from bs4 import BeautifulSoup
 from requests import Session
-from src.utils.general_functions import calculate_hash, insert_df_into_db, split_text_into_chunks, extract_text_from_pdfs_parallel
+from src.utils.chunk_record import ChunkRecord
+from src.utils.db_sync import DocumentSync, log_sync_stats
+from src.utils.general_functions import AIRZONE_API_URL, calculate_hash, split_text_into_chunks, iter_text_from_pdfs, \
+    fetch, fetch_cached, create_client_session
+from src.utils.http_cache import get_cache_key, get_http_cache, processing_version
+from src.utils.metrics import timer
+from src.utils.text_normalizer import HtmlNormalizer
 from bs4 import MarkupResemblesLocatorWarning
 
 
 # Disable the warning
 warnings.simplefilter("ignore", MarkupResemblesLocatorWarning)
 
+# Run the Support crawlers with asyncio, fetching groups, pages and sections concurrently
+SUPPORT_SCRAPER_ASYNC = os.environ.get('SUPPORT_SCRAPER_ASYNC', 'true').lower() == 'true'
+# Maximum number of concurrent requests to the Support API in the async mode
+SUPPORT_MAX_CONCURRENCY = int(os.environ.get('SUPPORT_MAX_CONCURRENCY', 10))
+
+SUPPORT_ENDPOINT = f'{AIRZONE_API_URL}/msmultimedia.pv1/digital-doc/books'
+SECTION_ENDPOINT = f'{AIRZONE_API_URL}/msmultimedia.pv1/digital-doc/sections/{{}}'
+FAQ_GROUPS_ENDPOINT = f'{AIRZONE_API_URL}/msmultimedia.pv1/faq-groups'
+FAQ_ENDPOINT = f'{AIRZONE_API_URL}/msmultimedia.pv1/faqs'
+GROUPS_ENDPOINT = f'{AIRZONE_API_URL}/msmultimedia.pv1/groups'
+GROUP_ENDPOINT = f'{AIRZONE_API_URL}/msmultimedia.pv1/groups/{{}}'
+
+SUPPORT_SOURCE = 'Airzone Support'
+FAQS_SOURCE = 'Airzone FAQs'
+DOWNLOADS_SOURCE = 'Airzone Downloads'
+
+# Conversion of the HTML descriptions of the digital book sections and of the FAQ answers into text
+SECTION_NORMALIZER = HtmlNormalizer(paragraph_tags=(), list_tags=(), walk_blocks=True, string_separator='',
+                                    drop_links=True)
+FAQ_NORMALIZER = HtmlNormalizer(paragraph_tags=(), list_tags=(), inline_tags=('a',), skipped_tags=('h1',),
+                                walk_blocks=True, fix_parentheses=True)
+# Chunk size and overlap of the digital book sections and of the FAQ answers
+SUPPORT_CHUNK_SIZE = 1000
+SUPPORT_CHUNK_OVERLAP = 200
+
+
+def get_support_categories(response_json) -> list:
+    """
+    Get the categories of the 'Airzone Cloud' digital book from the books response.
+    :param response_json: JSON response of the books endpoint
+    :return: list of dictionaries with the name and az_iso of each category
+    """
+    target_iso = 'MU_AZCLOUD'
+    categories = []
+    digital_books_data = response_json['body']['digital_books']['data']
+
+    category_list = next((item for item in digital_books_data if item.get('az_iso') == target_iso), None)
+
+    # If the categories are found in the response, the 'name' values for each list element in
+    # 'digital_sections' are extracted
+    if category_list and 'digital_sections' in category_list:
+        for category in category_list['digital_sections']:
+            # Add the category name and az_iso into a dictionary
+            categories.append({'name': category['name'], 'az_iso': category['az_iso']})
+        return categories
+
 
-def airzone_support_scraper(session: Session) -> pd.DataFrame:
-    support_endpoint = 'https://api.airzonecloud.com/msmultimedia.pv1/digital-doc/books'
+def process_support_section(response_json) -> list:
+    """
+    Clean and split into chunks the contents of a digital book section.
+    :param response_json: JSON response of the section endpoint
+    :return: list of ChunkRecord objects
+    """
     support_document_list = []
-    categories = []
-    target_iso = 'MU_AZCLOUD'
+    units = response_json['body']['digital_section']['digital_subsections']
+
+    for unit in units:
+        for subunit in unit['digital_contents']:
+            title = subunit['name']
+            raw_description = subunit['description']
+
+            # In order to clean the description, we will use BeautifulSoup
+            soup = BeautifulSoup(raw_description, 'html.parser')
+            clean_final_description = SECTION_NORMALIZER.normalize(soup)
+
+            chunks = split_text_into_chunks(clean_final_description, chunk_size=SUPPORT_CHUNK_SIZE,
+                                            chunk_overlap=SUPPORT_CHUNK_OVERLAP)
+
+            for i, text in enumerate(chunks):
+                # Calculate the hash_id based on the title and the description
+                hash_id_data = f"{title}{text}"
+                hash_id = calculate_hash(hash_id_data)
+
+                support_document_list.append(ChunkRecord.create(hash_id, SUPPORT_SOURCE, title, text))
+
+    return support_document_list
+
+
+def process_faq_page(response_json) -> list:
+    """
+    Clean and split into chunks the answers of a FAQs page.
+    :param response_json: JSON response of the FAQs endpoint
+    :return: list of ChunkRecord objects
+    """
+    faq_list = []
+    faqs = response_json['body']['faqs']['data']
+
+    for faq in faqs:
+        faq_question = faq['question']
+        faq_raw_answer = faq['answer']
+
+        # In order to clean the description, we will use BeautifulSoup
+        soup = BeautifulSoup(faq_raw_answer, 'html.parser')
+        clean_final_answer = FAQ_NORMALIZER.normalize(soup)
+
+        chunks = split_text_into_chunks(clean_final_answer, chunk_size=SUPPORT_CHUNK_SIZE,
+                                        chunk_overlap=SUPPORT_CHUNK_OVERLAP)
+
+        for i, text in enumerate(chunks):
+            # Calculate the hash_id based on the title and the description
+            hash_id_data = f"{faq_question}{text}"
+            hash_id = calculate_hash(hash_id_data)
+
+            faq_list.append(ChunkRecord.create(hash_id, FAQS_SOURCE, faq_question, text))
+
+    return faq_list
+
+
+def get_group_pdfs(response_json) -> list:
+    """
+    Get the PDF resources of a media group.
+    :param response_json: JSON response of the media group endpoint
+    :return: list of dictionaries with the title and URL of each PDF
+    """
+    item_list = []
+    group_classes = response_json['body']['media_group']['classes']
+    for group_class in group_classes:
+        for item in group_class['media_resources']:
+            if 'pdf' in item['url']:
+                item_name = item['name']
+                item_url = item['url']
+                # Save each item in a temporary dictionary
+                temp_item_dict = {'title': item_name,
+                                  'url': item_url
+                                  }
+                item_list.append(temp_item_dict)
+    return item_list
+
+
+def iter_pdf_records(item_list) -> Iterator[dict]:
+    """
+    Extract the text of the PDFs and split it into chunks, yielding the chunks of each PDF as soon as it is extracted.
+    If any PDF fails, an exception is raised once the rest of the PDFs have been processed.
+    :param item_list: list of dictionaries with the title and URL of each PDF
+    :return: generator of PDF ChunkRecord objects
+    """
+    # Remove duplicated PDFs by URL
+    unique_pdfs = {}
+    for item in item_list:
+        unique_pdfs.setdefault(item['url'], item['title'])
+
+    failed_pdfs = 0
+    # Extract the text from the PDFs in parallel
+    for pdf_title, pdf_url, pdf_text in iter_text_from_pdfs((title, url) for url, title in unique_pdfs.items()):
+        if pdf_text is None:
+            failed_pdfs += 1
+            continue
+
+        # Split the text into a list of paragraphs, separated by the newline character, and remove any paragraph that
+        # is less than 25 characters, enough to filter out any data that is not useful
+        paragraphs = [paragraph for paragraph in pdf_text.split('\n') if len(paragraph) > 25]
 
+        # Remake the full text by joining the paragraphs texts
+        full_text = ' '.join(paragraphs)
+
+        for i, text in enumerate(split_text_into_chunks(full_text, chunk_size=500, chunk_overlap=100)):
+            # Calculate the hash_id based on the title and the description
+            hash_id_data = f"{pdf_title}{text}"
+            hash_id = calculate_hash(hash_id_data)
+
+            yield ChunkRecord.create(hash_id, DOWNLOADS_SOURCE, pdf_title, text, pdf_url)
+
+    if failed_pdfs:
+        raise RuntimeError(f"The text of {failed_pdfs} PDFs could not be extracted")
+
+
+async def fetch_json(session, semaphore, url, params=None) -> dict:
+    """
+    Fetch a JSON response, limiting the number of concurrent requests with a semaphore.
+    :param session: aiohttp session
+    :param semaphore: asyncio semaphore
+    :param url: URL to fetch
+    :param params: query string parameters of the request
+    :return: JSON response
+    """
+    async with semaphore:
+        return await fetch(session, url, output_format='json', params=params)
+
+
+# Version of the processing of the pages by each function, so the chunks cached by a run that processed them with other
+# parameters are not reused
+PROCESSING_VERSIONS = {
+    process_support_section: processing_version(SECTION_NORMALIZER, SUPPORT_CHUNK_SIZE, SUPPORT_CHUNK_OVERLAP),
+    process_faq_page: processing_version(FAQ_NORMALIZER, SUPPORT_CHUNK_SIZE, SUPPORT_CHUNK_OVERLAP),
+}
+
+
+def process_cached_page(cache, cache_key, response_json, not_modified, process_function) -> list:
+    """
+    Process a page, reusing the chunks of the last run if the page has not been modified since then and the function
+    that processes it has the same version.
+    :param cache: HttpCache object (or None)
+    :param cache_key: cache key of the page
+    :param response_json: JSON response of the page
+    :param not_modified: True if the page was not modified since the last run
+    :param process_function: function that returns the list of chunks of the page (a key of PROCESSING_VERSIONS)
+    :return: list of ChunkRecord objects
+    """
+    version = PROCESSING_VERSIONS[process_function]
+    chunks = cache.get_derived(cache_key, version) if not_modified else None
+    if chunks is not None:
+        chunks = [ChunkRecord.from_json(chunk) for chunk in chunks]
+    else:
+        with timer('parse'):
+            chunks = process_function(response_json)
+        if cache is not None:
+            cache.set_derived(cache_key, chunks, version)
+    return chunks
+
+
+async def fetch_and_process_page(session, semaphore, cache, process_function, url, params=None) -> tuple:
+    """
+    Fetch a JSON page with a conditional request and process it into chunks.
+    :param session: aiohttp session
+    :param semaphore: asyncio semaphore
+    :param cache: HttpCache object (or None)
+    :param process_function: function that returns the list of chunks of the page
+    :param url: URL to fetch
+    :param params: query string parameters of the request
+    :return: tuple with the JSON response and its list of chunks
+    """
+    async with semaphore:
+        response_json, not_modified = await fetch_cached(session, url, cache, output_format='json', params=params)
+    chunks = process_cached_page(cache, get_cache_key(url, params), response_json, not_modified, process_function)
+    return response_json, chunks
+
+
+def create_support_client_session(session: Session) -> aiohttp.ClientSession:
+    """
+    Create an aiohttp session with the same headers as the requests session.
+    :param session: requests session
+    :return: aiohttp session
+    """
+    return create_client_session(headers=dict(session.headers), raise_for_status=True)
+
+
+def iter_support_records(session: Session) -> Iterator[dict]:
+    """
+    Scrape the Airzone Support sections, yielding the chunks of each section.
+    :param session: requests session
+    :return: generator of ChunkRecord objects
+    """
+    response = session.get(SUPPORT_ENDPOINT)
+    categories = get_support_categories(response.json())
+
+    cache = get_http_cache()
+    for category in categories or []:
+        response = session.get(SECTION_ENDPOINT.format(category['az_iso']))
+        response.raise_for_status()
+        yield from process_cached_page(cache, response.url, response.json(), getattr(response, 'not_modified', False),
+                                       process_support_section)
+
+
+def airzone_support_scraper(session: Session, document_sync: DocumentSync) -> None:
     try:
         logging.info("Starting the 'Airzone Support' website scraper...")
-        response = session.get(support_endpoint)
-        response_json = response.json()
-
-        digital_books_data = response_json['body']['digital_books']['data']
-
-        category_list = next((item for item in digital_books_data if item.get('az_iso') == target_iso), None)
-
-        # If the categories are found in the response, the 'name' values for each list element in
-        # 'digital_sections' are extracted
-        if category_list and 'digital_sections' in category_list:
-            for category in category_list['digital_sections']:
-                # Add the category name and az_iso into a dictionary
-                categories.append({'name': category['name'], 'az_iso': category['az_iso']})
-
-            for category in categories:
-                category_endpoint = f"https://api.airzonecloud.com/msmultimedia.pv1/digital-doc/sections/{category['az_iso']}"
-                response = session.get(category_endpoint)
-                response.raise_for_status()
-                response_json = response.json()
-                units = response_json['body']['digital_section']['digital_subsections']
-
-                for unit in units:
-                    for subunit in unit['digital_contents']:
-                        title = subunit['name']
-                        raw_description = subunit['description']
-
-                        # In order to clean the description, we will use BeautifulSoup
-                        soup = BeautifulSoup(raw_description, 'html.parser')
-                        clean_description = ""
-                        excluded_tags = ['a']
-                        for tag in soup.contents:
-                            if tag.name in excluded_tags:
-                                tag.decompose()
-                            elif tag.next.name in excluded_tags:
-                                tag.next.decompose()
-                            elif tag.text == '':
-                                tag.decompose()
-                            elif isinstance(tag, NavigableString):
-                                clean_description += tag.strip()
-                            else:
-                                list_number = 1
-                                # Iterate over the children of the tag to add to a predefined string only tags with
-                                # readable text
-                                for content in tag.contents:
-                                    if tag.name in ('h2', 'h3', 'h4'):
-                                        clean_description += content.text.strip() + ": "
-                                    elif content.name == 'li':
-                                        clean_description += str(list_number) + ") " + content.text.strip() + " "
-                                        list_number += 1
-                                    elif content.name in ('a', 'em'):
-                                        clean_description += "\"" + content.text.strip() + "\"" + " "
-                                    else:
-                                        clean_description += content.text.strip() + " "
-
-                        # Clean the final description removing double whitespaces and whitespaces before a dot
-                        clean_final_description = clean_description.replace(" .", ".").replace("   ", " ").replace("  ",
-                                                                                                                   " ").replace(
-                            "\n", " ").strip()
-
-                        chunks = split_text_into_chunks(clean_final_description, chunk_size=1000, chunk_overlap=200)
-
-                        for i, text in enumerate(chunks):
-                            # Calculate the hash_id based on the title and the description
-                            hash_id_data = f"{title}{text}"
-                            hash_id = calculate_hash(hash_id_data)
-
-                            chunk_dict = {
-                                'hash_id': hash_id,
-                                'upload_date': time.strftime('%Y-%m-%d %H:%M:%S'),
-                                'source': 'Airzone Support',
-                                'title': title,
-                                'description': text
-                            }
-                            support_document_list.append(chunk_dict)
-
-            logging.info("Inserting the 'Airzone Support' scraped data into a dataframe...")
-
-            # Store the documents into the dataframe
-            df = pd.DataFrame(support_document_list)
-
-            return df
+        with document_sync.track_source(SUPPORT_SOURCE):
+            document_sync.add_many(iter_support_records(session))
 
     except requests.exceptions.Timeout as e:
         logging.error(f"Request timed out: {str(e)}")
@@ -111,87 +287,82 @@ def airzone_support_scraper(session: Session) -> pd.DataFrame:
         logging.error(f"An error occurred in the airzone_support_scraper function: {str(e)}")
 
 
-def airzone_faq_scraper(session: Session) -> pd.DataFrame:
-    logging.info("Starting the 'Airzone Control' website FAQs scraper...")
-
-    faq_groups_endpoint = 'https://api.airzonecloud.com/msmultimedia.pv1/faq-groups'
-    faq_list = []
-    # Create a dataframe to store the data
-    df = pd.DataFrame(
-        columns=['hash_id', 'uploaded_date', 'source', 'title', 'description'])
+async def iter_support_pages_async(session, semaphore, cache) -> AsyncIterator[list]:
+    """
+    Fetch all the Airzone Support sections concurrently, yielding the chunks of each section in the order of the
+    categories (so the chunks are the same as in the sync mode) as soon as it and the previous ones are processed.
+    :param session: aiohttp session
+    :param semaphore: asyncio semaphore
+    :param cache: HttpCache object (or None)
+    :return: async generator of lists of ChunkRecord objects
+    """
+    categories = get_support_categories(await fetch_json(session, semaphore, SUPPORT_ENDPOINT))
+
+    sections = [asyncio.ensure_future(fetch_and_process_page(session, semaphore, cache, process_support_section,
+                                                             SECTION_ENDPOINT.format(category['az_iso'])))
+                for category in categories or []]
     try:
-        response = session.get(faq_groups_endpoint)
-        response_json = response.json()
+        for section in sections:
+            yield (await section)[1]
+    finally:
+        # If a section fails, the rest of the sections are not needed anymore
+        for section in sections:
+            section.cancel()
 
-        faq_groups = [{'name': group['name'], 'reference': group['reference']} for group in
-                      response_json['body']['groups']]
 
-        for group in faq_groups:
-            faq_endpoint = "https://api.airzonecloud.com/msmultimedia.pv1/faqs"
-            response = session.get(faq_endpoint, params={'group': group['reference']})
+async def airzone_support_scraper_async(session: Session, document_sync: DocumentSync) -> None:
+    try:
+        logging.info("Starting the 'Airzone Support' website scraper (async mode)...")
+        semaphore = asyncio.Semaphore(SUPPORT_MAX_CONCURRENCY)
+        cache = get_http_cache()
+        with document_sync.track_source(SUPPORT_SOURCE):
+            async with create_support_client_session(session) as client_session:
+                # The database writes are blocking, so they run outside the event loop
+                async for chunks in iter_support_pages_async(client_session, semaphore, cache):
+                    await asyncio.to_thread(document_sync.add_many, chunks)
+
+    except asyncio.TimeoutError as e:
+        logging.error(f"Request timed out: {str(e)}")
+    except aiohttp.ClientResponseError as e:
+        logging.error(f"HTTP error occurred: {str(e)}")
+    except Exception as e:
+        logging.error(f"An error occurred in the airzone_support_scraper_async function: {str(e)}")
+
+
+def iter_faq_records(session: Session) -> Iterator[dict]:
+    """
+    Scrape the Airzone Control FAQs, yielding the chunks of each page.
+    :param session: requests session
+    :return: generator of ChunkRecord objects
+    """
+    response = session.get(FAQ_GROUPS_ENDPOINT)
+    response_json = response.json()
+
+    faq_groups = [{'name': group['name'], 'reference': group['reference']} for group in
+                  response_json['body']['groups']]
+
+    cache = get_http_cache()
+    for group in faq_groups:
+        n_pages = 1
+        page = 1
+        while page <= n_pages:
+            response = session.get(FAQ_ENDPOINT, params={'page': page, 'group': group['reference']})
             response_json = response.json()
+            yield from process_cached_page(cache, response.url, response_json,
+                                           getattr(response, 'not_modified', False), process_faq_page)
 
-            n_pages = response_json['body']['faqs']['last_page']
-
-            for page in range(1, n_pages + 1):
-                faq_page_endpoint = "https://api.airzonecloud.com/msmultimedia.pv1/faqs"
-                response = session.get(faq_page_endpoint, params={'page': page, 'group': group['reference']})
-                response_json = response.json()
-
-                faqs = response_json['body']['faqs']['data']
-
-                for faq in faqs:
-                    faq_question = faq['question']
-                    faq_raw_answer = faq['answer']
-
-                    # In order to clean the description, we will use BeautifulSoup
-                    soup = BeautifulSoup(faq_raw_answer, 'html.parser')
-                    final_answer = ""
-                    for tag in soup.contents:
-                        if tag.name == 'a':
-                            final_answer += tag.text.strip()
-                        elif tag.name == 'h1' or tag.text == '':
-                            continue
-                        elif isinstance(tag, NavigableString):
-                            final_answer += tag.strip() + " "
-                        else:
-                            list_number = 1
-                            # Iterate over the children of the tag
-                            for content in tag.contents:
-                                if tag.name in ('h2', 'h3', 'h4'):
-                                    final_answer += content.text.strip() + ": "
-                                elif content.name == 'li':
-                                    final_answer += str(list_number) + ") " + content.text.strip() + " "
-                                    list_number += 1
-                                elif content.name in ('a', 'em'):
-                                    final_answer += "\"" + content.text.strip() + "\"" + " "
-                                else:
-                                    final_answer += content.text.strip() + " "
-
-                    # Clean the final description removing double whitespaces and whitespaces before a dot
-                    clean_final_answer = final_answer.replace(" .", ".").replace("   ", " ").replace("  ", " ").replace(
-                        "\n", " ").replace("( ", "(").strip()
-
-                    chunks = split_text_into_chunks(clean_final_answer, chunk_size=1000, chunk_overlap=200)
-
-                    for i, text in enumerate(chunks):
-                        # Calculate the hash_id based on the title and the description
-                        hash_id_data = f"{faq_question}{text}"
-                        hash_id = calculate_hash(hash_id_data)
-
-                        chunk_dict = {
-                            'hash_id': hash_id,
-                            'upload_date': time.strftime('%Y-%m-%d %H:%M:%S'),
-                            'source': 'Airzone FAQs',
-                            'title': faq_question,
-                            'description': text
-                        }
-                        faq_list.append(chunk_dict)
-
-        logging.info("Inserting the 'Airzone Control' FAQs scraped data into a dataframe...")
-
-        # Store the categories, units, subunits and descriptions in the dataframe
-        df = pd.DataFrame(faq_list)
+            # The first page also tells the number of pages of the group
+            if page == 1:
+                n_pages = response_json['body']['faqs']['last_page']
+            page += 1
+
+
+def airzone_faq_scraper(session: Session, document_sync: DocumentSync) -> None:
+    logging.info("Starting the 'Airzone Control' website FAQs scraper...")
+
+    try:
+        with document_sync.track_source(FAQS_SOURCE):
+            document_sync.add_many(iter_faq_records(session))
 
     except requests.exceptions.Timeout as e:
         logging.error(f"Request timed out: {str(e)}")
@@ -200,106 +371,143 @@ def airzone_faq_scraper(session: Session) -> pd.DataFrame:
     except Exception as e:
         logging.error(f"An error occurred in the airzone_faq_scraper function: {str(e)}")
 
-    return df
 
+async def fetch_faq_group(session, semaphore, cache, group) -> list:
+    """
+    Fetch and process all the FAQs pages of a group, reusing the first page to know the number of pages.
+    :param session: aiohttp session
+    :param semaphore: asyncio semaphore
+    :param cache: HttpCache object (or None)
+    :param group: FAQs group dictionary
+    :return: list with the chunks of each page, in order
+    """
+    first_page, first_chunks = await fetch_and_process_page(session, semaphore, cache, process_faq_page, FAQ_ENDPOINT,
+                                                            params={'page': 1, 'group': group['reference']})
+    n_pages = first_page['body']['faqs']['last_page']
 
-def airzone_downloads_scraper(session):
-    logging.info("Starting the 'Airzone Control' website Downloads scraper...")
+    next_pages = await asyncio.gather(
+        *[fetch_and_process_page(session, semaphore, cache, process_faq_page, FAQ_ENDPOINT,
+                                 params={'page': page, 'group': group['reference']})
+          for page in range(2, n_pages + 1)])
 
-    groups_endpoint = 'https://api.airzonecloud.com/msmultimedia.pv1/groups'
-    item_list = []
-    try:
-        response = session.get(groups_endpoint)
-        response_json = response.json()
+    return [first_chunks, *[chunks for _, chunks in next_pages]]
 
-        groups = [{'id': group['id'], 'name': group['name']} for group in response_json['body']['media_groups']]
 
-        for group in groups:
-            group_endpoint = f"https://api.airzonecloud.com/msmultimedia.pv1/groups/{group['id']}"
-            response = session.get(group_endpoint)
-            response_json = response.json()
-            group_classes = response_json['body']['media_group']['classes']
-            for group_class in group_classes:
-                for item in group_class['media_resources']:
-                    if 'pdf' in item['url']:
-                        item_name = item['name']
-                        item_url = item['url']
-                        # Save each item in a temporary dictionary
-                        temp_item_dict = {'title': item_name,
-                                          'url': item_url
-                                          }
-                        item_list.append(temp_item_dict)
+async def airzone_faq_scraper_async(session: Session, document_sync: DocumentSync) -> None:
+    logging.info("Starting the 'Airzone Control' website FAQs scraper (async mode)...")
 
-        # Create a dataframe to store the PDF names and URLs
-        pdf_df = pd.DataFrame(item_list)
+    try:
+        semaphore = asyncio.Semaphore(SUPPORT_MAX_CONCURRENCY)
+        cache = get_http_cache()
+        with document_sync.track_source(FAQS_SOURCE):
+            async with create_support_client_session(session) as client_session:
+                response_json = await fetch_json(client_session, semaphore, FAQ_GROUPS_ENDPOINT)
+
+                faq_groups = [{'name': group['name'], 'reference': group['reference']} for group in
+                              response_json['body']['groups']]
+
+                # Fetch all the groups (and their pages) concurrently, writing each group in the original order as
+                # soon as it and the previous ones are processed
+                groups = [asyncio.ensure_future(fetch_faq_group(client_session, semaphore, cache, group))
+                          for group in faq_groups]
+                try:
+                    for group_pages in groups:
+                        chunks = [chunk for page_chunks in await group_pages for chunk in page_chunks]
+                        await asyncio.to_thread(document_sync.add_many, chunks)
+                finally:
+                    # If a group fails, the rest of the groups are not needed anymore
+                    for group in groups:
+                        group.cancel()
+
+    except asyncio.TimeoutError as e:
+        logging.error(f"Request timed out: {str(e)}")
+    except aiohttp.ClientResponseError as e:
+        logging.error(f"HTTP error occurred: {str(e)}")
+    except Exception as e:
+        logging.error(f"An error occurred in the airzone_faq_scraper_async function: {str(e)}")
 
-        # Remove duplicates from the dataframe by URL
-        unique_pdf_df = pdf_df.drop_duplicates(subset='url')
 
-        # Extract the text from the PDFs in parallel
-        extracted_pdfs_text = extract_text_from_pdfs_parallel(unique_pdf_df)
+def airzone_downloads_scraper(session: Session, document_sync: DocumentSync) -> None:
+    logging.info("Starting the 'Airzone Control' website Downloads scraper...")
 
-        # Split each text into a list of paragraphs, separated by the newline character
-        split_texts = [(text[0], text[1], text[2].split('\n')) for text in extracted_pdfs_text]
+    try:
+        with document_sync.track_source(DOWNLOADS_SOURCE):
+            response = session.get(GROUPS_ENDPOINT)
+            response_json = response.json()
 
-        # Remove any paragraph that is less than 25 characters, enough to filter out any data that is not useful
-        for idx, text in enumerate(split_texts):
-            split_texts[idx] = (text[0], text[1], [paragraph for paragraph in text[2] if len(paragraph) > 25])
+            groups = [{'id': group['id'], 'name': group['name']} for group in response_json['body']['media_groups']]
 
-        # Remove any empty lists
-        split_texts = [text for text in split_texts if text]
+            item_list = []
+            for group in groups:
+                response = session.get(GROUP_ENDPOINT.format(group['id']))
+                item_list.extend(get_group_pdfs(response.json()))
 
-        # Remake the full text by joining the paragraphs texts
-        full_texts = [(text[0], text[1], ' '.join(text[2])) for text in split_texts]
+            document_sync.add_many(iter_pdf_records(item_list))
+
+    except requests.exceptions.Timeout as e:
+        logging.error(f"Request timed out: {str(e)}")
+    except requests.exceptions.HTTPError as e:
+        logging.error(f"HTTP error occurred: {str(e)}")
+    except Exception as e:
+        logging.error(f"An error occurred in the airzone_downloads_scraper function: {str(e)}")
 
-        support_pdf_chunk_list = []
-        for full_text in full_texts:
-            chunks = split_text_into_chunks(full_text[2], chunk_size=500, chunk_overlap=100)
 
-            for i, text in enumerate(chunks):
-                pdf_title = full_text[0]
-                pdf_url = full_text[1]
-                pdf_text = text
-                # Calculate the hash_id based on the title and the description
-                hash_id_data = f"{pdf_title}{pdf_text}"
-                hash_id = calculate_hash(hash_id_data)
+async def airzone_downloads_scraper_async(session: Session, document_sync: DocumentSync) -> None:
+    logging.info("Starting the 'Airzone Control' website Downloads scraper (async mode)...")
 
-                chunk_dict = {
-                    'hash_id': hash_id,
-                    'upload_date': time.strftime('%Y-%m-%d %H:%M:%S'),
-                    'source': 'Airzone Downloads',
-                    'title': pdf_title,
-                    'url': pdf_url,
-                    'description': pdf_text
-                }
-                support_pdf_chunk_list.append(chunk_dict)
+    try:
+        semaphore = asyncio.Semaphore(SUPPORT_MAX_CONCURRENCY)
+        with document_sync.track_source(DOWNLOADS_SOURCE):
+            async with create_support_client_session(session) as client_session:
+                response_json = await fetch_json(client_session, semaphore, GROUPS_ENDPOINT)
 
-        logging.info("Inserting the 'Airzone Control Downloads' scraped data into a dataframe...")
+                groups = [{'id': group['id'], 'name': group['name']} for group in
+                          response_json['body']['media_groups']]
 
-        pdf_df = pd.DataFrame(support_pdf_chunk_list)
+                # Fetch all the media groups concurrently, keeping the order of the groups
+                groups_json = await asyncio.gather(
+                    *[fetch_json(client_session, semaphore, GROUP_ENDPOINT.format(group['id'])) for group in groups])
 
-        return pdf_df
+            item_list = [item for group_json in groups_json for item in get_group_pdfs(group_json)]
 
-    except requests.exceptions.Timeout as e:
+            # The PDF extraction and the database writes are blocking, so they run outside the event loop to not stall
+            # the other crawlers
+            await asyncio.to_thread(document_sync.add_many, iter_pdf_records(item_list))
+
+    except asyncio.TimeoutError as e:
         logging.error(f"Request timed out: {str(e)}")
-    except requests.exceptions.HTTPError as e:
+    except aiohttp.ClientResponseError as e:
         logging.error(f"HTTP error occurred: {str(e)}")
     except Exception as e:
-        logging.error(f"An error occurred in the airzone_downloads_scraper function: {str(e)}")
+        logging.error(f"An error occurred in the airzone_downloads_scraper_async function: {str(e)}")
+
+
+async def support_scraper_async(session, document_sync: DocumentSync) -> None:
+    """
+    Run the three Support crawlers concurrently in async mode.
+    :param session: requests session, whose headers are reused by the aiohttp sessions
+    :param document_sync: synchronisation of the 'support' collection fed by the three crawlers
+    """
+    await asyncio.gather(airzone_support_scraper_async(session, document_sync),
+                         airzone_faq_scraper_async(session, document_sync),
+                         airzone_downloads_scraper_async(session, document_sync))
 
 
 def support_scraper(session, db):
     logging.info("Starting the Support scraper...")
     try:
-        support_df = airzone_support_scraper(session)
-        faq_df = airzone_faq_scraper(session)
-        downloads_df = airzone_downloads_scraper(session)
-
-        final_df = pd.concat([support_df, faq_df, downloads_df], ignore_index=True)
-
+        # The chunks of the three crawlers are written into the database in batches while they are being scraped
         collection = db['support']
+        document_sync = DocumentSync(collection)
         logging.info("Inserting the Support data into the database...")
-        insert_df_into_db(collection, final_df)
+        if SUPPORT_SCRAPER_ASYNC:
+            asyncio.run(support_scraper_async(session, document_sync))
+        else:
+            airzone_support_scraper(session, document_sync)
+            airzone_faq_scraper(session, document_sync)
+            airzone_downloads_scraper(session, document_sync)
+
+        log_sync_stats(collection, document_sync.finish())
 
     except Exception as e:
         logging.error(f"An error occurred in the support_scraper function: {str(e)}")